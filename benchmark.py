@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+'''
+throughput benchmark of gryphon on synthetic logs
+
+Logs of every size are written by dfsynth.py once and kept for the next
+runs. Each size is analysed in its own process, which times every
+extraction step on its own pass, the single pass of all of them, the
+command verification, the anomaly reports, the sensor analysis, the
+timeline file and the map path, with the messages per second and the
+peak RSS of each stage, where the kernel lets the peak be reset, or of
+the process so far otherwise. The records are written to a temporary
+directory removed once the log is done. A previous --json report given
+as --baseline shows the change of every stage, so regressions stand out.
+'''
+
+import sys, os, time, json, queue, traceback, tempfile, shutil
+from argparse import ArgumentParser
+from MAVProxy.modules.lib import multiproc
+from profiling import peak_rss_mb, reset_peak
+import dfsynth
+
+DEFAULT_SIZES = "10M,100M,1G"
+# change of the messages per second against the baseline shown as a regression
+REGRESSION = 0.10
+# stages quicker than that are too noisy to be flagged
+MIN_SECONDS = 0.5
+
+# seconds between the checks that the benchmark process of a log is still alive
+POLL_SECONDS = 1.0
+
+def synth_log(directory, size, seed=1):
+    '''path of the synthetic log of a size, written unless a previous run left it'''
+    filename = os.path.join(directory, "synth_%s_%u.bin" % (size, seed))
+    if not os.path.exists(filename):
+        start = time.time()
+        duration = dfsynth.duration_for_size(dfsynth.parse_size(size))
+        (messages, truth) = dfsynth.synthesize(filename + ".tmp", duration, seed=seed)
+        os.replace(filename + ".tmp", filename)
+        seconds = time.time() - start
+        print("%s: %u messages written in %.1fs (%.0f msgs/s)" % (filename, messages, seconds, messages / max(seconds, 1e-9)))
+    return filename
+
+def bench_log(filename, native, output, results):
+    '''worker process timing the stages of gryphon on one log'''
+    import gryphon
+    from sinks import make_sink
+    from dfbinary import DFBinaryReader
+    from mavflightview import mavflightview_mav, mavflightview_options
+    stages = []
+    # the records of the passes, the columnar sinks write a file per family next to the prefix they are given
+    records = tempfile.mkdtemp(prefix="gryphon_bench_")
+    # session of the last pass, whose records the stages after it analyse
+    session = None
+
+    def stage(name, func, count):
+        peak_reset = reset_peak()
+        start = time.time()
+        value = func()
+        seconds = time.time() - start
+        messages = count(value)
+        stages.append({"stage": name, "seconds": seconds, "messages": messages,
+                       "msgs_per_s": messages / max(seconds, 1e-9), "peak_rss_mb": peak_rss_mb() or 0.0,
+                       "peak_rss_of_stage": peak_reset})
+
+    def sensors_pass():
+        tlog = DFBinaryReader(filename)
+        try:
+            return session.sensor_analysis(tlog, filename)
+        finally:
+            tlog.close()
+
+    def map_pass():
+        tlog = gryphon.open_log(filename, native)
+        try:
+            return mavflightview_mav(tlog, mavflightview_options())
+        finally:
+            if hasattr(tlog, "close"):
+                tlog.close()
+
+    def one_pass(steps):
+        nonlocal session
+        if session is not None:
+            session.out.close()
+            session.close()
+        session = gryphon.AnalysisSession(make_sink(output, os.path.join(records, "records")))
+        tlog = gryphon.open_log(filename, native)
+        session.reader = tlog
+        session.dispatch_info(tlog, steps)
+        session.print_steps(steps)
+        # the next pass must not find the memory map of this one still held
+        session.reader = None
+        if hasattr(tlog, "close"):
+            tlog.close()
+        return sum([session.step_counts[step] for step in steps])
+
+    try:
+        # the timeline file is written next to the log
+        os.chdir(os.path.dirname(os.path.abspath(filename)))
+        filename = os.path.basename(filename)
+        for step in gryphon.extractors.keys():
+            stage("extract " + step, lambda: one_pass([step]), lambda n: n)
+        steps = list(gryphon.extractors.keys())
+        stage("single pass", lambda: one_pass(steps), lambda n: n)
+        stage("cmd_execution", session.cmd_execution, lambda r: len(session.cmd_list) + len(session.gps_list))
+        stage("curr_anomaly_detection", session.curr_anomaly_detection, lambda r: session.step_counts.get("curr", 0))
+        stage("gps_altD_anomaly_detection", session.gps_altD_anomaly_detection, lambda r: session.step_counts.get("gps", 0))
+        stage("gps_jump_detection", session.gps_jump_detection, lambda r: session.step_counts.get("gps", 0))
+        stage("sensor_analysis", sensors_pass, lambda r: r[1])
+        stage("timeline_analysis", lambda: session.timeline_analysis(filename), lambda r: session.timeline.count)
+        session.out.close()
+        session.close()
+        stage("mavflightview_mav", map_pass, lambda r: sum([len(p) for p in r[0]]) if r else 0)
+    except Exception:
+        # the parent would wait forever for the stages, it gets the error instead
+        results.put(traceback.format_exc())
+        return
+    finally:
+        shutil.rmtree(records, ignore_errors=True)
+    results.put(stages)
+
+def run_size(filename, native, output):
+    '''the stages of one log, timed in a fresh process so the peak RSS is the one of that log alone'''
+    results = multiproc.Queue()
+    p = multiproc.Process(target=bench_log, args=(filename, native, output, results))
+    p.start()
+    while True:
+        try:
+            stages = results.get(timeout=POLL_SECONDS)
+            break
+        except queue.Empty:
+            # a process killed before it could report, by the OOM killer for one, sends nothing
+            if not p.is_alive():
+                try:
+                    stages = results.get(timeout=POLL_SECONDS)
+                    break
+                except queue.Empty:
+                    raise RuntimeError("benchmark of %s died with exit code %s" % (filename, p.exitcode))
+    p.join()
+    if isinstance(stages, str):
+        raise RuntimeError("benchmark of %s failed:\n%s" % (filename, stages))
+    return stages
+
+def print_report(report, baseline=None):
+    for (size, stages) in report.items():
+        print("\n>%s" % size)
+        print("%-28s %9s %11s %12s %9s" % ("stage", "seconds", "messages", "msgs/s", "peak MB"))
+        before = {}
+        if baseline is not None:
+            before = dict([(s["stage"], s) for s in baseline.get(size, [])])
+        for s in stages:
+            line = "%-28s %9.2f %11u %12.0f %9.1f" % (s["stage"], s["seconds"], s["messages"], s["msgs_per_s"], s["peak_rss_mb"])
+            b = before.get(s["stage"])
+            if b is not None and b["msgs_per_s"] > 0:
+                change = s["msgs_per_s"] / b["msgs_per_s"] - 1
+                regression = change < -REGRESSION and s["seconds"] >= MIN_SECONDS
+                line += "  %+6.1f%%%s" % (change * 100, "  REGRESSION" if regression else "")
+            print(line)
+
+def __main__():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="sizes of the synthetic logs (%(default)s)")
+    parser.add_argument("--dir", default="bench", help="directory of the synthetic logs (%(default)s)")
+    parser.add_argument("--native", action='store_true', default=False, help="decode with the native NumPy decoder")
+    parser.add_argument("--output", default="console", help="sink the records are written to, in a temporary directory (%(default)s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", default=None, help="write the report to this JSON file")
+    parser.add_argument("--baseline", default=None, help="JSON report of a previous run to compare with")
+    args = parser.parse_args()
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    report = {}
+    for size in args.sizes.split(","):
+        filename = synth_log(args.dir, size, args.seed)
+        report[size] = run_size(filename, args.native, args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+if __name__ == "__main__":
+    multiproc.freeze_support()
+    __main__()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+'''
+rolling statistics for anomaly detectors fed one sample at a time
+
+Every statistic keeps a bounded window of the last samples, so a detector
+can run while the log is parsed and on logs of any length.
+'''
+
+from bisect import bisect_left, insort
+from collections import deque
+
+# scales the MAD to the standard deviation of a normal distribution
+MAD_SCALE = 1.4826
+# max allowed alt offset in meters between consecutive gps fixes, offline and live
+ALT_OFFSET = 3
+
+class RollingMean(object):
+    '''mean of the last window samples, updated in constant time'''
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.total = 0.0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def update(self, value):
+        self.samples.append(value)
+        self.total += value
+        if len(self.samples) > self.window:
+            self.total -= self.samples.popleft()
+
+    def mean(self):
+        if not self.samples:
+            return None
+        return self.total / len(self.samples)
+
+class RollingMedian(object):
+    '''median and median absolute deviation of the last window samples
+
+    The window is also kept sorted, a sample is placed and dropped with a
+    binary search, and the MAD is a selection over the two sorted runs of
+    distances on each side of the median, so no update sorts the window.
+    Placing and dropping a sample shifts the sorted list, so an update is
+    O(window), a memmove of a few hundred bytes for the windows used here.'''
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.ordered = []
+
+    def __len__(self):
+        return len(self.samples)
+
+    def update(self, value):
+        self.samples.append(value)
+        insort(self.ordered, value)
+        if len(self.samples) > self.window:
+            old = self.samples.popleft()
+            del self.ordered[bisect_left(self.ordered, old)]
+
+    def median(self):
+        n = len(self.ordered)
+        if n == 0:
+            return None
+        if n % 2:
+            return self.ordered[n // 2]
+        return (self.ordered[n // 2 - 1] + self.ordered[n // 2]) * 0.5
+
+    def kth_distance(self, m, k):
+        '''k-th smallest distance (0 based) of the samples to m'''
+        s = self.ordered
+        p = bisect_left(s, m)
+        # distances below m grow going left from p, the ones above m grow going right
+        below = lambda i: m - s[p - 1 - i]
+        above = lambda j: s[p + j] - m
+        nb = p
+        na = len(s) - p
+        # number of distances taken from below among the k+1 smallest
+        lo = max(0, k + 1 - na)
+        hi = min(k + 1, nb)
+        while lo < hi:
+            i = (lo + hi) // 2
+            # take i+1 from below if its last one is not larger than the next from above
+            if below(i) <= above(k - i):
+                lo = i + 1
+            else:
+                hi = i
+        i = lo
+        j = k + 1 - i
+        candidates = []
+        if i > 0:
+            candidates.append(below(i - 1))
+        if j > 0:
+            candidates.append(above(j - 1))
+        return max(candidates)
+
+    def mad(self):
+        n = len(self.ordered)
+        if n == 0:
+            return None
+        m = self.median()
+        if n % 2:
+            return self.kth_distance(m, n // 2)
+        return (self.kth_distance(m, n // 2 - 1) + self.kth_distance(m, n // 2)) * 0.5
+
+class RateOfChange(object):
+    '''change of a value since the previous sample, and its rate per second'''
+    def __init__(self):
+        self.last = None
+        self.delta = None
+        self.rate = None
+
+    def update(self, t, value):
+        if self.last is not None:
+            self.delta = value - self.last[1]
+            dt = t - self.last[0]
+            self.rate = self.delta / dt if dt > 0 else None
+        self.last = (t, value)
+        return self.delta
+
+class BandDetector(object):
+    '''flags samples away from the rolling mean of the samples before them
+
+    A sample is anomalous when it leaves the band of thres_per around the
+    mean, and is also a robust outlier, more than mad_k scaled MADs from the
+    rolling median, so the noise of the signal alone does not raise it.
+    Anomalies stay out of the window, but after relearn of them in a row the
+    level is taken as the new normal and the window starts over from them,
+    so a lasting change of level is only flagged at its start.'''
+    def __init__(self, window, thres_per, mad_k=3.0, min_samples=10, relearn=None):
+        self.window = window
+        self.mean = RollingMean(window)
+        self.median = RollingMedian(window)
+        self.thres_per = thres_per
+        self.mad_k = mad_k
+        self.min_samples = min_samples
+        self.relearn = relearn if relearn is not None else min_samples
+        # the anomalies in a row since the last normal sample
+        self.run = []
+
+    def update(self, value):
+        anomaly = False
+        if len(self.mean) >= self.min_samples:
+            mean = self.mean.mean()
+            # the MAD is only worked out for the samples already out of the band
+            if abs(value - mean) > abs(mean) * self.thres_per:
+                spread = self.mad_k * MAD_SCALE * self.median.mad()
+                anomaly = abs(value - self.median.median()) > spread
+        # anomalies stay out of the window so a short fault is not learnt as normal
+        if not anomaly:
+            self.run = []
+            self.mean.update(value)
+            self.median.update(value)
+            return False
+        self.run.append(value)
+        if len(self.run) >= self.relearn:
+            self.mean = RollingMean(self.window)
+            self.median = RollingMedian(self.window)
+            for v in self.run:
+                self.mean.update(v)
+                self.median.update(v)
+            self.run = []
+        return True
+
+class JumpDetector(object):
+    '''flags samples changing by at least offset since the previous one'''
+    def __init__(self, offset):
+        self.offset = offset
+        self.change = RateOfChange()
+
+    def update(self, t, value):
+        delta = self.change.update(t, value)
+        return delta is not None and abs(delta) >= self.offset
@@ -0,0 +1,860 @@
+#!/usr/bin/env python
+
+'''
+native decoder for binary DataFlash logs
+
+The log is memory mapped and the FMT records are turned into NumPy
+structured dtypes, so every record of a message type is decoded with bulk
+array operations instead of one Python object per message. The decoded
+values are the same as the ones of pymavlink's DFReader_binary.
+'''
+
+import sys, os, re, mmap, struct, heapq, itertools, hashlib, json, time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from pymavlink import mavutil
+from MAVProxy.modules.lib import multiproc
+
+HEAD1 = 0xA3
+HEAD2 = 0x95
+FMT_TYPE = 0x80
+FMT_LENGTH = 89
+
+# DataFlash format characters to (NumPy type, multiplier), as in pymavlink's FORMAT_TO_STRUCT
+FORMAT_TO_DTYPE = {
+    "a": ("(32,)<i2", None),
+    "b": ("i1", None),
+    "B": ("u1", None),
+    "g": ("<f2", None),
+    "h": ("<i2", None),
+    "H": ("<u2", None),
+    "i": ("<i4", None),
+    "I": ("<u4", None),
+    "f": ("<f4", None),
+    "n": ("S4", None),
+    "N": ("S16", None),
+    "Z": ("S64", None),
+    "c": ("<i2", 0.01),
+    "C": ("<u2", 0.01),
+    "e": ("<i4", 0.01),
+    "E": ("<u4", 0.01),
+    "L": ("<i4", 1.0e-7),
+    "d": ("<f8", None),
+    "M": ("i1", None),
+    "q": ("<i8", None),
+    "Q": ("<u8", None),
+}
+
+# version of the sidecar index layout, an index of another version is rebuilt
+INDEX_VERSION = 1
+# where the index goes when the directory of the log can not be written
+INDEX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gryphon")
+
+# number of messages decoded at once when iterating over the log
+BLOCK_SIZE = 65536
+# bytes searched at once for message headers
+SCAN_SIZE = 64 * 1024 * 1024
+# smallest byte range worth its own worker when a log is walked in parallel
+MIN_RANGE_SIZE = 16 * 1024 * 1024
+# types read before a time window too, for the flight mode, vehicle type and parameters at its start
+STATE_TYPES = ('MODE', 'MSG', 'PARM')
+# messages of the clock type kept on each side of a window found by bisection, for the other types written around it
+WINDOW_MARGIN = 2
+# consecutive messages that must chain for a worker to trust a boundary it found
+SYNC_DEPTH = 16
+# bytes searched at once for a trusted boundary
+SYNC_WINDOW = 1024 * 1024
+
+def null_term(value):
+    '''decode a DataFlash string the way pymavlink does'''
+    try:
+        value = value.decode("utf-8")
+    except UnicodeDecodeError:
+        value = value.decode("ISO-8859-1")
+    idx = value.find("\0")
+    if idx != -1:
+        value = value[:idx]
+    return value
+
+def parse_time(text):
+    '''a window bound, ('log', seconds) from the start of the log as S or [H:]M:S, or ('wall', time) for a local Y-m-d H:M:S'''
+    text = text.strip()
+    m = re.match(r'^(\d{4}-\d{2}-\d{2})[ T](\d{1,2}:\d{2}:\d{2})(\.\d*)?$', text)
+    if m:
+        t = time.mktime(time.strptime(m.group(1) + " " + m.group(2), "%Y-%m-%d %H:%M:%S"))
+        return ('wall', t + float(m.group(3) or 0))
+    seconds = 0.0
+    try:
+        for part in text.split(':'):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        raise ValueError("%s is neither seconds from the start of the log, [H:]M:S nor Y-m-d H:M:S" % text)
+    return ('log', seconds)
+
+def gps_time_to_time(week, msec):
+    '''convert GPS week and TOW to a time in seconds since 1970'''
+    epoch = 86400*(10*365 + int((1980-1969)/4) + 1 + 6 - 2)
+    return epoch + 86400*7*week + msec*0.001 - 18
+
+class DFBinaryFormat(object):
+    '''message format of a FMT record, as a NumPy structured dtype'''
+    def __init__(self, type, name, length, format, columns):
+        self.type = type
+        self.name = name
+        self.len = length
+        self.format = format
+        self.columns = columns.split(',') if columns else []
+        names = []
+        formats = []
+        offsets = []
+        self.mults = {}
+        ofs = 0
+        for (c, col) in zip(format, self.columns):
+            (dtype, mult) = FORMAT_TO_DTYPE[c]
+            # the occasional duplicated column keeps the first definition reachable by name
+            while col in names:
+                col = col + "_"
+            names.append(col)
+            formats.append(dtype)
+            offsets.append(ofs)
+            ofs += np.dtype(dtype).itemsize
+            if mult is not None:
+                self.mults[col] = mult
+        if ofs + 3 != length:
+            raise ValueError("FMT %s: format %s is %u bytes, header says %u" % (name, format, ofs + 3, length))
+        self.dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': ofs})
+        self.names = names
+
+    def __str__(self):
+        return ("DFBinaryFormat(%s,%s,%s,%s)" %
+                (self.type, self.name, self.format, self.columns))
+
+def parse_fmt(body):
+    '''return the format defined by the body of a FMT record or None if it is not a valid one'''
+    try:
+        (ftype, length, name, format, columns) = struct.unpack("<BB4s16s64s", body)
+        return DFBinaryFormat(ftype, null_term(name), length, null_term(format), null_term(columns))
+    except Exception:
+        return None
+
+def find_pattern(data, pattern, start=0, end=None):
+    '''offsets of every occurrence of a byte pattern, searched in slices to bound memory'''
+    if end is None:
+        end = len(data)
+    found = []
+    n = len(pattern)
+    for ofs in range(start, end, SCAN_SIZE):
+        seg = data[ofs:min(end, ofs + SCAN_SIZE) + n - 1]
+        if len(seg) < n:
+            break
+        mask = seg[:len(seg) - n + 1] == pattern[0]
+        for i in range(1, n):
+            mask &= seg[i:len(seg) - n + 1 + i] == pattern[i]
+        found.append(np.flatnonzero(mask) + ofs)
+    if not found:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(found).astype(np.int64)
+
+def walk_messages(data, lengths, start=0, end=None):
+    '''follow the chain of message lengths from start, as pymavlink does when it indexes a log
+
+    returns the offsets of the messages that start before end and the offset
+    following the last one; bytes that are not a message header are skipped
+    and an unknown message type stops the walk'''
+    data_len = len(data)
+    if end is None:
+        end = data_len
+    walked = []
+    pos = start
+    for ofs in range(start, end, SCAN_SIZE):
+        if pos >= end:
+            break
+        seg_end = min(end, ofs + SCAN_SIZE)
+        if pos >= seg_end:
+            continue
+        cand = find_pattern(data, bytes([HEAD1, HEAD2]), max(pos, ofs), seg_end)
+        cand = cand[cand + 2 < data_len]
+        if len(cand) == 0:
+            continue
+        mlen = lengths[data[cand + 2]]
+        # index of the next header candidate after each message, -1 for unknown types
+        succ = np.searchsorted(cand, cand + mlen)
+        succ[mlen <= 0] = -1
+        succ = succ.tolist()
+        chain = []
+        i = 0
+        n = len(succ)
+        stop = False
+        while i < n:
+            s = succ[i]
+            if s < 0:
+                stop = True
+                break
+            chain.append(i)
+            i = s
+        if chain:
+            chain = cand[chain]
+            walked.append(chain)
+            pos = int(chain[-1] + lengths[data[chain[-1] + 2]])
+        if stop:
+            pos = data_len
+            break
+    if walked:
+        offsets = np.concatenate(walked)
+    else:
+        offsets = np.zeros(0, dtype=np.int64)
+    return (offsets, pos)
+
+def sync_messages(data, lengths, start, end, depth=SYNC_DEPTH):
+    '''first offset from start where depth messages of known types follow each other, or end'''
+    data_len = len(data)
+    for ofs in range(start, end, SYNC_WINDOW):
+        # look a little past the window so the chains of its last candidates can be checked
+        cand = find_pattern(data, bytes([HEAD1, HEAD2]), ofs, min(data_len, ofs + SYNC_WINDOW + 256 * depth))
+        cand = cand[cand + 2 < data_len]
+        if len(cand) == 0:
+            continue
+        mlen = lengths[data[cand + 2]]
+        nxt = cand + mlen
+        succ = np.searchsorted(cand, nxt)
+        # a candidate is good if it is a known type followed by another header or by the end of the log
+        good = (mlen > 0) & (((succ < len(cand)) & (cand[np.minimum(succ, len(cand) - 1)] == nxt)) | (nxt == data_len))
+        at_end = nxt >= data_len
+        succ = np.minimum(succ, len(cand) - 1)
+        chained = good.copy()
+        hop = succ
+        for i in range(depth - 1):
+            chained &= good[hop] | at_end
+            at_end = at_end | at_end[hop]
+            hop = succ[hop]
+        hits = np.flatnonzero(chained & (cand < min(end, ofs + SYNC_WINDOW)))
+        if len(hits):
+            return int(cand[hits[0]])
+    return end
+
+def walk_worker(filename, lengths, tasks, results):
+    '''worker process of DFBinaryReader._walk_parallel, walks the byte ranges of the task queue'''
+    with open(filename, 'rb') as f:
+        data_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = np.frombuffer(data_map, dtype=np.uint8)
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            (i, start, end) = task
+            start = sync_messages(data, lengths, start, end) if start > 0 else 0
+            (offsets, pos) = walk_messages(data, lengths, start, end)
+            results.put((i, offsets, pos))
+        del data
+        data_map.close()
+
+class DFBinaryMessage(object):
+    '''a decoded message with the attribute interface of pymavlink's DFMessage'''
+    def __init__(self, fmt, values, timestamp):
+        self.fmt = fmt
+        self._fieldnames = fmt.columns
+        self._timestamp = timestamp
+        self.__dict__.update(zip(fmt.names, values))
+
+    def get_type(self):
+        return self.fmt.name
+
+    def to_dict(self):
+        d = {'mavpackettype': self.fmt.name}
+        for field in self.fmt.names:
+            d[field] = getattr(self, field)
+        return d
+
+    def __str__(self):
+        return "%s {%s}" % (self.fmt.name, ", ".join(["%s : %s" % (c, getattr(self, c)) for c in self.fmt.names]))
+
+class DFBinaryReader(object):
+    '''memory mapped DataFlash log decoded type by type into NumPy arrays'''
+    def __init__(self, filename, zero_time_base=False, index=False, jobs=1):
+        self.filename = filename
+        self.filehandle = open(filename, 'rb')
+        self.filehandle.seek(0, 2)
+        self.data_len = self.filehandle.tell()
+        self.filehandle.seek(0)
+        if self.data_len > 0:
+            self.data_map = mmap.mmap(self.filehandle.fileno(), self.data_len, access=mmap.ACCESS_READ)
+            self.data = np.frombuffer(self.data_map, dtype=np.uint8)
+        else:
+            self.data_map = None
+            self.data = np.zeros(0, dtype=np.uint8)
+        self._zero_time_base = zero_time_base
+        self.formats = {}
+        self.name_to_id = {}
+        self._running = None
+        self._stored_timestamps = {}
+        self.mav_type = mavutil.mavlink.MAV_TYPE_FIXED_WING
+        self.params = {}
+        self.digest = None
+        self.window = None
+        # with an index the offsets and timestamps of a previous run are reused if the content is the same
+        if not (index and self._load_index()):
+            self._scan(jobs)
+            self._init_clock()
+            if index:
+                self._save_index()
+        self.rewind()
+
+    def close(self):
+        '''release the memory map of the log'''
+        self.data = None
+        if self.data_map is not None:
+            self.data_map.close()
+            self.data_map = None
+        self.filehandle.close()
+
+    # ----- message boundaries
+
+    def _find(self, pattern, start=0, end=None):
+        '''offsets of every occurrence of a byte pattern'''
+        return find_pattern(self.data, pattern, start, end)
+
+    def _read_formats(self, offsets):
+        '''build the formats of the FMT records at the given offsets, the first definition of a type wins'''
+        formats = {FMT_TYPE: DFBinaryFormat(FMT_TYPE, 'FMT', FMT_LENGTH, 'BBnNZ', 'Type,Length,Name,Format,Columns')}
+        for ofs in offsets.tolist():
+            if ofs + FMT_LENGTH > self.data_len:
+                continue
+            fmt = parse_fmt(self.data_map[ofs+3:ofs+FMT_LENGTH])
+            if fmt is not None and fmt.type not in formats:
+                formats[fmt.type] = fmt
+        return formats
+
+    def _walk(self, lengths, start=0, end=None):
+        '''offsets of the messages from start to end, see walk_messages'''
+        return walk_messages(self.data, lengths, start, end)
+
+    def _walk_parallel(self, lengths, jobs):
+        '''walk the log split in byte ranges, each range on its own worker process
+
+        Every worker finds the first real message boundary of its range and
+        walks it. The ranges are stitched back in order: a range whose walk
+        does not meet the message where the previous one ended is walked again
+        from there, so the offsets are exactly the ones of a sequential walk.'''
+        bounds = np.linspace(0, self.data_len, jobs + 1).astype(np.int64).tolist()
+        tasks = multiproc.Queue()
+        results = multiproc.Queue()
+        for i in range(jobs):
+            tasks.put((i, bounds[i], bounds[i+1]))
+        workers = []
+        for i in range(jobs):
+            tasks.put(None)
+            p = multiproc.Process(target=walk_worker, args=(self.filename, lengths, tasks, results))
+            p.start()
+            workers.append(p)
+        walks = [None] * jobs
+        for n in range(jobs):
+            (i, offsets, pos) = results.get()
+            walks[i] = (offsets, pos)
+        for p in workers:
+            p.join()
+        stitched = []
+        pos = 0
+        for i in range(jobs):
+            (offsets, end) = walks[i]
+            if pos >= bounds[i+1]:
+                # the previous range walked over this one, or the log stopped
+                continue
+            # walks are deterministic, once they meet a message they go on the same way
+            k = int(np.searchsorted(offsets, pos))
+            if k < len(offsets) and offsets[k] == pos:
+                offsets = offsets[k:]
+            else:
+                (offsets, end) = self._walk(lengths, pos, bounds[i+1])
+            stitched.append(offsets)
+            pos = end
+        if not stitched:
+            return (np.zeros(0, dtype=np.int64), pos)
+        return (np.concatenate(stitched), pos)
+
+    def _scan(self, jobs=1):
+        '''find the formats and the offset of every complete message in the log'''
+        fmt_offsets = self._find(bytes([HEAD1, HEAD2, FMT_TYPE]))
+        # only split logs large enough for the workers to pay off
+        jobs = max(1, min(jobs, self.data_len // MIN_RANGE_SIZE))
+        while True:
+            formats = self._read_formats(fmt_offsets)
+            lengths = np.zeros(256, dtype=np.int64)
+            for fmt in formats.values():
+                lengths[fmt.type] = fmt.len
+            if jobs > 1:
+                (offsets, pos) = self._walk_parallel(lengths, jobs)
+            else:
+                (offsets, pos) = self._walk(lengths)
+            # drop a message cut by the end of the log
+            if len(offsets) and offsets[-1] + lengths[self.data[offsets[-1] + 2]] > self.data_len:
+                offsets = offsets[:-1]
+            msgids = self.data[offsets + 2] if len(offsets) else np.zeros(0, dtype=np.uint8)
+            # a FMT header found inside the payload of another message is not a format
+            real = offsets[msgids == FMT_TYPE]
+            if len(real) == len(fmt_offsets):
+                break
+            fmt_offsets = real
+        self._set_formats(formats)
+        # group the offsets by type, keeping the log order inside every type
+        order = np.argsort(msgids, kind='stable')
+        counts = np.bincount(msgids, minlength=256)
+        self._offsets = {}
+        for (mtype, part) in zip(range(256), np.split(offsets[order], np.cumsum(counts)[:-1])):
+            if len(part):
+                self._offsets[mtype] = part
+
+    def _set_formats(self, formats):
+        self.formats = formats
+        self.name_to_id = dict((fmt.name, fmt.type) for fmt in formats.values())
+
+    def _merged(self, mtypes, ranges=None):
+        '''offsets and types of the messages of the given types, in log order, ranges limits types to (start, end) file offsets'''
+        parts = []
+        for m in mtypes:
+            if m not in self._offsets:
+                continue
+            offsets = self._offsets[m]
+            if ranges is not None and m in ranges:
+                (start, end) = ranges[m]
+                offsets = offsets[np.searchsorted(offsets, start):np.searchsorted(offsets, end)]
+            parts.append((m, offsets))
+        if not parts:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8))
+        offsets = np.concatenate([o for (m, o) in parts])
+        msgids = np.concatenate([np.full(len(o), m, dtype=np.uint8) for (m, o) in parts])
+        order = np.argsort(offsets, kind='stable')
+        return (offsets[order], msgids[order])
+
+    def message_count(self):
+        '''number of complete messages in the log'''
+        return sum([len(o) for o in self._offsets.values()])
+
+    # ----- bulk decoding
+
+    def _gather(self, fmt, offsets):
+        '''copy the bodies of the records at offsets into a structured array of the format'''
+        body_len = fmt.len - 3
+        if len(offsets) == 0 or body_len == 0:
+            return np.zeros(len(offsets), dtype=fmt.dtype)
+        # every row of the view is the body_len bytes from an offset of the log, so a body is one contiguous copy
+        rows = sliding_window_view(self.data, body_len)
+        return np.ascontiguousarray(rows[offsets + 3]).view(fmt.dtype).reshape(-1)
+
+    def type_offsets(self, name):
+        '''offsets of every message of a type'''
+        if name not in self.name_to_id:
+            return np.zeros(0, dtype=np.int64)
+        return self._offsets.get(self.name_to_id[name], np.zeros(0, dtype=np.int64))
+
+    def records(self, name, offsets=None):
+        '''raw structured array of all the records of a type, as stored in the log'''
+        if name not in self.name_to_id:
+            return None
+        if offsets is None:
+            offsets = self.type_offsets(name)
+        return self._gather(self.formats[self.name_to_id[name]], offsets)
+
+    def columns(self, name, offsets=None, recs=None):
+        '''dict of column name to NumPy array for a type, with the format multipliers applied'''
+        if recs is None:
+            recs = self.records(name, offsets)
+        if recs is None:
+            return None
+        fmt = self.formats[self.name_to_id[name]]
+        cols = {}
+        for col in fmt.names:
+            cols[col] = self._scaled(fmt, col, recs[col])
+        return cols
+
+    def _scaled(self, fmt, col, values):
+        '''apply the multiplier of a column, dividing as pymavlink does for accuracy'''
+        mult = fmt.mults.get(col)
+        if mult is None:
+            return values
+        if mult > 0.0 and mult < 1.0:
+            return values.astype(np.float64) / (1/mult)
+        return values.astype(np.float64) * mult
+
+    def _python_columns(self, fmt, recs):
+        '''convert a structured array to lists of Python values as returned by pymavlink'''
+        cols = []
+        for (c, col) in zip(fmt.format, fmt.names):
+            values = self._scaled(fmt, col, recs[col])
+            if c in "nNZ":
+                cols.append([null_term(v) for v in values.tolist()])
+            else:
+                cols.append(values.tolist())
+        return cols
+
+    # ----- timestamps
+
+    def _init_clock(self):
+        '''work out the time base of the log the way pymavlink does for microsecond and millisecond clocks'''
+        self.timebase = 0
+        self.clock = None
+        gps = self.formats.get(self.name_to_id.get('GPS'))
+        first_stamp = None
+        # the first message of the log with a time of its own
+        first = None
+        for (mtype, offsets) in self._offsets.items():
+            fmt = self.formats[mtype]
+            if len(fmt.columns) and fmt.columns[0] in ('TimeUS', 'TimeMS'):
+                if first is None or offsets[0] < first[1]:
+                    first = (fmt, offsets[0])
+        if first is not None:
+            (fmt, ofs) = first
+            self.clock = fmt.columns[0]
+            first_stamp = self.records(fmt.name, np.array([ofs]))[fmt.names[0]][0]
+        if gps is not None and 'TimeUS' in gps.columns and 'GWk' in gps.columns and 'GMS' in gps.columns:
+            self.clock = 'TimeUS'
+            recs = self.records('GPS')
+            good = np.flatnonzero(recs['GWk'] > 0)
+            if len(good) and not self._zero_time_base:
+                m = recs[good[0]]
+                t = gps_time_to_time(int(m['GWk']), int(m['GMS']))
+                self.timebase = t - int(m['TimeUS'])*0.000001
+        elif gps is not None and 'T' in gps.columns and 'Week' in gps.columns and 'TimeMS' in gps.columns:
+            self.clock = 'TimeMS'
+            recs = self.records('GPS')
+            good = np.flatnonzero((recs['T'] != 0) & (recs['Week'] != 0))
+            if len(good) and not self._zero_time_base:
+                m = recs[good[0]]
+                t = gps_time_to_time(int(m['Week']), int(m['TimeMS']))
+                self.timebase = t - int(m['T'])*0.001
+        # timestamp of the messages before the first time stamped one
+        self.start_timestamp = self.timebase
+        if first_stamp is not None:
+            scale = 0.000001 if self.clock == 'TimeUS' else 0.001
+            self.start_timestamp += int(first_stamp)*scale
+
+    def _own_timestamps(self, fmt, recs):
+        '''timestamps of records carrying their own time, None for the others'''
+        if not fmt.columns:
+            return None
+        if self.clock == 'TimeUS' and fmt.columns[0] == 'TimeUS':
+            return self.timebase + recs['TimeUS'].astype(np.float64)*0.000001
+        if self.clock == 'TimeMS' and fmt.columns[0] == 'TimeMS':
+            return self.timebase + recs['TimeMS'].astype(np.float64)*0.001
+        if self.clock == 'TimeMS' and fmt.name in ('GPS', 'GPS2') and 'T' in fmt.columns:
+            return self.timebase + recs['T'].astype(np.float64)*0.001
+        return None
+
+    def _running_timestamps(self):
+        '''timestamp of the last time stamped message at or before every message of the log'''
+        if self._running is None:
+            (offsets, msgids) = self._merged(list(self._offsets.keys()))
+            stamps = np.full(len(offsets), np.nan)
+            for (mtype, fmt) in self.formats.items():
+                sel = np.flatnonzero(msgids == mtype)
+                if len(sel) == 0:
+                    continue
+                own = self._own_timestamps(fmt, self._gather(fmt, offsets[sel]))
+                if own is not None:
+                    stamps[sel] = own
+            # forward fill the messages without a time of their own
+            have = np.where(np.isnan(stamps), -1, np.arange(len(stamps)))
+            have = np.maximum.accumulate(have)
+            running = np.where(have >= 0, stamps[np.maximum(have, 0)], self.start_timestamp)
+            self._running = (offsets, running)
+        return self._running
+
+    def timestamps(self, name, offsets=None, recs=None):
+        '''timestamps of the records of a type, in seconds since 1970'''
+        if offsets is None:
+            if name in self._stored_timestamps:
+                return self._stored_timestamps[name]
+            offsets = self.type_offsets(name)
+        elif name in self._stored_timestamps:
+            return self._stored_timestamps[name][np.searchsorted(self.type_offsets(name), offsets)]
+        fmt = self.formats[self.name_to_id[name]]
+        if recs is None:
+            recs = self._gather(fmt, offsets)
+        own = self._own_timestamps(fmt, recs)
+        if own is not None:
+            return own
+        # messages without a time of their own get the one of the message before them
+        (all_offsets, running) = self._running_timestamps()
+        idx = np.searchsorted(all_offsets, offsets)
+        return np.where(idx > 0, running[np.maximum(idx - 1, 0)], self.start_timestamp)
+
+    # ----- time window
+
+    def _clock_type(self):
+        '''the type with a time of its own and the most messages, its timestamps run with the log'''
+        best = None
+        for (mtype, offsets) in self._offsets.items():
+            fmt = self.formats[mtype]
+            if self._own_timestamps(fmt, self._gather(fmt, offsets[:1])) is None:
+                continue
+            if best is None or len(offsets) > len(self._offsets[best]):
+                best = mtype
+        return best
+
+    def _bisect_time(self, mtype, t):
+        '''index of the first message of a type stamped at or after t, reading one message per step'''
+        fmt = self.formats[mtype]
+        offsets = self._offsets[mtype]
+        if fmt.name in self._stored_timestamps:
+            return int(np.searchsorted(self._stored_timestamps[fmt.name], t))
+        (lo, hi) = (0, len(offsets))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._own_timestamps(fmt, self._gather(fmt, offsets[mid:mid+1]))[0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _bound(self, bound):
+        '''time since 1970 of a window bound given as a time or as parse_time does'''
+        if isinstance(bound, tuple):
+            (kind, value) = bound
+            return self.start_timestamp + value if kind == 'log' else value
+        return bound
+
+    def set_window(self, start=None, end=None):
+        '''only return the messages stamped from start to end, None leaves a side open
+
+        The bounds are times since 1970 or the ('log', seconds) and ('wall',
+        time) of parse_time. The window is found by bisection of the
+        timestamps of the busiest time stamped type, so only the messages
+        around it are ever decoded, the clock of the log must run forward.
+        The state types are still read from the start of the log.'''
+        start = self._bound(start)
+        end = self._bound(end)
+        self.window = (start, end)
+        (lo, hi) = (0, self.data_len)
+        mtype = self._clock_type()
+        if mtype is not None:
+            offsets = self._offsets[mtype]
+            if start is not None:
+                k = self._bisect_time(mtype, start) - WINDOW_MARGIN
+                lo = int(offsets[k]) if k > 0 else 0
+            if end is not None:
+                k = self._bisect_time(mtype, np.nextafter(end, np.inf)) + WINDOW_MARGIN
+                hi = int(offsets[k]) if k < len(offsets) else self.data_len
+        self._window_offsets = (lo, hi)
+        self.rewind()
+        return self.window
+
+    def in_window(self, t):
+        '''is a timestamp inside the window, or the mask of an array of them'''
+        inside = True
+        if self.window is None:
+            return np.ones(np.shape(t), dtype=bool) if np.ndim(t) else inside
+        (start, end) = self.window
+        if start is not None:
+            inside = inside & (t >= start)
+        if end is not None:
+            inside = inside & (t <= end)
+        return inside
+
+    def window_offsets(self, name):
+        '''offsets of the messages of a type around the window, all of them without a window'''
+        offsets = self.type_offsets(name)
+        if self.window is None:
+            return offsets
+        (lo, hi) = self._window_offsets
+        return offsets[np.searchsorted(offsets, lo):np.searchsorted(offsets, hi)]
+
+    # ----- sidecar index
+
+    def _index_paths(self):
+        '''places of the index of this log, next to it or in the cache keyed by its content'''
+        return [self.filename + ".gidx", os.path.join(INDEX_CACHE_DIR, self.digest + ".gidx")]
+
+    def _load_index(self):
+        '''load the offsets and timestamps of a previous run, False if there is no valid index'''
+        self.digest = hashlib.sha256(self.data_map if self.data_map is not None else b"").hexdigest()
+        for path in self._index_paths():
+            if not os.path.exists(path):
+                continue
+            try:
+                with np.load(path) as z:
+                    meta = json.loads(str(z['meta']))
+                    # the index is only valid for the very same content
+                    if (meta['version'] != INDEX_VERSION or meta['sha256'] != self.digest or
+                        meta['zero_time_base'] != self._zero_time_base):
+                        continue
+                    offsets = {}
+                    stamps = {}
+                    for mtype in meta['types']:
+                        offsets[mtype] = z['offsets_%u' % mtype]
+                        stamps[mtype] = z['timestamps_%u' % mtype]
+            except Exception as ex:
+                print("Ignoring unreadable index %s: %s" % (path, ex), file=sys.stderr)
+                continue
+            self._offsets = offsets
+            self._set_formats(self._read_formats(offsets.get(FMT_TYPE, np.zeros(0, dtype=np.int64))))
+            self._stored_timestamps = dict((self.formats[m].name, stamps[m]) for m in offsets)
+            self.clock = meta['clock']
+            self.timebase = meta['timebase']
+            self.start_timestamp = meta['start_timestamp']
+            return True
+        return False
+
+    def _save_index(self):
+        '''store the offset and timestamp of every message grouped by type'''
+        meta = {'version': INDEX_VERSION, 'sha256': self.digest, 'zero_time_base': self._zero_time_base,
+                'clock': self.clock, 'timebase': self.timebase, 'start_timestamp': self.start_timestamp,
+                'types': sorted(self._offsets.keys())}
+        arrays = {'meta': np.array(json.dumps(meta))}
+        for (mtype, offsets) in self._offsets.items():
+            arrays['offsets_%u' % mtype] = offsets
+            arrays['timestamps_%u' % mtype] = self.timestamps(self.formats[mtype].name)
+        for path in self._index_paths():
+            try:
+                if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+                    os.makedirs(os.path.dirname(path))
+                tmp = path + ".tmp"
+                with open(tmp, 'wb') as f:
+                    np.savez(f, **arrays)
+                os.replace(tmp, path)
+                return path
+            except OSError:
+                continue
+        print("Could not write the index of %s" % self.filename, file=sys.stderr)
+        return None
+
+    # ----- pymavlink compatible iteration
+
+    def rewind(self):
+        '''rewind to start of log'''
+        self.offset = 0
+        self.messages = {'MAV': self, '__MAV__': self}
+        self.flightmode = "UNKNOWN"
+        self._pending = None
+        self._pending_types = None
+
+    def _add_msg(self, m):
+        '''track the vehicle state the way pymavlink's DFReader does'''
+        type = m.get_type()
+        self.messages[type] = m
+        if type == 'MSG':
+            if m.Message.find("Rover") != -1:
+                self.mav_type = mavutil.mavlink.MAV_TYPE_GROUND_ROVER
+            elif m.Message.find("Plane") != -1:
+                self.mav_type = mavutil.mavlink.MAV_TYPE_FIXED_WING
+            elif m.Message.find("Copter") != -1:
+                self.mav_type = mavutil.mavlink.MAV_TYPE_QUADROTOR
+            elif m.Message.startswith("Antenna"):
+                self.mav_type = mavutil.mavlink.MAV_TYPE_ANTENNA_TRACKER
+            elif m.Message.find("ArduSub") != -1:
+                self.mav_type = mavutil.mavlink.MAV_TYPE_SUBMARINE
+        elif type == 'MODE':
+            if isinstance(getattr(m, 'Mode', None), str):
+                self.flightmode = m.Mode.upper()
+            elif 'ModeNum' in m._fieldnames:
+                mapping = mavutil.mode_mapping_bynumber(self.mav_type)
+                if mapping is not None and m.ModeNum in mapping:
+                    self.flightmode = mapping[m.ModeNum]
+                else:
+                    self.flightmode = 'UNKNOWN'
+            elif hasattr(m, 'Mode'):
+                self.flightmode = mavutil.mode_string_acm(m.Mode)
+        elif type == 'PARM':
+            self.params[m.Name] = m.Value
+
+    def check_condition(self, condition):
+        '''check if a condition is true'''
+        return mavutil.evaluate_condition(condition, self.messages)
+
+    def _iter_messages(self, types, start):
+        '''yield the messages of the given types from a file offset, decoded block by block'''
+        wanted = [self.name_to_id[t] for t in types if t in self.name_to_id]
+        ranges = None
+        if self.window is not None:
+            # a window limits the types to the messages around it, the state types are also read before it
+            (lo, hi) = self._window_offsets
+            ranges = dict((m, (0 if self.formats[m].name in STATE_TYPES else lo, hi)) for m in wanted)
+        # only the offsets of the wanted types are visited, the rest of the log is never read
+        (all_offsets, all_ids) = self._merged(wanted, ranges)
+        first = int(np.searchsorted(all_offsets, start))
+        for b in range(first, len(all_offsets), BLOCK_SIZE):
+            ids = all_ids[b:b+BLOCK_SIZE]
+            offsets = all_offsets[b:b+BLOCK_SIZE]
+            streams = []
+            for mtype in wanted:
+                sel = np.flatnonzero(ids == mtype)
+                if len(sel) == 0:
+                    continue
+                fmt = self.formats[mtype]
+                recs = self._gather(fmt, offsets[sel])
+                stamps = self.timestamps(fmt.name, offsets[sel], recs).tolist()
+                cols = self._python_columns(fmt, recs)
+                rows = zip(*cols) if cols else [()] * len(sel)
+                streams.append(zip(offsets[sel].tolist(), itertools.repeat(fmt), rows, stamps))
+            # the streams of each type are in file order, merge them back into the order of the log
+            for (ofs, fmt, values, stamp) in heapq.merge(*streams, key=lambda s: s[0]):
+                yield (ofs, DFBinaryMessage(fmt, values, stamp))
+
+    def recv_match(self, condition=None, type=None, blocking=False, strict=False):
+        '''recv the next message of the given type(s), as pymavlink's recv_match does'''
+        if type is None:
+            types = set(self.name_to_id.keys())
+        elif isinstance(type, str):
+            types = set([type])
+        else:
+            types = set(type)
+        if self._pending is None or types != self._pending_types:
+            # like pymavlink, always read the key types so flightmode, params etc are tracked
+            read = types if strict else types | set(STATE_TYPES)
+            self._pending = self._iter_messages(read, self.offset)
+            self._pending_types = types
+        for (ofs, m) in self._pending:
+            self.offset = ofs + m.fmt.len
+            self._add_msg(m)
+            if m.fmt.name not in types or (self.window is not None and not self.in_window(m._timestamp)):
+                continue
+            if condition is not None and not mavutil.evaluate_condition(condition, self.messages):
+                continue
+            return m
+        self.offset = self.data_len
+        return None
+
+    def recv_msg(self):
+        return self.recv_match()
+
+def compare_decoders(filename, types):
+    '''decode the given types with pymavlink and with DFBinaryReader and report any difference'''
+    mlog = mavutil.mavlink_connection(filename, notimestamps=False, zero_time_base=False)
+    native = DFBinaryReader(filename)
+    mismatches = 0
+    count = 0
+    while True:
+        m = mlog.recv_match(type=types)
+        if m is None:
+            break
+        if m.get_type() not in types:
+            continue
+        n = native.recv_match(type=types)
+        count += 1
+        if n is None or n.get_type() != m.get_type():
+            print("message %u: pymavlink %s, native %s" % (count, m.get_type(), n and n.get_type()))
+            return False
+        for col in m.get_fieldnames():
+            a = getattr(m, col)
+            b = getattr(n, col)
+            if a != b and not (a != a and b != b):
+                mismatches += 1
+                print("message %u %s.%s: pymavlink %s, native %s" % (count, m.get_type(), col, a, b))
+        if m._timestamp != n._timestamp:
+            mismatches += 1
+            print("message %u %s timestamp: pymavlink %s, native %s" % (count, m.get_type(), m._timestamp, n._timestamp))
+    if native.recv_match(type=types) is not None:
+        print("native decoder returned more messages than pymavlink")
+        return False
+    print("%u messages compared, %u differences" % (count, mismatches))
+    return mismatches == 0
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="check the native DataFlash decoder against pymavlink")
+    parser.add_argument("files", metavar="<FILE>", nargs="+")
+    parser.add_argument("--types", default="GPS,CURR,CMD,MODE,ERR,EV,PARM,MSG", help="message types to compare")
+    args = parser.parse_args()
+    ok = True
+    for f in args.files:
+        print(f)
+        ok = compare_decoders(f, args.types.split(',')) and ok
+    sys.exit(0 if ok else 1)
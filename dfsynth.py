@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+'''
+synthetic ArduCopter DataFlash logs of any size, with planted anomalies
+
+The vehicle flies circles around its home through a mission, changing
+modes. GPS fix losses, altitude and position jumps, current spikes, errors,
+a stuck gyro, a noisy IMU, accelerometer clipping and a command that is
+never reached are planted at known times, and can be written to a
+JSON file to check the analysis against. The messages are built a chunk of
+flight at a time as NumPy record arrays, so gigabyte logs are quick to write.
+'''
+
+import sys, json, math
+import numpy as np
+from argparse import ArgumentParser
+from dfbinary import FORMAT_TO_DTYPE, HEAD1, HEAD2, FMT_TYPE
+from sensors import ACCEL_FULL_SCALE
+
+# message types of the log: (type, name, format, columns)
+FORMATS = [
+    (129, 'GPS', 'QBIHBcLLefffB', 'TimeUS,Status,GMS,GWk,NSats,HDop,Lat,Lng,Alt,Spd,GCrs,VZ,U'),
+    (130, 'CURR', 'Qfff', 'TimeUS,Volt,Curr,CurrTot'),
+    (131, 'CMD', 'QHHHffffLLfB', 'TimeUS,CTot,CNum,CId,Prm1,Prm2,Prm3,Prm4,Lat,Lng,Alt,Frame'),
+    (132, 'MODE', 'QMBB', 'TimeUS,Mode,ModeNum,Rsn'),
+    (133, 'ERR', 'QBB', 'TimeUS,Subsys,ECode'),
+    (134, 'EV', 'QB', 'TimeUS,Id'),
+    (135, 'PARM', 'QNf', 'TimeUS,Name,Value'),
+    (136, 'MSG', 'QZ', 'TimeUS,Message'),
+    (137, 'IMU', 'QBffffffIIfBBHH', 'TimeUS,I,GyrX,GyrY,GyrZ,AccX,AccY,AccZ,EG,EA,T,GH,AH,GHz,AHz'),
+    (138, 'BARO', 'QBffcfIff', 'TimeUS,I,Alt,Press,Temp,CRt,SMS,Offset,GndTemp'),
+    (139, 'MAG', 'QBhhhhhhhhhBI', 'TimeUS,I,MagX,MagY,MagZ,OfsX,OfsY,OfsZ,MOX,MOY,MOZ,Health,S'),
+    (140, 'VIBE', 'QBfffI', 'TimeUS,IMU,VibeX,VibeY,VibeZ,Clip'),
+]
+# parameters of a real vehicle written before the filler ones, the vehicle SYSID_THISMAV is the seed
+PARAMS = [('SYSID_THISMAV', 1), ('SYSID_MYGCS', 255), ('BATT_CAPACITY', 5200), ('COMPASS_USE', 1),
+          ('RTL_ALT', 1500), ('RTL_ALT_FINAL', 0), ('TELEM_DELAY', 0), ('SERIAL0_BAUD', 115)]
+# default rates in Hz of the periodic messages
+DEFAULT_RATES = {'GPS': 10, 'CURR': 10, 'IMU': 50, 'BARO': 10, 'MAG': 10, 'VIBE': 10}
+# seconds between two planted anomalies of the same kind
+ANOMALY_INTERVAL = 600
+# seconds between two mode changes
+MODE_INTERVAL = 300
+# copter modes flown in turn, by number
+MODES = [5, 3, 2, 16, 6]
+# seconds a planted sensor fault lasts
+SENSOR_FAULT = {'gyro_stuck': 3.0, 'imu_noise': 3.0, 'accel_clip': 0.5}
+# bytes of flight built at once
+CHUNK_SIZE = 32 * 1024 * 1024
+
+HOME = (-35.363261, 149.165230, 584.0)
+# radius in metres and period in seconds of the circles
+RADIUS = 200.0
+PERIOD = 120.0
+ALTITUDE = 20.0
+# boot time, and the GPS week and time of week in ms at boot
+BOOT_US = 1000000
+GPS_WEEK = 2100
+GPS_TOW_MS = 100000000
+MS_PER_WEEK = 7 * 86400 * 1000
+# scaling of the DataFlash integer formats
+SCALE = {'L': 1.0e7, 'e': 100.0, 'E': 100.0, 'c': 100.0, 'C': 100.0}
+
+def parse_size(text):
+    '''bytes of a size such as 4096, 10M or 1G'''
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def parse_rates(text):
+    '''message rates from TYPE=HZ pairs, on top of the default ones'''
+    rates = dict(DEFAULT_RATES)
+    if text:
+        for pair in text.split(','):
+            (name, hz) = pair.split('=')
+            rates[name.strip().upper()] = float(hz)
+    return rates
+
+def fmt_record(ftype, name, format, columns):
+    '''the FMT record defining a message type'''
+    length = record_format(ftype, format, columns)[1].itemsize
+    return (bytes([HEAD1, HEAD2, FMT_TYPE, ftype, length]) + name.encode().ljust(4, b'\0') +
+            format.encode().ljust(16, b'\0') + columns.encode().ljust(64, b'\0'))
+
+def track(t):
+    '''position, altitude above home, speed and course of the vehicle at t seconds of flight'''
+    a = 2 * np.pi * t / PERIOD
+    north = RADIUS * np.sin(a)
+    east = RADIUS * (1 - np.cos(a))
+    lat = HOME[0] + np.degrees(north / 6378137.0)
+    lng = HOME[1] + np.degrees(east / (6378137.0 * math.cos(math.radians(HOME[0]))))
+    alt = ALTITUDE + 5 * np.sin(t / 37.0)
+    speed = np.full(np.shape(t), 2 * np.pi * RADIUS / PERIOD)
+    course = np.degrees(a) % 360
+    return (lat, lng, alt, speed, course)
+
+def record_format(ftype, format, columns):
+    '''(type, dtype of a whole record with its header, format character of every column) of a message type'''
+    names = columns.split(',')
+    fields = [('head1', 'u1'), ('head2', 'u1'), ('type', 'u1')]
+    for (c, col) in zip(format, names):
+        fields.append((col, FORMAT_TO_DTYPE[c][0]))
+    return (ftype, np.dtype(fields), dict(zip(names, format)))
+
+class LogWriter(object):
+    '''writes messages of the FORMATS types as packed records'''
+    def __init__(self, f):
+        self.f = f
+        self.formats = {}
+        self.messages = 0
+        self.f.write(fmt_record(FMT_TYPE, 'FMT', 'BBnNZ', 'Type,Length,Name,Format,Columns'))
+        for (ftype, name, format, columns) in FORMATS:
+            self.f.write(fmt_record(ftype, name, format, columns))
+            self.formats[name] = record_format(ftype, format, columns)
+        self.messages += len(FORMATS) + 1
+
+    def records(self, name, t_us, **values):
+        '''records of a message type at the times t_us, values are in the units pymavlink reads'''
+        (ftype, dtype, chars) = self.formats[name]
+        rec = np.zeros(len(t_us), dtype=dtype)
+        rec['head1'] = HEAD1
+        rec['head2'] = HEAD2
+        rec['type'] = ftype
+        rec['TimeUS'] = t_us
+        for (col, value) in values.items():
+            scale = SCALE.get(chars[col])
+            if scale is not None:
+                value = np.round(np.asarray(value, dtype=np.float64) * scale)
+            rec[col] = value
+        return rec
+
+    def write(self, batches):
+        '''write record arrays of several types merged in time order, records of the same time keep their batch order'''
+        batches = [b for b in batches if len(b)]
+        if not batches:
+            return
+        times = np.concatenate([b['TimeUS'] for b in batches])
+        sizes = np.concatenate([np.full(len(b), b.dtype.itemsize, dtype=np.int64) for b in batches])
+        order = np.argsort(times, kind='stable')
+        # offset of every record in the output, in the order of the concatenated batches
+        offsets = np.empty(len(order), dtype=np.int64)
+        offsets[order] = np.concatenate(([0], np.cumsum(sizes[order])[:-1]))
+        out = np.empty(int(sizes.sum()), dtype=np.uint8)
+        start = 0
+        for b in batches:
+            raw = b.view(np.uint8).reshape(len(b), b.dtype.itemsize)
+            out[offsets[start:start+len(b), None] + np.arange(b.dtype.itemsize)] = raw
+            start += len(b)
+        self.f.write(out.tobytes())
+        self.messages += len(order)
+
+def periodic_times(rate, t0, t1, phase=0.0):
+    '''times in seconds of a message sent at rate Hz between t0 and t1'''
+    if rate <= 0:
+        return np.zeros(0)
+    first = math.ceil((t0 - phase) * rate)
+    last = math.ceil((t1 - phase) * rate)
+    return phase + np.arange(first, last) / float(rate)
+
+def to_us(t):
+    return (BOOT_US + np.round(np.asarray(t) * 1.0e6)).astype(np.uint64)
+
+def planted(duration, interval, seed):
+    '''the anomalies of a flight: (kind, time in seconds), one of each kind every interval seconds'''
+    rng = np.random.RandomState(seed)
+    found = []
+    for kind in ['gps_loss', 'alt_jump', 'curr_spike', 'err', 'gps_jump', 'gyro_stuck', 'imu_noise', 'accel_clip']:
+        for start in np.arange(60.0, duration - 30, interval):
+            found.append((kind, float(start + rng.uniform(0, min(interval, duration - 30 - start)))))
+    return sorted(found, key=lambda a: a[1])
+
+def mission():
+    '''(CId, Lat, Lng, Alt, Frame) of the commands as ArduPilot logs them: home first at its altitude above sea
+    level, then waypoints on the circle above home, a speed change without a position and a last waypoint far
+    from the circle that is never reached'''
+    times = np.linspace(10.0, PERIOD, 6)
+    (lat, lng, alt) = track(times)[:3]
+    cmds = [(16, HOME[0], HOME[1], HOME[2], 0)]
+    cmds += [(16, float(la), float(ln), float(al), 3) for (la, ln, al) in zip(lat, lng, alt)]
+    cmds.append((178, 0.0, 0.0, 0.0, 0))
+    cmds.append((16, HOME[0] + 0.01, HOME[1] + 0.01, 50.0, 3))
+    return cmds
+
+def synthesize(filename, duration, rates=None, interval=ANOMALY_INTERVAL, seed=1, params=300):
+    '''write a log of duration seconds of flight, returns the messages written and the planted anomalies'''
+    rates = rates if rates is not None else dict(DEFAULT_RATES)
+    rng = np.random.RandomState(seed)
+    anomalies = planted(duration, interval, seed)
+    truth = []
+    with open(filename, 'wb') as f:
+        w = LogWriter(f)
+        # boot: firmware, parameters, mission, arming
+        boot = [w.records('MSG', to_us([0.0]), Message=[b'ArduCopter V4.0.3 (ffffffff)']),
+                w.records('MSG', to_us([0.0]), Message=[b'ChibiOS: d4fce84e']),
+                w.records('PARM', to_us(np.zeros(len(PARAMS))), Name=[p[0].encode() for p in PARAMS],
+                          Value=[p[1] if p[0] != 'SYSID_THISMAV' else seed for p in PARAMS]),
+                w.records('PARM', to_us(np.zeros(params)), Name=[('PARAM_%u' % i).encode() for i in range(params)],
+                          Value=rng.uniform(0, 100, params))]
+        cmds = mission()
+        cmd_t = to_us(np.zeros(len(cmds)))
+        boot.append(w.records('CMD', cmd_t, CTot=len(cmds), CNum=np.arange(len(cmds)), CId=[c[0] for c in cmds],
+                              Lat=[c[1] for c in cmds], Lng=[c[2] for c in cmds], Alt=[c[3] for c in cmds],
+                              Frame=[c[4] for c in cmds]))
+        truth.append({"kind": "cmd_not_executed", "t_us": int(cmd_t[-1]), "CNum": len(cmds) - 1})
+        boot.append(w.records('MODE', to_us([0.0]), Mode=MODES[0], ModeNum=MODES[0], Rsn=0))
+        boot.append(w.records('EV', to_us([0.0]), Id=10))
+        w.write(boot)
+        # bytes of one second of flight, to size the chunks
+        per_second = sum([rates.get(name, 0) * w.formats[name][1].itemsize for name in rates if name in w.formats])
+        chunk = max(10.0, CHUNK_SIZE / max(per_second, 1.0))
+        amp = 0.0
+        # accelerometer clipping events so far, counted by VIBE
+        clips = 0
+        t0 = 0.0
+        while t0 < duration:
+            t1 = min(duration, t0 + chunk)
+            batches = []
+            marks = [(kind, t) for (kind, t) in anomalies if t0 <= t < t1]
+            if 'GPS' in rates:
+                t = periodic_times(rates['GPS'], t0, t1)
+                (lat, lng, alt, speed, course) = track(t)
+                status = np.full(len(t), 3)
+                alt = alt + HOME[2]
+                for (kind, at) in marks:
+                    if kind == 'gps_loss':
+                        status[(t >= at) & (t < at + 2.0)] = 1
+                    elif kind == 'alt_jump':
+                        alt[np.searchsorted(t, at):][:1] += 8.0
+                    elif kind == 'gps_jump':
+                        # one fix a kilometre north, as a spoofed or glitching receiver reports it
+                        lat[np.searchsorted(t, at):][:1] += 0.01
+                    else:
+                        continue
+                    truth.append({"kind": kind, "t_us": int(to_us([t[min(np.searchsorted(t, at), len(t) - 1)]])[0])})
+                gps_ms = GPS_TOW_MS + np.round(t * 1000).astype(np.int64)
+                batches.append(w.records('GPS', to_us(t), Status=status, GMS=gps_ms % MS_PER_WEEK,
+                                         GWk=GPS_WEEK + gps_ms // MS_PER_WEEK, NSats=np.where(status >= 3, 12, 3),
+                                         HDop=0.8, Lat=lat, Lng=lng, Alt=alt, Spd=speed, GCrs=course, VZ=0.0, U=1))
+            if 'CURR' in rates:
+                t = periodic_times(rates['CURR'], t0, t1, 0.01)
+                curr = 12.0 + rng.uniform(-0.5, 0.5, len(t))
+                for (kind, at) in marks:
+                    if kind == 'curr_spike' and len(t):
+                        i = min(np.searchsorted(t, at), len(t) - 1)
+                        curr[i] += 20.0
+                        truth.append({"kind": kind, "t_us": int(to_us([t[i]])[0])})
+                batches.append(w.records('CURR', to_us(t), Volt=16.8 - 4.0 * t / max(duration, 1.0), Curr=curr,
+                                         CurrTot=(12000.0 / 3600.0) * t))
+            if 'IMU' in rates:
+                t = periodic_times(rates['IMU'], t0, t1, 0.002)
+                n = len(t)
+                (gx, gy, gz) = (rng.normal(0, 0.01, n), rng.normal(0, 0.01, n), rng.normal(0, 0.01, n))
+                accz = -9.8 + rng.normal(0, 0.2, n)
+                for (kind, at) in marks:
+                    if kind not in SENSOR_FAULT:
+                        continue
+                    (i, j) = np.searchsorted(t, [at, at + SENSOR_FAULT[kind]])
+                    if i >= n:
+                        continue
+                    if kind == 'gyro_stuck':
+                        gx[i:j] = gx[i]
+                    elif kind == 'imu_noise':
+                        gy[i:j] *= 30.0
+                    else:
+                        accz[i:j] = -ACCEL_FULL_SCALE
+                    truth.append({"kind": kind, "t_us": int(to_us([t[i]])[0])})
+                batches.append(w.records('IMU', to_us(t), I=0, GyrX=gx, GyrY=gy, GyrZ=gz, AccX=rng.normal(0, 0.2, n),
+                                         AccY=rng.normal(0, 0.2, n), AccZ=accz, T=40.0, GH=1, AH=1, GHz=400, AHz=400))
+            if 'BARO' in rates:
+                t = periodic_times(rates['BARO'], t0, t1, 0.004)
+                alt = track(t)[2]
+                batches.append(w.records('BARO', to_us(t), I=0, Alt=alt, Press=101325.0 - 12.0 * alt, Temp=25.0,
+                                         CRt=0.0, SMS=np.round(t * 1000), GndTemp=20.0))
+            if 'MAG' in rates:
+                t = periodic_times(rates['MAG'], t0, t1, 0.006)
+                a = np.radians(track(t)[4])
+                n = len(t)
+                batches.append(w.records('MAG', to_us(t), I=0, MagX=np.round(200 * np.cos(a) + rng.normal(0, 2, n)),
+                                         MagY=np.round(200 * np.sin(a) + rng.normal(0, 2, n)),
+                                         MagZ=np.round(-400 + rng.normal(0, 2, n)), Health=1, S=np.round(t * 1000)))
+            if 'VIBE' in rates:
+                t = periodic_times(rates['VIBE'], t0, t1, 0.008)
+                n = len(t)
+                vibez = np.abs(rng.normal(8, 1, n))
+                clip_times = [at for (kind, at) in marks if kind == 'accel_clip']
+                # the counter goes up once per clipping event, the vibration is high while it lasts
+                clip = clips + np.searchsorted(clip_times, t, side='right')
+                for at in clip_times:
+                    vibez[(t >= at) & (t < at + SENSOR_FAULT['accel_clip'])] = 60.0
+                clips += len(clip_times)
+                batches.append(w.records('VIBE', to_us(t), IMU=0, VibeX=np.abs(rng.normal(5, 1, n)),
+                                         VibeY=np.abs(rng.normal(5, 1, n)), VibeZ=vibez, Clip=clip))
+            # mode changes and errors
+            t = periodic_times(1.0 / MODE_INTERVAL, max(t0, 1.0), t1)
+            modes = [MODES[int(round(x / MODE_INTERVAL)) % len(MODES)] for x in t]
+            batches.append(w.records('MODE', to_us(t), Mode=modes, ModeNum=modes, Rsn=1))
+            t = np.array([at for (kind, at) in marks if kind == 'err'])
+            batches.append(w.records('ERR', to_us(t), Subsys=11, ECode=2))
+            truth.extend([{"kind": "err", "t_us": int(x)} for x in to_us(t)])
+            w.write(batches)
+            t0 = t1
+        w.write([w.records('EV', to_us([duration]), Id=11)])
+    truth.sort(key=lambda a: a["t_us"])
+    return (w.messages, truth)
+
+def duration_for_size(size, rates=None):
+    '''seconds of flight of a log of about size bytes'''
+    rates = rates if rates is not None else dict(DEFAULT_RATES)
+    per_second = 0
+    for (ftype, name, format, columns) in FORMATS:
+        if name in rates:
+            per_second += rates[name] * record_format(ftype, format, columns)[1].itemsize
+    return max(60.0, size / float(max(per_second, 1)))
+
+def __main__():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("output", metavar="<LOGFILE.bin>")
+    parser.add_argument("--size", default=None, help="approximate size of the log, like 10M or 1G")
+    parser.add_argument("--duration", type=float, default=600, help="seconds of flight when no --size is given (%(default)s)")
+    parser.add_argument("--rates", default=None, help="rates of the periodic messages as TYPE=HZ,... (GPS, CURR, IMU, BARO, MAG, VIBE)")
+    parser.add_argument("--anomaly-interval", type=float, default=ANOMALY_INTERVAL,
+                        help="seconds between two anomalies of the same kind (%(default)s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--truth", default=None, help="write the planted anomalies to this JSON file")
+    args = parser.parse_args()
+    rates = parse_rates(args.rates)
+    duration = duration_for_size(parse_size(args.size), rates) if args.size else args.duration
+    (messages, truth) = synthesize(args.output, duration, rates, args.anomaly_interval, args.seed)
+    print("%s: %u messages, %.0f seconds of flight, %u planted anomalies" % (args.output, messages, duration, len(truth)))
+    if args.truth:
+        with open(args.truth, 'w') as f:
+            json.dump(truth, f, indent=1)
+
+if __name__ == "__main__":
+    __main__()
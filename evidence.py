@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+'''
+SQLite evidence store of the records extracted from many logs
+
+Every record family (parm, msg, ev, mode, err, curr, cmd, gps, cmdexec and
+the anomalies) is a table with the log, the time in microseconds and one
+column per field, indexed by log and time, the other times some records
+hold are in microseconds too. The logs table holds the vehicle
+SYSID_THISMAV, firmware and summary of every log, so questions across
+flights are a single SQL query.
+
+The records of a log are first bulk inserted into a private staging
+database and copied into the store in one transaction once the log is
+analysed, so batch workers do not hold the store locked while they work.
+'''
+
+import os, re, time, json, sqlite3, tempfile, datetime
+from argparse import ArgumentParser
+from sinks import Sink
+
+SCHEMA_VERSION = 1
+# records of a family inserted at once
+INSERT_BATCH = 10000
+# seconds a writer waits for another one to finish its log
+BUSY_TIMEOUT = 600
+
+def column_name(field):
+    '''SQL column of a record field'''
+    return re.sub(r'[^0-9a-z_]', '_', field.lower())
+
+def connect(filename):
+    '''the store, created if needed, in autocommit mode so transactions are explicit'''
+    db = sqlite3.connect(filename, timeout=BUSY_TIMEOUT, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    db.execute("INSERT OR IGNORE INTO meta VALUES ('version', ?)", (str(SCHEMA_VERSION),))
+    db.execute("CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, sysid INTEGER, "
+               "firmware TEXT, release TEXT, loaded TEXT, summary TEXT)")
+    db.execute("CREATE INDEX IF NOT EXISTS logs_sysid ON logs (sysid)")
+    return db
+
+def table_columns(db, table, schema="main"):
+    '''columns of a table, empty if it does not exist'''
+    return [row[1] for row in db.execute('PRAGMA %s.table_info("%s")' % (schema, table))]
+
+def ensure_table(db, table, columns, schema="main", indexed=True):
+    '''create a record table or add the columns it is missing, the fields are NUMERIC so numbers read as text compare as numbers'''
+    existing = table_columns(db, table, schema)
+    if not existing:
+        cols = ", ".join(['"%s" NUMERIC' % c for c in columns])
+        db.execute('CREATE TABLE %s."%s" (log_id INTEGER, t_us INTEGER%s)' % (schema, table, ", " + cols if cols else ""))
+        if indexed:
+            db.execute('CREATE INDEX %s."%s_log_time" ON "%s" (log_id, t_us)' % (schema, table, table))
+            db.execute('CREATE INDEX %s."%s_time" ON "%s" (t_us)' % (schema, table, table))
+        return
+    for c in columns:
+        if c not in existing:
+            db.execute('ALTER TABLE %s."%s" ADD COLUMN "%s" NUMERIC' % (schema, table, c))
+
+def record_tables(db):
+    '''the record tables of the store'''
+    return [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'")
+            if "log_id" in table_columns(db, row[0])]
+
+class EvidenceSink(Sink):
+    '''loads the records of a log into the store once its summary is written'''
+    def __init__(self, filename):
+        Sink.__init__(self)
+        self.filename = filename
+        (fd, self.staged_name) = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.staged = sqlite3.connect(self.staged_name, isolation_level=None)
+        self.staged.execute("PRAGMA journal_mode=OFF")
+        self.staged.execute("PRAGMA synchronous=OFF")
+        self.staged.execute("BEGIN")
+        self.columns = {}
+        self.rows = {}
+        self.sysid = None
+
+    def record(self, family, t_us, fields, colors=None, console=True, label=None):
+        columns = self.columns.get(family)
+        if columns is None:
+            columns = self.columns[family] = []
+            self.rows[family] = []
+        names = [column_name(f) for f in fields.keys()]
+        if names != columns[:len(names)]:
+            # a family whose records do not all have the same fields
+            missing = [c for c in names if c not in columns]
+            if missing:
+                self.insert(family)
+                columns.extend(missing)
+            self.rows[family].append([t_us] + [dict(zip(names, fields.values())).get(c) for c in columns])
+        else:
+            self.rows[family].append([t_us] + list(fields.values()))
+        if family == "parm" and fields.get("Name") == "SYSID_THISMAV":
+            self.sysid = int(fields["Value"])
+        if len(self.rows[family]) >= INSERT_BATCH:
+            self.insert(family)
+
+    def insert(self, family):
+        '''bulk insert the records of a family waiting in memory into the staging database'''
+        rows = self.rows[family]
+        if not rows:
+            return
+        columns = self.columns[family]
+        ensure_table(self.staged, family, columns, indexed=False)
+        width = len(columns) + 1
+        cols = ", ".join(["t_us"] + ['"%s"' % c for c in columns])
+        self.staged.executemany('INSERT INTO "%s" (%s) VALUES (%s)' % (family, cols, ", ".join(["?"] * width)),
+                                [r + [None] * (width - len(r)) for r in rows])
+        self.rows[family] = []
+
+    def summary(self, summary):
+        for family in self.columns:
+            self.insert(family)
+        self.staged.execute("COMMIT")
+        self.load(summary)
+        self.staged.execute("BEGIN")
+
+    def load(self, summary):
+        '''copy the staged records into the store in one transaction, replacing a previous load of the same log'''
+        db = connect(self.filename)
+        try:
+            db.execute("ATTACH DATABASE ? AS staged", (self.staged_name,))
+            db.execute("BEGIN IMMEDIATE")
+            path = os.path.abspath(summary.get("log", ""))
+            previous = db.execute("SELECT id FROM logs WHERE path = ?", (path,)).fetchone()
+            if previous is not None:
+                for table in record_tables(db):
+                    db.execute('DELETE FROM "%s" WHERE log_id = ?' % table, previous)
+                db.execute("DELETE FROM logs WHERE id = ?", previous)
+            log_id = db.execute("INSERT INTO logs (path, sysid, firmware, release, loaded, summary) VALUES (?, ?, ?, ?, ?, ?)",
+                                (path, self.sysid, summary.get("firmware") or None, summary.get("release") or None,
+                                 datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                 json.dumps(summary, default=str))).lastrowid
+            for (family, columns) in self.columns.items():
+                if not table_columns(db, family, "staged"):
+                    continue
+                ensure_table(db, family, columns)
+                cols = ", ".join(["t_us"] + ['"%s"' % c for c in columns])
+                db.execute('INSERT INTO main."%s" (log_id, %s) SELECT ?, %s FROM staged."%s"' % (family, cols, cols, family), (log_id,))
+            db.execute("COMMIT")
+            db.execute("DETACH DATABASE staged")
+        finally:
+            db.close()
+        # the staged records are in the store now
+        for family in self.columns:
+            if table_columns(self.staged, family):
+                self.staged.execute('DELETE FROM "%s"' % family)
+
+    def close(self):
+        self.staged.close()
+        if os.path.exists(self.staged_name):
+            os.remove(self.staged_name)
+
+def query(filename, sql, params=()):
+    '''(column names, rows) of a query on the store'''
+    db = connect(filename)
+    try:
+        cursor = db.execute(sql, params)
+        columns = [d[0] for d in cursor.description] if cursor.description else []
+        return (columns, cursor.fetchall())
+    finally:
+        db.close()
+
+def print_query(filename, sql):
+    '''run a query and print its rows tab separated'''
+    start = time.time()
+    (columns, rows) = query(filename, sql)
+    if columns:
+        print("\t".join(columns))
+    for row in rows:
+        print("\t".join([str(v) for v in row]))
+    print("(%u rows in %.1f ms)" % (len(rows), (time.time() - start) * 1000))
+
+def __main__():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("db", metavar="<DB>", help="evidence store loaded by gryphon.py --db")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("query", help="run an SQL query across the flights")
+    p.add_argument("sql")
+    sub.add_parser("logs", help="list the logs of the store")
+    sub.add_parser("tables", help="list the record tables and their columns")
+    args = parser.parse_args()
+    if args.command == "query":
+        print_query(args.db, args.sql)
+    elif args.command == "logs":
+        print_query(args.db, "SELECT id, path, sysid, firmware, release, loaded FROM logs ORDER BY id")
+    elif args.command == "tables":
+        db = connect(args.db)
+        for table in record_tables(db):
+            print("%s\t%s" % (table, ", ".join(table_columns(db, table))))
+        db.close()
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    __main__()
@@ -1,13 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys, struct, time, os, subprocess, datetime, platform, math
+import sys, struct, time, os, subprocess, datetime, platform, math, queue
+from operator import attrgetter
+import numpy as np
 from MAVProxy.modules.lib import multiproc
 from pymavlink import mavutil
 from io import StringIO
 from termcolor import colored, cprint
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from mavflightview import *
+from dfbinary import DFBinaryReader, parse_time
+from trajectory import TrackIndex, Trajectory
+from timeline import Timeline, DEFAULT_BUDGET, format_time
+from detectors import BandDetector, JumpDetector, ALT_OFFSET
+from sensors import analyse_sensors, nan_max
+from hashdb import get_hashdb, HASHDB_FILE
+from sinks import Sink, ConsoleSink, TeeSink, make_sink, sink_classes, columnar_kinds
+from evidence import EvidenceSink, print_query
+from profiling import StageProfiler, disabled
 
 
 # dictionaries of data decompilation
@@ -19,24 +30,18 @@ gps_desc_dict = {0:"no GPS", 1:"GPS but no fix", 2:"GPS with 2D fix", 3:"GPS wit
 err_dict = {1: "Main", 2: "Radio", 3: "Compass", 4: "Optical flow", 5: "Throttle failsafe", 6: "Battery failsafe", 7: "GPS failsafe", 8: "GCS failsafe", 9: "Fence",
             10: "Flight Mode", 11: "GPS", 12: "Crash Check"}
 
-# FMT header declared as types for usage in the proper function FORMAT: Name , Format , ColumsVals
-gpstypes = set(['GPS', 'QBIHBcLLefffB', 'GMS', 'GWk', 'NSats', 'HDop', 'Lat', 'Lng', 'Alt', 'Spd', 'GCrs', 'VZ', 'U'])
-msgtypes = set(['MSG', 'Z', 'Message'])
-evtypes = set(['EV', 'B', 'Id'])
-parmtypes = set(['PARM', 'Nf', 'Name', 'Value'])
-modetypes = set(['MODE', 'Mh', 'ModeNum', 'Rsn'])
-errtypes = set(['ERR', 'BB', 'Subsys','ECode'])
-cmdtypes = set(['CMD', 'IHHHfffffff', 'TimeMS', 'CTot', 'CNum', 'CId', 'Prm1', 'Prm2', 'Prm3', 'Prm4', 'Lat', 'Lng', 'Alt'])
-currtypes = set(['CURR', 'IhIhhhf', 'TimeMS', 'ThrOut', 'ThrInt', 'Volt', 'Curr', 'Vcc', 'CurrTot'])
-
-# global variables for later data validation
-ext_crc = None
-hash_list = []
-extdata_list = []
-cmd_list = []
-gps_list = []
-curr_list = []
-
+# total current thresshold percentage around the rolling mean of the last CURR_WINDOW samples
+CURR_THRES_PER = 0.1
+CURR_WINDOW = 50
+# allowed 3D distance in meters between a command location and a gps fix to mark the command as executed
+CMD_OFFSET = 5.0
+# MAV_FRAME of the commands whose altitude is above home, relative (3, 6) or above terrain (10, 11),
+# the terrain height is not in the log so those are taken above home as well
+RELATIVE_FRAMES = set([3, 6, 10, 11])
+# columns of the timeline rows, besides the first, holding the microseconds of another time, formatted when written
+TIMELINE_TIMES = {"alt": (1,), "cmdexec": (3,), "jump": (1,), "sensor": (1,)}
+# gps status descriptions of the fixes with a position
+GPS_FIXES = set([gps_desc_dict[2], gps_desc_dict[3]])
 # object similar to the C# stringbuilder, for nice clean output
 class StringBuilder:
      _file_str = None
@@ -50,7 +55,75 @@ class StringBuilder:
      def __str__(self):
          return self._file_str.getvalue()
 
-# ----- Helper functions: get_eucledian_dist, find_letter / and unused but usefull functions log_info, fmt_info
+# extraction step registered to the single pass dispatcher of get_MAVmsgs, declared by the message type it reads
+# and the fields of its records, and compiled once into the handler of every message of that type
+class Extractor:
+    def __init__(self, name, title, msgtype, fields, label=None, colours=None, console=None, accept=None, hook=None,
+                 finish=None):
+        # step name as used on the command line, section title printed before its output
+        self.name = name
+        self.title = title
+        # message type as declared in the FMT headers
+        self.msgtype = msgtype
+        # (record field, message attribute, optional conversion of the value, optional default) of every field,
+        # in timeline row order, a field with a default may be missing from the format of the message
+        self.fields = fields
+        # text written in the timeline row before the fields
+        self.label = label
+        # colours of the console fields, a dict or a function of the message returning one
+        self.colours = colours
+        # function of the message telling whether the console shows its record, and whether it is recorded at all
+        self.console = console
+        self.accept = accept
+        # function called with the session, the message and its timeline row once it is recorded
+        self.hook = hook
+        # optional function called with the session once the pass is over
+        self.finish = finish
+        self.handler = self.compile()
+
+    # the per message handler, called with the session analysing the log, the fields are read by one attrgetter
+    # and only the declared conversions run, nothing of a log is kept by the handler so every session shares it
+    def compile(self):
+        family = self.name
+        names = [f[0] for f in self.fields]
+        getter = attrgetter(*[f[1] for f in self.fields])
+        single = len(names) == 1
+        conversions = [(i, f[2]) for (i, f) in enumerate(self.fields) if len(f) > 2 and f[2] is not None]
+        # attributes and defaults, read one by one only for the messages of a format missing an optional field
+        defaults = dict([(f[1], f[3]) for f in self.fields if len(f) > 3])
+        attributes = [f[1] for f in self.fields]
+        label = self.label
+        prefix = [label] if label is not None else []
+        (colours, console, accept, hook) = (self.colours, self.console, self.accept, self.hook)
+        dynamic_colours = callable(colours)
+
+        def handler(session, mavmsg):
+            if accept is not None and not accept(mavmsg):
+                return
+            try:
+                values = [getter(mavmsg)] if single else list(getter(mavmsg))
+            except AttributeError:
+                if not defaults:
+                    raise
+                values = [getattr(mavmsg, attr, defaults[attr]) if attr in defaults else getattr(mavmsg, attr)
+                          for attr in attributes]
+            for (i, convert) in conversions:
+                values[i] = convert(values[i])
+            t_us = time_us(mavmsg)
+            session.out.record(family, t_us, dict(zip(names, values)), colours(mavmsg) if dynamic_colours else colours,
+                               console is None or console(mavmsg), label)
+            # timelining
+            data = [t_us] + prefix + values
+            session.timeline.add(family, data)
+            if hook is not None:
+                hook(session, mavmsg, data)
+        return handler
+
+# ----- Helper functions: time_us, get_eucledian_dist, find_letter / and unused but usefull functions log_info, fmt_info
+
+# timestamp of a message in integer microseconds, the timeline and the sinks format it only when they write it
+def time_us(mavmsg):
+    return int(round(mavmsg._timestamp * 1.0e6))
 
 # get the euclidean distance between 2 coordinate arrays
 def get_eucledian_dist(a, b):
@@ -89,471 +162,628 @@ def fmt_info(tlog, types = None):
             print(mavmsg)
     tlog.rewind()
 
-# -----
-
-# each of the _info function takes a types arg, of the type as declared in the FMT headers
-# get the FMT type of PARM and look for the specific ones declared in the param_list
-def parm_info(tlog, types = parmtypes):
-    while True:
-        data = []
-        # create an output in a stringbuilder like format
-        output = StringBuilder()
-        # get the MavLink Message
-        mavmsg = tlog.recv_match(type=types, condition=None)
-        if mavmsg is None:
-            break
-        # if the header is PARM , and belongs to the param_list
-        if mavmsg.get_type() == 'PARM':
-            # get the value as declared in the FMT set list
-            parm_name = mavmsg.Name
-            if parm_name in param_list:
-                parm_val = mavmsg.Value
-                # timestamp extraction
-                tmstmp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mavmsg._timestamp))
-                output.append(str(tmstmp))
-                output.append("  ")
-                output.append(str(parm_name))
-                output.append("\t")
-                output.append(str(parm_val))
-                print(output)
-                # timelining
-                data.append(tmstmp)
-                data.append(parm_name)
-                data.append(parm_val)
-                extdata_list.append(data)
-    # reset back to the begin of log.bin file
-    tlog.rewind()
-
-# get the output of messages
-def msg_info(tlog, types = msgtypes):
-    while True:
-        data = []
-        # create an output in a stringbuilder like format
-        output = StringBuilder()
-        # get the MavLink Message
-        mavmsg = tlog.recv_match(type=types, condition=None)
-        if mavmsg is None:
-            break
-        if mavmsg.get_type() == 'MSG':
-            # get the value as declared in the FMT set list
-            msg = mavmsg.Message
-            # timestamp extraction
-            tmstmp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mavmsg._timestamp))
-            output.append(str(tmstmp))
-            output.append("  ")
-            output.append(colored(str(msg), 'green'))
-            print(output)
-            # timelining
-            data.append(tmstmp)
-            data.append(msg)
-            extdata_list.append(data)
-            # get the checksum, spit the msg and check if the () appear which means that firmware version is included
-            if len(msg.split(" ")) == 3 and find_letter("(", msg.split(" ")):
-                msg = msg.split(" ")
-                # refer to the global variable , since python keeps the scope visible for the function only
-                global ext_crc
-                # keep the list item and remove the first and last "(" ")"
-                ext_crc = msg[2][1:-1]
-    # reset back to the begin of log.bin file
-    tlog.rewind()
-
-# get the events of the flight
-def ev_info(tlog, types = evtypes):
-    while True:
-        data = []
-        output = StringBuilder()
-        mavmsg = tlog.recv_match(type=types, condition=None)
-        if mavmsg is None:
-            break
-        if mavmsg.get_type() == 'EV':
-            # get the value as declared in the FMT set list
-            eventNo = mavmsg.Id
-            # timestamp extraction
-            tmstmp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mavmsg._timestamp))
-            output.append(str(tmstmp))
-            output.append("  ")
-            output.append(str(event_dict.get(eventNo)))
-            print(output)
-            # timelining
-            data.append(tmstmp)
-            data.append(str(event_dict.get(eventNo)))
-            extdata_list.append(data)
-    # reset back to the begin of log.bin file
-    tlog.rewind()
-
-# get the errors happened during the flight
-def err_info(tlog, types = errtypes):
-    while True:
-        data = []
-        output = StringBuilder()
-        mavmsg = tlog.recv_match(type=types, condition=None)
-        if mavmsg is None:
-            break
-        if mavmsg.get_type() == 'ERR':
-            err = mavmsg.Subsys
-            ecode = mavmsg.ECode
-            tmstmp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mavmsg._timestamp))
-            output.append(str(tmstmp))
-            output.append("  ")
-            output.append(err_dict.get(err))
-            output.append("\t")
-            output.append(str(ecode))
-            print(output)
-            # timelining
-            data.append(tmstmp)
-            data.append(str(err_dict.get(err)))
-            data.append(ecode)
-            extdata_list.append(data)
-    tlog.rewind()
-
-# get the mode changes during the flight
-def mode_info(tlog, types = modetypes):
-    while True:
-        data = []
-        output = StringBuilder()
-        mavmsg = tlog.recv_match(type=types, condition=None)
-        if mavmsg is None:
-            break
-        if mavmsg.get_type() == 'MODE':
-            # get the value as declared in the FMT set list
-            mode = mode_dict.get(mavmsg.Mode)
-            modenum = mavmsg.ModeNum
-            # timestamp extraction
-            tmstmp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mavmsg._timestamp))
-            output.append(str(tmstmp))
-            output.append("  ")
-            output.append(str(mode))
-            output.append("\t")
-            output.append(str(modenum))
-            print(output)
-            # timelining
-            data.append(tmstmp)
-            data.append(mode)
-            data.append(modenum)
-            extdata_list.append(data)
-    # reset back to the begin of log.bin file
-    tlog.rewind()
-
-# get current, voltage and consumption info
-def curr_info(tlog, types = currtypes):
-    while True:
-        output = StringBuilder()
-        data = []
-        mavmsg = tlog.recv_match(type=types, condition=None)
-        if mavmsg is None:
-            break
-        if mavmsg.get_type() == 'CURR':
-            tmstmp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mavmsg._timestamp))
-            volt = mavmsg.Volt
-            curr = mavmsg.Curr
-            currtot = mavmsg.CurrTot
-            output.append(str(tmstmp))
-            output.append("  ")
-            output.append("CURR")
-            output.append("\t")
-            output.append(str(volt))
-            output.append("\t")
-            output.append(str(curr))
-            output.append("\t")
-            output.append(str(currtot))
-            # timelining
-            data.append(tmstmp)
-            data.append("CURR")
-            data.append(str(volt))
-            data.append(curr)
-            data.append(currtot)
-            extdata_list.append(data)
-            # record Board voltage and Total current drawn from battery to monitor for Anomalies
-            curr_list.append([tmstmp,curr])
-            print(output)
-    tlog.rewind()
-
-# Detect Anomalies in Board voltage and Total current drawn from battery above decalred thresshold
-def curr_anomaly_detection():
-    # total current thresshold percentage
-    thres_per_curr = 0.1
-    # median values curr
-    medcurr = 0
-    # list of values exceding thresshold
-    c_ex_list = []
-    # find the median value of each one
-    for c in zip(curr_list):
-        medcurr += c[1]
-    # foramt float to 0 pressision
-    medcurr = medcurr / len(curr_list)
-    # find anomalies in declared thresshold
-    for c in zip(curr_list):
-        thres_curr = medcurr*thres_per_curr
-        if (c[1] < medcurr - thres_curr) or (c[1] > medcurr + thres_curr):
-            c_ex_list.append([c[0],c[1]])
-    if not c_ex_list:
-        print(colored("No Current drawn from the battery Anonmaly Detected",'green'))
-    else:
-        print(colored("Current drawn from the battery  Anonmaly Detected",'red'))
-        for c in c_ex_list:
-            print(c[0], "\t", c[1])
-
-# get gps info and coordinates
-def gps_info(tlog, types = gpstypes):
-    while True:
-        output = StringBuilder()
-        data = []
-        mavmsg = tlog.recv_match(type=types, condition=None)
-        gps_status_err = False
-        if mavmsg is None:
-            break
-        if mavmsg.get_type() == 'GPS':
-            # get the value as declared in the FMT set list
-            lat = mavmsg.Lat
-            lng = mavmsg.Lng
-            status = mavmsg.Status
-            # format float val to 2 decimal
-            alt = "{0:.2f}".format(mavmsg.Alt)
-            # timestamp extraction
-            tmstmp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mavmsg._timestamp))
-            output.append(str(tmstmp))
-            output.append("  ")
-            # according to the GPS status a proper color is displayed
-            if status == 0:
-                gps_status_err = True
-                output.append(str(tmstmp))
-                output.append("  ")
-                output.append(colored(str(gps_desc_dict.get(status)),'red'))
-                print(output)
-            elif status == 1:
-                gps_status_err = True
-                output.append(str(tmstmp))
-                output.append("  ")
-                output.append(colored(str(gps_desc_dict.get(status)),'yellow'))
-                print(output)
-            # timelining
-            data.append(tmstmp)
-            data.append(gps_desc_dict.get(status))
-            data.append(lat)
-            data.append(lng)
-            data.append(alt)
-            extdata_list.append(data)
-            gps_list.append(data)
-    if not gps_status_err:
-      output.append(colored("No GPS signal loss",'green'))
-      print(output)
-    # reset back to the begin of log.bin file
-    tlog.rewind()
-
-# get the recorded transmited commands
-def cmd_info(tlog, types = cmdtypes):
-    while True:
-        output = StringBuilder()
-        data = []
-        mavmsg = tlog.recv_match(type=types, condition=None)
-        if mavmsg is None:
-            break
-        if mavmsg.get_type() == 'CMD':
-            tmstmp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mavmsg._timestamp))
-            cid = mavmsg.CId
-            lat = mavmsg.Lat
-            lng = mavmsg.Lng
-            alt = mavmsg.Alt
-            output.append(str(tmstmp))
-            output.append("  ")
-            output.append(str(cid))
-            output.append("\t")
-            output.append(str(lat))
-            output.append("\t")
-            output.append(str(lng))
-            output.append("\t")
-            output.append(str(alt))
-            print(output)
-            # timelining
-            data.append(tmstmp)
-            data.append(str(cid))
-            data.append(lat)
-            data.append(lng)
-            data.append(float(alt))
-            extdata_list.append(data)
-            cmd_list.append(data)
-    # reset back to the begin of log.bin file
-    tlog.rewind()
-
-# verify the cmd execution
-def cmd_execution():
-    # allowed offset of location to mark a cmd as executed
-    offset = 0.2
-    if not gps_list:
-        print("No GPS Data recorded during flight")
-    elif not cmd_list:
-        print("No Command Data recorded during flight")
-    else:
-        # check foe every recoeded command
-        for command in cmd_list:
-            output = StringBuilder()
-            data = []
-            # flag for command execution
-            executed = False
-            # cmd_lat = command[2]  cmd_lng = command[3]  cmd_alt = command[4]
-            cmd_coords = [command[2], command[3], command[4]]
-            # crossvalidate with the recorded gps coordinates
-            for gpslocation in gps_list:
-                # gps_lat = gpslocation[3]  gps_lng = gpslocation[4]  gps_alt = gpslocation[5]
-                gps_coords = [gpslocation[2], gpslocation[3], gpslocation[4]]
-                # get the 3D euclidean distance
-                dist = get_eucledian_dist(cmd_coords, gps_coords)
-                # check the correct execution
-                if dist <= offset:
-                    # set the flag true and get the timestamp of the execution
-                    executed = True
-                    tmstmp = gpslocation[0]
-                    print(gpslocation)
-                    print(command)
-            if executed:
-                output.append(tmstmp)
-                output.append("  ")
-                output.append(colored("EXECUTED",'green'))
-                output.append("\t")
-                output.append(command[1])
-                print(output)
-                # timelining
-                data.append(tmstmp)
-                data.append("EXECUTED")
-                data.append(command[1])
-                extdata_list.append(data)
-            else:
-                # if not executed get the timestamp of cmd transmission
-                tmstmp = command[0]
-                output.append(tmstmp)
-                output.append("  ")
-                output.append(colored("NOT EXECUTED",'red'))
-                output.append("\t")
-                output.append(command[1])
-                print(output)
-                # timelining
-                data.append(command[0])
-                data.append("NOT EXECUTED")
-                data.append(command[1])
-                extdata_list.append(data)
-
-# get the gps height locations where the next coord is way far from the current
-def gps_altD_anomaly_detection():
-    # max allowed alt offset in meters
-    offset = 3
-    # flag to display alt anomaly
-    alt_anomaly = False
-    for i in range(len(gps_list)-1):
-        output = StringBuilder()
-        data = []
-        # get the current and next timestamp
-        cur_tmstmp = gps_list[i][0]
-        next_tmstmp = gps_list[i+1][0]
-        # get the current and next relalt
-        cur_relalt = float(gps_list[i][4])
-        next_relalt = float(gps_list[i+1][4])
-        # get the alt diff and display the anomaly
-        diff = abs(cur_relalt - next_relalt)
-        if diff >= offset:
-            alt_anomaly = True
-            output.append(cur_tmstmp)
-            output.append("  ")
-            output.append(next_tmstmp)
-            output.append("\t")
-            output.append(colored("Alt Anomaly Detected",'red'))
-            output.append("\t")
-            output.append("{0:.2f}".format(diff))
-            print(output)
+# ----- Analysis session: the state and results of the analysis of one log
+
+# everything the analysis of a log keeps, so many logs can be analysed at the same time on the threads of one process,
+# sessions share nothing but the extractor registry, whose compiled handlers keep nothing of a log,
+# and close releases the records, spill files and reader of the log
+class AnalysisSession:
+    def __init__(self, sink=None, memory_budget=DEFAULT_BUDGET, map_view=None, stage_profiler=None):
+        # firmware checksum found in the version message
+        self.ext_crc = None
+        # records of every step and analysis, merged in time order into the timeline file
+        self.timeline = Timeline(memory_budget, TIMELINE_TIMES)
+        self.cmd_list = []
+        self.gps_list = []
+        # streaming detectors fed by curr_msg and gps_msg, and the anomalies they raised
+        self.curr_detector = BandDetector(CURR_WINDOW, CURR_THRES_PER)
+        self.alt_detector = JumpDetector(ALT_OFFSET)
+        self.curr_anomalies = []
+        self.alt_anomalies = []
+        # set by gps_msg when a fix below 2D has been recorded during the pass
+        self.gps_status_err = False
+        # (trajectory, index in gps_list of every fix) of the fixes, built once the pass is over
+        self.gps_track = None
+        # output sink of the records, the console output of each extraction step is held by it
+        # and written as a section once the single pass is over
+        self.out = sink if sink is not None else ConsoleSink()
+        # number of messages each extraction step has handled
+        self.step_counts = {}
+        # reader of the log being analysed, its flight mode is the one of the message being handled
+        self.reader = None
+        # GPS positions and CMDs collected for the map view during the pass, None when there is no map
+        self.map_data = map_view
+        # profiler of the stages of the analysis, measuring nothing unless --profile is given
+        self.profiler = stage_profiler if stage_profiler is not None else disabled
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # drop the records and spill files of the timeline and close the log, the sink belongs to the caller
+    def close(self):
+        self.timeline.reset()
+        if self.reader is not None and hasattr(self.reader, "close"):
+            self.reader.close()
+        self.reader = None
+        self.cmd_list = []
+        self.gps_list = []
+        self.curr_anomalies = []
+        self.alt_anomalies = []
+        self.gps_track = None
+        self.map_data = None
+
+    # get the checksum of the firmware from the version message
+    def msg_msg(self, mavmsg, data):
+        msg = data[1]
+        # spit the msg and check if the () appear which means that firmware version is included
+        if len(msg.split(" ")) == 3 and find_letter("(", msg.split(" ")):
+            msg = msg.split(" ")
+            # keep the list item and remove the first and last "(" ")"
+            self.ext_crc = msg[2][1:-1]
+
+    # monitor the Total current drawn from battery for Anomalies as it streams out of the log
+    def curr_msg(self, mavmsg, data):
+        if self.curr_detector.update(mavmsg.Curr):
+            self.curr_anomalies.append([data[0], mavmsg.Curr])
+
+    # keep the gps coordinates for the command verification and the map
+    def gps_msg(self, mavmsg, data):
+        if mavmsg.Status == 0 or mavmsg.Status == 1:
+            self.gps_status_err = True
+        # the height jump from the previous fix, checked on the numeric altitude
+        if self.alt_detector.update(mavmsg._timestamp, mavmsg.Alt):
+            diff = abs(self.alt_detector.change.delta)
+            self.alt_anomalies.append([self.gps_list[-1][0], data[0], diff])
             #timelining
-            data.append(cur_tmstmp)
-            data.append(next_tmstmp)
-            data.append("Alt Anomaly Detected")
-            data.append("{0:.2f}".format(diff))
-            extdata_list.append(data)
-    if not alt_anomaly:
-        output = StringBuilder()
-        output.append(colored("No Alt Anomaly Detected",'green'))
-        print(output)
-
-# function to check if the extracted checksum corresponds to the one of ArduPilot official repo
-def crc_verification():
-    output = StringBuilder()
-    data = []
-    # get the branches hash code that include tags, which means they are released versions
-    command = ["git ls-remote git://github.com/ArduPilot/ardupilot.git | grep refs/tags"]
-    # send the command
-    p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    # read the output
-    for line in p.stdout.readlines():
-        line = line.decode("utf-8")
-        #keep the 8 first digits
-        line = line[:8]
-        hash_list.append(line)
-    if ext_crc in hash_list:
-        print(colored("CRC Found",'yellow'),"\t",ext_crc)
-    else:
-        print(colored("Extracted CRC does not match with Ardupilot",'red'))
-
-# function to sort and display timeline events and create an timeline file
-def timeline_analysis(args):
+            self.timeline.add("alt", [self.gps_list[-1][0], data[0], "Alt Anomaly Detected", "{0:.2f}".format(diff)])
+        # the numeric altitude, the row has the one formatted for the output
+        self.gps_list.append([data[0], data[1], data[2], data[3], mavmsg.Alt])
+        if self.map_data is not None:
+            self.map_data.add_position(mavmsg._timestamp, data[2], data[3], self.reader.flightmode, mavmsg.Status >= 2)
+
+    # report the GPS status once every GPS message has been seen
+    def gps_finish(self):
+        if not self.gps_status_err:
+            self.out.message("No GPS signal loss", 'green', "gps")
+
+    # keep the recorded transmited commands for the command verification and the map
+    def cmd_msg(self, mavmsg, data):
+        self.cmd_list.append(data)
+        if self.map_data is not None:
+            self.map_data.add_command(mavmsg)
+
+    # write the section of every step that run during the pass
+    def print_steps(self, steps):
+        for step in steps:
+            self.out.section(extractors[step].title, step)
+
+    # read the log once and hand every message to the handlers of the steps that asked for its type
+    def dispatch_info(self, tlog, steps):
+        # message type -> handlers, so a message read once feeds every step that needs it
+        handlers = {}
+        for step in steps:
+            ext = extractors[step]
+            handlers.setdefault(ext.msgtype, []).append((step, ext.handler))
+            self.step_counts.setdefault(step, 0)
+        types = set(handlers.keys())
+        step_counts = self.step_counts
+        # the sink keeps the output of the steps for their sections
+        self.out.hold(steps)
+        while True:
+            mavmsg = tlog.recv_match(type=types, condition=None)
+            if mavmsg is None:
+                break
+            # every step registered for the type gets the message
+            for (step, handler) in handlers.get(mavmsg.get_type(), ()):
+                handler(self, mavmsg)
+                step_counts[step] += 1
+        for step in steps:
+            if extractors[step].finish is not None:
+                extractors[step].finish(self)
+        # reset back to the begin of log.bin file
+        tlog.rewind()
+
+    # report the Anomalies in Total current drawn from battery found by the detector of curr_msg
+    def curr_anomaly_detection(self):
+        if not self.step_counts.get("curr"):
+            self.out.message("No Current Data recorded during flight")
+            return 0
+        if not self.curr_anomalies:
+            self.out.message("No Current drawn from the battery Anonmaly Detected", 'green')
+        else:
+            self.out.message("Current drawn from the battery  Anonmaly Detected", 'red')
+            for c in self.curr_anomalies:
+                self.out.record("curr_anomaly", c[0], {"Curr": c[1]})
+        return len(self.curr_anomalies)
+
+    # trajectory of the gps fixes in local metres, shared by the command verification and the jump detection
+    def gps_trajectory(self):
+        if self.gps_track is None:
+            gps_list = self.gps_list
+            # gps_t = gpslocation[0]  gps_lat = gpslocation[2]  gps_lng = gpslocation[3]  gps_alt = gpslocation[4]
+            fixes = [i for (i, g) in enumerate(gps_list) if g[1] in GPS_FIXES]
+            self.gps_track = (Trajectory([gps_list[i][0] * 1.0e-6 for i in fixes], [gps_list[i][2] for i in fixes],
+                                         [gps_list[i][3] for i in fixes], [gps_list[i][4] for i in fixes]), fixes)
+        return self.gps_track
+
+    # altitude above sea level of home, the one of the command 0 of the mission or else of the first 3D fix
+    def home_alt(self, trajectory):
+        # cmd_cnum = command[5]  cmd_frame = command[6]
+        for command in self.cmd_list:
+            if command[5] == 0 and command[6] not in RELATIVE_FRAMES and (command[2] != 0 or command[3] != 0):
+                return command[4]
+        for gpslocation in self.gps_list:
+            if gpslocation[1] == gps_desc_dict[3]:
+                return gpslocation[4]
+        return trajectory.origin[2]
+
+    # verify the cmd execution
+    def cmd_execution(self):
+        out = self.out
+        gps_list = self.gps_list
+        # home, the command 0, and the commands without a position, the ones that are not navigation commands,
+        # are not flown to by the mission
+        cmd_list = [c for c in self.cmd_list if c[5] != 0 and (c[2] != 0 or c[3] != 0)]
+        # number of commands without a matching gps location
+        not_executed = 0
+        (trajectory, fixes) = self.gps_trajectory()
+        if not fixes:
+            out.message("No GPS Data recorded during flight")
+        elif not cmd_list:
+            out.message("No Command Data recorded during flight")
+        else:
+            # index the recorded gps positions once, so every command is a single radius query in metres
+            track = TrackIndex(trajectory.enu, CMD_OFFSET)
+            # the altitudes of the gps fixes are above sea level, the relative ones of the commands are above home
+            home = self.home_alt(trajectory)
+            # cmd_lat = command[2]  cmd_lng = command[3]  cmd_alt = command[4]  cmd_frame = command[6]
+            cmd_alts = [c[4] + home if c[6] in RELATIVE_FRAMES else c[4] for c in cmd_list]
+            cmd_enu = trajectory.project([c[2] for c in cmd_list], [c[3] for c in cmd_list], cmd_alts)
+            # check foe every recoeded command
+            for (command, cmd_coords) in zip(cmd_list, cmd_enu):
+                data = []
+                # crossvalidate with the recorded gps positions within the 3D offset
+                match = track.query(cmd_coords)
+                if match is not None:
+                    # the first fix gives the timestamp of the execution, the closest one how accurate it was
+                    (first, closest, dist) = match
+                    tmstmp = gps_list[fixes[first]][0]
+                    closest_time = gps_list[fixes[closest]][0]
+                    out.record("cmdexec", tmstmp, {"Status": "EXECUTED", "CId": str(command[1]), "Closest": closest_time,
+                                                   "Dist": "{0:.2f}".format(dist)}, {"Status": 'green'})
+                    # timelining
+                    data.append(tmstmp)
+                    data.append("EXECUTED")
+                    data.append(command[1])
+                    data.append(closest_time)
+                    data.append("{0:.2f}".format(dist))
+                    self.timeline.add("cmdexec", data)
+                else:
+                    # if not executed get the timestamp of cmd transmission
+                    not_executed += 1
+                    out.record("cmdexec", command[0], {"Status": "NOT EXECUTED", "CId": str(command[1])}, {"Status": 'red'})
+                    # timelining
+                    data.append(command[0])
+                    data.append("NOT EXECUTED")
+                    data.append(command[1])
+                    self.timeline.add("cmdexec", data)
+        return not_executed
+
+    # report the gps height locations where the next coord is way far from the current, found by gps_msg
+    def gps_altD_anomaly_detection(self):
+        for (cur_tmstmp, next_tmstmp, diff) in self.alt_anomalies:
+            self.out.record("alt_anomaly", cur_tmstmp, {"Next": next_tmstmp, "Event": "Alt Anomaly Detected",
+                                                        "Diff": "{0:.2f}".format(diff)}, {"Event": 'red'})
+        if not self.alt_anomalies:
+            self.out.message("No Alt Anomaly Detected", 'green')
+        return len(self.alt_anomalies)
+
+    # report the moves between consecutive gps fixes too fast for any vehicle, a glitch or spoofing of the position
+    def gps_jump_detection(self):
+        (trajectory, fixes) = self.gps_trajectory()
+        gps_list = self.gps_list
+        if len(trajectory) < 2:
+            self.out.message("No GPS Data recorded during flight")
+            return 0
+        # a track whose fixes all share a time has no rates at all, they are skipped rather than their warnings
+        # silenced since the warning filters are shared by every thread
+        self.out.message("Max ground speed {0:.1f} m/s, climb rate {1:.1f} m/s, acceleration {2:.1f} m/s2".format(
+            nan_max(trajectory.ground_speed), nan_max(np.abs(trajectory.climb_rate)), nan_max(trajectory.acceleration)))
+        jumps = trajectory.jumps()
+        for i in jumps.tolist():
+            cur_tmstmp = gps_list[fixes[i]][0]
+            next_tmstmp = gps_list[fixes[i + 1]][0]
+            dist = "{0:.2f}".format(float(np.linalg.norm(trajectory.segments[i])))
+            speed = "{0:.1f}".format(trajectory.ground_speed[i])
+            climb = "{0:.1f}".format(trajectory.climb_rate[i])
+            self.out.record("gps_jump", cur_tmstmp, {"Next": next_tmstmp, "Event": "GPS Jump Detected", "Dist": dist,
+                                                     "Speed": speed, "Climb": climb}, {"Event": 'red'})
+            self.timeline.add("jump", [cur_tmstmp, next_tmstmp, "GPS Jump Detected", dist, speed, climb])
+        if not len(jumps):
+            self.out.message("No GPS Jump Detected", 'green')
+        return len(jumps)
+
+    # check the range, saturation, clipping, stuck values and noise of the IMU, BARO, MAG and VIBE streams,
+    # decoded in bulk by the native reader, which is opened for them when the log is read by pymavlink
+    def sensor_analysis(self, tlog, args):
+        sensor_reader = tlog
+        if not isinstance(tlog, DFBinaryReader):
+            try:
+                sensor_reader = DFBinaryReader(args)
+            except Exception:
+                self.out.message("No sensor data, the sensor analysis needs a DataFlash .bin log")
+                return (0, 0)
+        try:
+            (anomalies, samples) = analyse_sensors(sensor_reader)
+        finally:
+            if sensor_reader is not tlog:
+                sensor_reader.close()
+        if not samples:
+            self.out.message("No Sensor Data recorded during flight")
+            return (0, 0)
+        for a in anomalies:
+            start_us = int(round(a["start"] * 1.0e6))
+            end = int(round(a["end"] * 1.0e6))
+            value = "{0:.3f}".format(a["value"])
+            self.out.record("sensor", start_us, {"End": end, "Sensor": a["sensor"], "Field": a["field"], "Check": a["check"],
+                                                 "Samples": a["samples"], "Value": value}, {"Check": 'red'})
+            self.timeline.add("sensor", [start_us, end, a["sensor"], a["field"], a["check"], a["samples"], value])
+        if not anomalies:
+            self.out.message("No Sensor Anomaly Detected in %u samples" % samples, 'green')
+        return (len(anomalies), samples)
+
+    # function to check if the extracted checksum corresponds to a release of the ArduPilot official repo,
+    # looked up in the local hash database built by hashdb.py from an ardupilot clone, returns the releases
+    def crc_verification(self, hashdb_file=HASHDB_FILE):
+        db = get_hashdb(hashdb_file)
+        if db is None:
+            self.out.message("No ArduPilot hash database %s, build it with: python3 hashdb.py import <ardupilot clone>" % hashdb_file, 'red')
+            return None
+        releases = db.lookup(self.ext_crc)
+        if releases:
+            self.out.message(colored("CRC Found",'yellow') + "\t" + self.ext_crc + "\t" + " ".join(["%s(%s)" % r for r in releases]))
+        else:
+            self.out.message("Extracted CRC does not match with Ardupilot", 'red')
+        return releases
+
+    # function to sort and display timeline events and create an timeline file
+    def timeline_analysis(self, args):
+        filename = log_name(args)
+        # every step spilled its records in sorted runs, they are merged straight into the file
+        self.timeline.write(filename+".analysis")
+        self.out.section("Timeline Analysis file Created")
+
+    # write the report of the profiler of the log, named after the log
+    def write_profile(self, args):
+        if self.profiler.enabled:
+            self.profiler.write(log_name(args) + ".profile.json")
+            self.out.message("Profile written to " + log_name(args) + ".profile.json")
+
+    # extract and analyse one log and write its timeline, returns the fleet summary of the log
+    def analyse(self, args, steps=None, crc=False, native=False, index=False, jobs=1, window=None, sensors=True):
+        (out, profiler) = (self.out, self.profiler)
+        # all the extraction steps are enabled by default, they share a single pass over the log
+        if steps is None:
+            steps = list(extractors.keys())
+        start = time.time()
+        with profiler.stage("open"):
+            tlog = open_log(args, native, index, jobs, window)
+
+        # input validatiion
+        if len(args) > 0:
+            wildcard = args[0]
+            if wildcard.find('*') == -1 and wildcard.find('?') == -1:
+                wildcard = "*" + wildcard + "*"
+        else:
+            wildcard = '*'
+        tlog.rewind()
+        self.reader = tlog
+
+        summary = {"log": args}
+        if window is not None:
+            (first, last) = tlog.window
+            out.message("Window %s - %s" % (format_time(int(first * 1e6)) if first is not None else "start",
+                                            format_time(int(last * 1e6)) if last is not None else "end"))
+        ##begin info extraction
+        #log_info(tlog)
+        #fmt_info(tlog)
+        with profiler.stage("extraction") as stage:
+            self.dispatch_info(tlog, steps)
+            stage["messages"] = sum(self.step_counts.values())
+            stage["bytes_read"] = os.path.getsize(args)
+        with profiler.stage("sections"):
+            self.print_steps(steps)
+        if self.map_data is not None:
+            self.map_data.mav_type = tlog.mav_type
+        for step in extractors.keys():
+            summary[step] = self.step_counts.get(step, "")
+        summary["gps_loss"] = self.gps_status_err if "gps" in steps else ""
+        summary["firmware"] = self.ext_crc if self.ext_crc is not None else ""
+        summary["not_executed"] = ""
+        summary["curr_anomalies"] = ""
+        summary["alt_anomalies"] = ""
+        summary["gps_jumps"] = ""
+        summary["sensor_anomalies"] = ""
+        if "cmd" in steps and "gps" in steps:
+            out.section("CMD Execution")
+            with profiler.stage("cmd_execution") as stage:
+                summary["not_executed"] = self.cmd_execution()
+                stage["messages"] = len(self.cmd_list)
+        summary["release"] = ""
+        # crc is True for the default hash database, or the path of another one
+        if crc and "msg" in steps:
+            out.section("CRC Verification")
+            with profiler.stage("crc_verification"):
+                releases = self.crc_verification(crc if isinstance(crc, str) else HASHDB_FILE)
+            if releases is not None:
+                summary["release"] = " ".join([r[0] for r in releases]) if releases else "none"
+        if "curr" in steps:
+            out.section("CURR Anomaly Detection")
+            with profiler.stage("curr_anomaly_detection") as stage:
+                summary["curr_anomalies"] = self.curr_anomaly_detection()
+                stage["messages"] = self.step_counts.get("curr", 0)
+        if "gps" in steps:
+            out.section("GPS Alt Anomaly Detection")
+            with profiler.stage("gps_altD_anomaly_detection") as stage:
+                summary["alt_anomalies"] = self.gps_altD_anomaly_detection()
+                stage["messages"] = self.step_counts.get("gps", 0)
+            out.section("GPS Jump Detection")
+            with profiler.stage("gps_jump_detection") as stage:
+                summary["gps_jumps"] = self.gps_jump_detection()
+                stage["messages"] = self.step_counts.get("gps", 0)
+        if sensors:
+            out.section("Sensor Analysis")
+            with profiler.stage("sensor_analysis") as stage:
+                (summary["sensor_anomalies"], stage["messages"]) = self.sensor_analysis(tlog, args)
+        with profiler.stage("timeline_analysis") as stage:
+            self.timeline_analysis(args)
+            stage["messages"] = self.timeline.count
+        summary["seconds"] = "%.2f" % (time.time() - start)
+        with profiler.stage("output"):
+            out.summary(summary)
+            out.flush()
+        return summary
+
+# according to the GPS status a proper color is displayed, only the fixes below 2D are displayed
+def gps_colours(mavmsg):
+    return {"Status": 'red' if mavmsg.Status == 0 else 'yellow'}
+
+def gps_console(mavmsg):
+    return mavmsg.Status == 0 or mavmsg.Status == 1
+
+# every extraction step in the order its section is displayed, a new message family is one more declaration
+# read in the same single pass, the hooks are the AnalysisSession methods doing what a step does besides
+# writing its record and timeline row
+extractors = {}
+for ext in [Extractor("parm", "PARM Extraction", "PARM", [("Name", "Name"), ("Value", "Value")],
+                      accept=lambda mavmsg: mavmsg.Name in param_list),
+            Extractor("msg", "MSG Extraction", "MSG", [("Message", "Message")], colours={"Message": 'green'},
+                      hook=AnalysisSession.msg_msg),
+            Extractor("ev", "EVENT Extraction", "EV", [("Event", "Id", lambda i: str(event_dict.get(i)))]),
+            Extractor("mode", "MODE Extraction", "MODE", [("Mode", "Mode", mode_dict.get), ("ModeNum", "ModeNum")]),
+            Extractor("err", "ERROR Extraction", "ERR", [("Subsys", "Subsys", lambda e: str(err_dict.get(e))), ("ECode", "ECode")]),
+            Extractor("curr", "CURRENT Extraction", "CURR", [("Volt", "Volt"), ("Curr", "Curr"), ("CurrTot", "CurrTot")],
+                      label="CURR", hook=AnalysisSession.curr_msg),
+            Extractor("cmd", "CMD Extraction", "CMD", [("CId", "CId"), ("Lat", "Lat"), ("Lng", "Lng"), ("Alt", "Alt", float),
+                                                        ("CNum", "CNum", None, None), ("Frame", "Frame", None, 0)],
+                      hook=AnalysisSession.cmd_msg),
+            Extractor("gps", "GPS Status Extraction", "GPS",
+                      [("Status", "Status", gps_desc_dict.get), ("Lat", "Lat"), ("Lng", "Lng"), ("Alt", "Alt", "{0:.2f}".format)],
+                      colours=gps_colours, console=gps_console, hook=AnalysisSession.gps_msg, finish=AnalysisSession.gps_finish)]:
+    extractors[ext.name] = ext
+
+# run a single step over the whole log in a session of its own, which is returned with its records
+def step_info(tlog, step):
+    session = AnalysisSession()
+    session.reader = tlog
+    session.dispatch_info(tlog, [step])
+    session.print_steps([step])
+    return session
+
+# each of the _info function runs a single step over the whole log
+def parm_info(tlog):
+    return step_info(tlog, "parm")
+
+def msg_info(tlog):
+    return step_info(tlog, "msg")
+
+def ev_info(tlog):
+    return step_info(tlog, "ev")
+
+def err_info(tlog):
+    return step_info(tlog, "err")
+
+def mode_info(tlog):
+    return step_info(tlog, "mode")
+
+def curr_info(tlog):
+    return step_info(tlog, "curr")
+
+def gps_info(tlog):
+    return step_info(tlog, "gps")
+
+def cmd_info(tlog):
+    return step_info(tlog, "cmd")
+
+# name of the files written for a log in the current directory
+def log_name(args):
     filename = args.strip('../')
-    filename = filename.replace("/","__")
-    extdata_list.sort()
-    with open(filename+".analysis", 'w+') as log:
-        for item in extdata_list:
-            output = StringBuilder()
-            for i in item:
-                output.append(str(i))
-                output.append('\t')
-            log.write(str(output)+"\n")
-    print("\n>Timeline Analysis file Created")
-
-# core function to handle the data extraction
-def get_MAVmsgs(args):
-    # create an object out if the log file
-    tlog = mavutil.mavlink_connection(args, notimestamps=False,
+    return filename.replace("/","__")
+
+# profiler of a log, profile is True for the JSON report and "cprofile" to also dump a cProfile of every stage
+def make_profiler(args, profile):
+    if not profile:
+        return None
+    return StageProfiler(args, cprofile_prefix=log_name(args) if profile == "cprofile" else None)
+
+# create an object out if the log file, the native decoder reads .bin logs in bulk with NumPy
+# and with an index it seeks straight to the messages of the enabled steps,
+# a huge log has its message boundaries found by several worker processes,
+# a (start, end) window of parse_time bounds keeps only the messages of that time
+def open_log(args, native=False, index=False, jobs=1, window=None):
+    if native or index or window is not None:
+        tlog = DFBinaryReader(args, index=index, jobs=jobs)
+        if window is not None:
+            tlog.set_window(*window)
+        return tlog
+    return mavutil.mavlink_connection(args, notimestamps=False,
                                       zero_time_base=False)
-    # create a map object to store the options from mavflightview
-    map_options = mavflightview_options()
-
-    # input validatiion
-    if len(args) > 0:
-        wildcard = args[0]
-        if wildcard.find('*') == -1 and wildcard.find('?') == -1:
-            wildcard = "*" + wildcard + "*"
-    else:
-        wildcard = '*'
-    tlog.rewind()
 
-    ##begin info extraction
-    #log_info(tlog)
-    #fmt_info(tlog)
-    print("\n>PARM Extraction")
-    #parm_info(tlog)
-    print("\n>MSG Extraction")
-    #msg_info(tlog)
-    print("\n>EVENT Extraction")
-    #ev_info(tlog)
-    print("\n>MODE Extraction")
-    #mode_info(tlog)
-    print("\n>ERROR Extraction")
-    #err_info(tlog)
-    print("\n>CURRENT Extraction")
-    #curr_info(tlog)
-    print("\n>CMD Extraction")
-    #cmd_info(tlog)
-    print("\n>GPS Status Extraction")
-    gps_info(tlog)
-    print("\n>CMD Execution")
-    #cmd_execution()
-    print("\n>CRC Verification")
-    #crc_verification()
-    #print("\n>CURR Anomaly Detection")
-    #curr_anomaly_detection()
-    print("\n>GPS Alt Anomaly Detection")
-    gps_altD_anomaly_detection()
-    timeline_analysis(args)
-    print("\n>MAP View")
-    mavflightview(args,map_options)
+# --from and --to bound of the command line, see parse_time
+def window_time(text):
+    try:
+        return parse_time(text)
+    except ValueError as ex:
+        raise ArgumentTypeError(str(ex))
 
+# extract and analyse one log in a session of its own and write its timeline, returns the fleet summary of the log
+def analyse_log(args, steps=None, crc=False, native=False, index=False, jobs=1, memory_budget=DEFAULT_BUDGET, sink=None,
+                map_view=None, stage_profiler=None, window=None, sensors=True):
+    with AnalysisSession(sink, memory_budget, map_view, stage_profiler) as session:
+        return session.analyse(args, steps, crc, native, index, jobs, window, sensors)
 
-def __main__():
-    # parse the input data
+# core function to handle the data extraction
+def get_MAVmsgs(args, steps=None, crc=False, native=False, index=False, jobs=1, memory_budget=DEFAULT_BUDGET, sink=None,
+                map_image=None, map_background="plain", profile=False, window=None, sensors=True):
+    # the map reuses the GPS and CMD messages of the analysis when both steps run
+    map_view = MapData() if steps is None or ("gps" in steps and "cmd" in steps) else None
+    with AnalysisSession(sink, memory_budget, map_view, make_profiler(args, profile)) as session:
+        session.analyse(args, steps, crc, native, index, jobs, window, sensors)
+        # create a map object to store the options from mavflightview
+        map_options = mavflightview_options()
+        map_options.index = index
+        map_options.window = window
+        # an image of the map is rendered headless, with no tile server and no window
+        if map_image is not None:
+            map_options.imagefile = map_image
+            map_options.headless = True
+            map_options.background = map_background
+        session.out.section("MAP View")
+        session.out.flush()
+        if map_view is not None:
+            mavflightview_data(map_view, map_options, title=args, profiler=session.profiler)
+        else:
+            mavflightview(args,map_options, profiler=session.profiler)
+        session.write_profile(args)
+
+# ----- Batch mode: many logs analysed on a pool of worker processes
+
+# columns of the fleet summary, besides the message count of every extraction step
+# seconds between the checks that the batch workers are still alive
+BATCH_POLL_SECONDS = 1.0
+summary_columns = ["log", "status", "seconds", "firmware", "release", "gps_loss", "not_executed", "curr_anomalies", "alt_anomalies", "gps_jumps", "sensor_anomalies"]
+
+# analyse one log of a batch in a session of its own without console output, errors are reported in the summary,
+# the jsonl and csv outputs are written to a file named after the log, the parquet and arrow ones to files prefixed by it,
+# it only writes files of its own so several of them can run at once on the threads of a process
+def batch_analyse(filename, steps, crc, native, index, memory_budget, output="console", profile=False, db=None, window=None,
+                  sensors=True):
+    sink = None
+    try:
+        if output in ("jsonl", "csv"):
+            sink = make_sink(output, log_name(filename) + "." + output)
+        elif output in columnar_kinds:
+            sink = make_sink(output, log_name(filename))
+        else:
+            # the console output is dropped
+            sink = Sink()
+        # the records of every log are also loaded into the evidence store
+        if db is not None:
+            sink = TeeSink([sink, EvidenceSink(db)])
+        # nothing of this log is kept by the worker once its summary is sent back
+        with AnalysisSession(sink, memory_budget, stage_profiler=make_profiler(filename, profile)) as session:
+            summary = session.analyse(filename, steps, crc, native, index, 1, window, sensors)
+            session.write_profile(filename)
+        summary["status"] = "ok"
+    except Exception as ex:
+        summary = {"log": filename, "status": "error: %s" % ex}
+    finally:
+        if sink is not None:
+            sink.close()
+    return summary
+
+# worker process of the batch pool, it takes logs from the task queue until it gets None
+def batch_worker(tasks, results, steps, crc, native, index, memory_budget, output, profile=False, db=None, window=None,
+                 sensors=True):
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (i, filename) = task
+        results.put((i, batch_analyse(filename, steps, crc, native, index, memory_budget, output, profile, db, window, sensors)))
+
+# expand the directories of the command line into the dataflash logs they contain
+def batch_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (root, dirs, names) in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith(".bin"):
+                        files.append(os.path.join(root, name))
+        else:
+            files.append(path)
+    return files
+
+# analyse many logs on a pool of processes, write their timelines and a combined fleet summary
+def batch_analysis(paths, steps, crc=False, native=False, index=False, jobs=None, summary_file="fleet_summary.tsv",
+                   memory_budget=DEFAULT_BUDGET, output="console", profile=False, db=None, window=None, sensors=True):
+    files = batch_files(paths)
+    if jobs is None or jobs <= 0:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(files)))
+    print("\n>Batch Analysis of %u logs on %u processes" % (len(files), jobs))
+    tasks = multiproc.Queue()
+    results = multiproc.Queue()
+    for task in enumerate(files):
+        tasks.put(task)
+    workers = []
+    for i in range(jobs):
+        tasks.put(None)
+        p = multiproc.Process(target=batch_worker, args=(tasks, results, steps, crc, native, index, memory_budget, output, profile, db, window, sensors))
+        p.start()
+        workers.append(p)
+    summaries = [None] * len(files)
+    n = 0
+    while n < len(files):
+        try:
+            (i, summary) = results.get(timeout=BATCH_POLL_SECONDS)
+        except queue.Empty:
+            # a worker killed by the OOM killer, a signal or a crash of the decoder never sends the summary of its log,
+            # once no worker is left the logs still outstanding are the ones they were analysing
+            if any([p.is_alive() for p in workers]):
+                continue
+            try:
+                (i, summary) = results.get(timeout=BATCH_POLL_SECONDS)
+            except queue.Empty:
+                break
+        summaries[i] = summary
+        n += 1
+        print("[%u/%u] %s\t%s" % (n, len(files), summary["log"], summary["status"]))
+    for p in workers:
+        p.join()
+    codes = ", ".join([str(p.exitcode) for p in workers if p.exitcode])
+    for (i, filename) in enumerate(files):
+        if summaries[i] is None:
+            summaries[i] = {"log": filename, "status": "error: worker died (exit code %s)" % codes}
+            n += 1
+            print("[%u/%u] %s\t%s" % (n, len(files), filename, summaries[i]["status"]))
+    # fleet summary, one row per log in the order they were given
+    columns = summary_columns + list(extractors.keys())
+    with open(summary_file, 'w') as tsv:
+        tsv.write("\t".join(columns) + "\n")
+        for summary in summaries:
+            tsv.write("\t".join([str(summary.get(c, "")) for c in columns]) + "\n")
+    print("\n>Fleet summary file %s Created" % summary_file)
+    return summaries
+
+
+# the banner of the console output
+def print_banner():
     print('                               888                      ')
     print('                               888                      ')
     print(' .d88b. 888d888888  88888888b. 88888b.  .d88b. 88888b.  ')
@@ -563,14 +793,86 @@ def __main__():
     print('     888            888888                              ')
     print('Y8b d88P       Y8b d88P888                              ')
     print(' "Y88P"         "Y88P" 888                              ')
+
+def __main__():
+    # parse the input data
     parser = ArgumentParser(description=__doc__)
-    parser.add_argument("files", metavar="<FILE>", nargs="?")
+    parser.add_argument("files", metavar="<FILE>", nargs="*",
+                        help="log file, several logs or directories of logs are analysed in batch mode")
+    parser.add_argument("--steps", default=",".join(extractors.keys()),
+                        help="comma separated extraction steps, all read in one pass (%(default)s)")
+    parser.add_argument("--crc", action="store_true", default=False,
+                        help="verify the firmware CRC against the releases of the local ArduPilot hash database")
+    parser.add_argument("--hashdb", default=HASHDB_FILE,
+                        help="ArduPilot hash database built by hashdb.py (%(default)s)")
+    parser.add_argument("--native", action="store_true", default=False,
+                        help="decode the .bin log with the memory mapped NumPy decoder instead of pymavlink")
+    parser.add_argument("--index", action="store_true", default=False,
+                        help="keep a sidecar index of the message offsets so later runs seek straight to them (implies --native)")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="worker processes of the batch mode (default: one per core), or splitting a single huge log with --native (default: none)")
+    parser.add_argument("--summary", default="fleet_summary.tsv",
+                        help="fleet summary file of the batch mode (%(default)s)")
+    parser.add_argument("--memory-budget", type=int, default=DEFAULT_BUDGET // (1024 * 1024),
+                        help="MB of timeline records kept in memory before they are spilled to temporary files (%(default)s)")
+    parser.add_argument("--map-image", default=None,
+                        help="write the map view to this PNG file, rendered offline, instead of opening a window")
+    parser.add_argument("--map-background", default="plain", choices=["plain", "cache"],
+                        help="background of --map-image, plain or the map tiles already cached (%(default)s)")
+    parser.add_argument("--output", default="console", choices=list(sink_classes.keys()),
+                        help="console sections, quiet summary only, jsonl and csv records, or parquet and arrow files per record family (%(default)s)")
+    parser.add_argument("--output-file", default=None,
+                        help="file of the records, the standard output by default, or the file prefix of parquet and arrow (in batch mode named after each log)")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="write the time, CPU, messages, bytes read and peak memory of every stage to <LOG>.profile.json")
+    parser.add_argument("--cprofile", action="store_true", default=False,
+                        help="with --profile, also dump a cProfile of every stage to <LOG>.<STAGE>.prof")
+    parser.add_argument("--db", default=None,
+                        help="also load the records into this SQLite evidence store, see evidence.py")
+    parser.add_argument("--query", default=None,
+                        help="SQL query run on the --db evidence store once the logs are loaded")
+    parser.add_argument("--from", dest="start", default=None, type=window_time,
+                        help="analyse only from this time, seconds or [H:]M:S from the start of the log or a local Y-m-d H:M:S (implies --native)")
+    parser.add_argument("--to", dest="end", default=None, type=window_time,
+                        help="analyse only up to this time, as --from")
+    parser.add_argument("--no-sensors", dest="sensors", action="store_false", default=True,
+                        help="skip the range, saturation, clipping, stuck value and noise checks of the IMU, BARO, MAG and VIBE data")
     args = parser.parse_args()
-    if args.files is not None and len(args.files) != 0:
-        get_MAVmsgs(args.files)
-    else:
+    if args.query and not args.db:
+        parser.error("--query needs the --db evidence store")
+    window = (args.start, args.end) if args.start is not None or args.end is not None else None
+    profile = "cprofile" if args.profile and args.cprofile else args.profile
+    if args.output == "console":
+        print_banner()
+    steps = [step for step in args.steps.split(",") if step]
+    for step in steps:
+        if step not in extractors:
+            parser.error("unknown step %s, choose from %s" % (step, ",".join(extractors.keys())))
+    if len(args.files) > 1 or (len(args.files) == 1 and os.path.isdir(args.files[0])):
+        batch_analysis(args.files, steps, args.crc and args.hashdb, args.native, args.index, args.jobs, args.summary,
+                       args.memory_budget * 1024 * 1024, args.output, profile, args.db, window, args.sensors)
+    elif len(args.files) == 1:
+        output_file = args.output_file
+        # the columnar outputs write one file per family, prefixed by the log name unless --output-file says otherwise
+        if args.output in columnar_kinds and output_file is None:
+            output_file = log_name(args.files[0])
+        try:
+            sink = make_sink(args.output, output_file)
+        except ImportError as ex:
+            parser.error(str(ex))
+        if args.db:
+            sink = TeeSink([sink, EvidenceSink(args.db)])
+        try:
+            get_MAVmsgs(args.files[0], steps, args.crc and args.hashdb, args.native, args.index, args.jobs or 1,
+                        args.memory_budget * 1024 * 1024, sink, args.map_image, args.map_background, profile, window, args.sensors)
+        finally:
+            sink.close()
+    elif not args.query:
         print("Usage: gryphon.py <LOGFILE...>")
         sys.exit(1)
+    if args.query:
+        print_query(args.db, args.query)
 
 if __name__ == "__main__":
+    multiproc.freeze_support()
     __main__()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+'''
+local database of the ArduPilot release hashes, for the CRC verification
+
+The firmware writes the first 8 characters of its git commit in the version
+MSG. The database maps them to the release tags pointing at that commit and
+their vehicle type, it is built from a local ardupilot clone so the
+verification needs no network.
+'''
+
+import os, json, subprocess, datetime
+from argparse import ArgumentParser
+
+HASHDB_VERSION = 1
+HASHDB_FILE = os.path.join(os.path.expanduser("~"), ".cache", "gryphon", "ardupilot_hashes.json")
+# length of the commit hash written by the firmware
+HASH_LENGTH = 8
+# tag prefixes of the vehicles, the older Ardu and APM names included
+vehicle_dict = {"Copter": "Copter", "ArduCopter": "Copter", "Plane": "Plane", "ArduPlane": "Plane",
+                "Rover": "Rover", "APMrover2": "Rover", "Sub": "Sub", "ArduSub": "Sub",
+                "Tracker": "Tracker", "AntennaTracker": "Tracker", "Blimp": "Blimp", "AP_Periph": "AP_Periph"}
+
+def tag_vehicle(tag):
+    '''vehicle type of a release tag such as Copter-4.0.3 or ArduPlane-stable'''
+    return vehicle_dict.get(tag.split("-")[0], "")
+
+class HashDB(object):
+    '''release tags and vehicles by firmware hash'''
+    def __init__(self, hashes=None, source=None, created=None):
+        self.hashes = hashes if hashes is not None else {}
+        self.source = source
+        self.created = created
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lookup(self, crc):
+        '''[(tag, vehicle), ...] of a firmware hash, empty when it is not a release'''
+        if not crc:
+            return []
+        return [tuple(r) for r in self.hashes.get(crc[:HASH_LENGTH].lower(), [])]
+
+    def add(self, commit, tag):
+        releases = self.hashes.setdefault(commit[:HASH_LENGTH].lower(), [])
+        if [tag, tag_vehicle(tag)] not in releases:
+            releases.append([tag, tag_vehicle(tag)])
+
+    @staticmethod
+    def load(filename=HASHDB_FILE):
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get("version") != HASHDB_VERSION:
+            raise ValueError("%s: hash database version %s, expected %u" % (filename, data.get("version"), HASHDB_VERSION))
+        return HashDB(data["hashes"], data.get("source"), data.get("created"))
+
+    def save(self, filename=HASHDB_FILE):
+        '''write the database, replacing the previous one only once it is complete'''
+        dirname = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        data = {"version": HASHDB_VERSION, "source": self.source, "created": self.created, "hashes": self.hashes}
+        tmp = filename + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=0, sort_keys=True)
+        os.replace(tmp, filename)
+
+def import_clone(clone):
+    '''build the database of every tag of a local ardupilot clone'''
+    # annotated tags are peeled to the commit they point at, which is what the firmware reports
+    command = ["git", "-C", clone, "for-each-ref", "--format=%(objectname) %(*objectname) %(refname:short)", "refs/tags"]
+    out = subprocess.check_output(command).decode("utf-8")
+    db = HashDB(source=os.path.abspath(clone), created=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    for line in out.splitlines():
+        fields = line.split(" ")
+        if len(fields) != 3:
+            continue
+        (obj, peeled, tag) = fields
+        db.add(peeled or obj, tag)
+    return db
+
+# database of the current process, loaded once for every log it verifies
+loaded = {}
+
+def get_hashdb(filename=HASHDB_FILE):
+    '''the database of filename, loaded on first use, None if there is none'''
+    if filename not in loaded:
+        try:
+            loaded[filename] = HashDB.load(filename)
+        except (IOError, OSError, ValueError):
+            loaded[filename] = None
+    return loaded[filename]
+
+def __main__():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--db", default=HASHDB_FILE, help="hash database file (%(default)s)")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("import", help="rebuild the database from a local ardupilot clone")
+    p.add_argument("clone", help="path of the ardupilot clone, fetch its tags first")
+    p = sub.add_parser("lookup", help="show the releases of firmware hashes")
+    p.add_argument("hashes", nargs="+")
+    args = parser.parse_args()
+    if args.command == "import":
+        db = import_clone(args.clone)
+        db.save(args.db)
+        print("%u release hashes of %s written to %s" % (len(db), args.clone, args.db))
+    elif args.command == "lookup":
+        db = HashDB.load(args.db)
+        for crc in args.hashes:
+            releases = db.lookup(crc)
+            print(crc, "\t", " ".join(["%s(%s)" % r for r in releases]) if releases else "not a release")
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+'''
+live analysis of a MAVLink telemetry link or of a growing tlog
+
+The GPS status, error, mode and altitude jump checks of gryphon run on every
+message as it arrives and their events are written to the timeline file at
+once, so they are flagged during the flight.
+'''
+
+import sys, time, struct, asyncio
+from argparse import ArgumentParser
+from termcolor import colored
+from pymavlink import mavutil
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+from timeline import format_time, format_row
+from detectors import JumpDetector, ALT_OFFSET
+
+# STATUSTEXT severities raised as errors
+ERR_SEVERITY = mavlink.MAV_SEVERITY_ERROR
+# bytes read at once from a link or a tlog
+READ_SIZE = 65536
+
+def time_us(t):
+    return int(round(t * 1.0e6))
+
+def timeline_name(source):
+    '''timeline file of a source, named like the one of an offline analysis'''
+    return source.strip('../').replace("/", "__").replace(":", "_") + ".analysis"
+
+class LiveAnalyser(object):
+    '''incremental checks over the messages of a link, in the order they arrive'''
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.fix_type = None
+        self.mode = None
+        # the altitude jump check of the offline analysis, fed with every fix
+        self.alt_detector = JumpDetector(ALT_OFFSET)
+        self.events = 0
+
+    def emit(self, data, output, times=()):
+        '''print an event and append it to the timeline straight away, formatted like the offline timeline'''
+        print(output)
+        self.timeline.write(format_row(data, times))
+        self.timeline.flush()
+        self.events += 1
+
+    def handle(self, t, msg):
+        mtype = msg.get_type()
+        if mtype == 'GPS_RAW_INT':
+            self.gps(t, msg)
+        elif mtype == 'STATUSTEXT':
+            self.statustext(t, msg)
+        elif mtype == 'HEARTBEAT':
+            self.heartbeat(t, msg)
+
+    def gps(self, t, msg):
+        t_us = time_us(t)
+        tmstmp = format_time(t_us)
+        lat = msg.lat * 1.0e-7
+        lng = msg.lon * 1.0e-7
+        alt = msg.alt * 0.001
+        # report the changes of the fix, and every fix below 2D
+        if msg.fix_type != self.fix_type:
+            desc = mavlink.enums['GPS_FIX_TYPE'][msg.fix_type].description if msg.fix_type in mavlink.enums['GPS_FIX_TYPE'] else str(msg.fix_type)
+            color = 'red' if msg.fix_type == 0 else 'yellow' if msg.fix_type == 1 else 'green'
+            self.emit([t_us, desc, lat, lng, "{0:.2f}".format(alt)],
+                      tmstmp + "  " + colored("GPS " + desc, color))
+            self.fix_type = msg.fix_type
+        # altitude jump between two consecutive fixes, whatever their status as offline
+        last = self.alt_detector.change.last
+        if self.alt_detector.update(t, alt):
+            diff = "{0:.2f}".format(abs(self.alt_detector.change.delta))
+            last_us = time_us(last[0])
+            self.emit([last_us, t_us, "Alt Anomaly Detected", diff],
+                      format_time(last_us) + "  " + tmstmp + "\t" + colored("Alt Anomaly Detected", 'red') + "\t" + diff, (1,))
+
+    def statustext(self, t, msg):
+        if msg.severity > ERR_SEVERITY:
+            return
+        t_us = time_us(t)
+        tmstmp = format_time(t_us)
+        self.emit([t_us, msg.text, msg.severity], tmstmp + "  " + colored(msg.text, 'red') + "\t" + str(msg.severity))
+
+    def heartbeat(self, t, msg):
+        # only the vehicle, not the ground stations sharing the link
+        if msg.type == mavlink.MAV_TYPE_GCS or msg.autopilot == mavlink.MAV_AUTOPILOT_INVALID:
+            return
+        if msg.custom_mode == self.mode:
+            return
+        t_us = time_us(t)
+        tmstmp = format_time(t_us)
+        mode = mavutil.mode_string_v10(msg)
+        self.emit([t_us, mode, msg.custom_mode], tmstmp + "  " + str(mode) + "\t" + str(msg.custom_mode))
+        self.mode = msg.custom_mode
+
+    def link_lost(self, t, seconds):
+        t_us = time_us(t)
+        tmstmp = format_time(t_us)
+        self.emit([t_us, "LINK LOST", "{0:.1f}".format(seconds)],
+                  tmstmp + "  " + colored("LINK LOST", 'red') + "\t" + "{0:.1f}".format(seconds))
+
+# ----- sources, each one puts (timestamp, message) on the queue as soon as a message is complete
+
+class UDPSource(asyncio.DatagramProtocol):
+    def __init__(self, queue):
+        self.queue = queue
+        self.parser = mavlink.MAVLink(None)
+        self.parser.robust_parsing = True
+
+    def datagram_received(self, data, addr):
+        for msg in self.parser.parse_buffer(data) or []:
+            self.queue.put_nowait((time.time(), msg))
+
+async def read_udp(queue, host, port):
+    loop = asyncio.get_running_loop()
+    (transport, protocol) = await loop.create_datagram_endpoint(lambda: UDPSource(queue), local_addr=(host, port))
+    try:
+        await asyncio.Future()
+    finally:
+        transport.close()
+
+async def read_tcp(queue, host, port):
+    (reader, writer) = await asyncio.open_connection(host, port)
+    parser = mavlink.MAVLink(None)
+    parser.robust_parsing = True
+    try:
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            for msg in parser.parse_buffer(data) or []:
+                queue.put_nowait((time.time(), msg))
+    finally:
+        writer.close()
+    await queue.put(None)
+
+def tlog_packet_length(buf, ofs):
+    '''length of the MAVLink packet at ofs, or None if it is not a packet start'''
+    if buf[ofs] == mavlink.PROTOCOL_MARKER_V1:
+        return 8 + buf[ofs+1]
+    if buf[ofs] == mavlink.PROTOCOL_MARKER_V2:
+        signed = buf[ofs+2] & mavlink.MAVLINK_IFLAG_SIGNED
+        return 12 + buf[ofs+1] + (mavlink.MAVLINK_SIGNATURE_BLOCK_LEN if signed else 0)
+    return None
+
+async def follow_tlog(queue, filename, poll=0.2):
+    '''read a tlog from its start and keep reading what is appended to it'''
+    parser = mavlink.MAVLink(None)
+    parser.robust_parsing = True
+    buf = bytearray()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                await asyncio.sleep(poll)
+                continue
+            buf += data
+            ofs = 0
+            # every packet is preceded by its 8 byte big endian timestamp in microseconds
+            while len(buf) - ofs >= 11:
+                plen = tlog_packet_length(buf, ofs + 8)
+                if plen is None:
+                    # not in sync, skip a byte like pymavlink does
+                    ofs += 1
+                    continue
+                if len(buf) - ofs < 8 + plen:
+                    break
+                t = struct.unpack('>Q', bytes(buf[ofs:ofs+8]))[0] * 1.0e-6
+                for msg in parser.parse_buffer(bytes(buf[ofs+8:ofs+8+plen])) or []:
+                    queue.put_nowait((t, msg))
+                ofs += 8 + plen
+            del buf[:ofs]
+            await asyncio.sleep(0)
+
+def open_source(queue, source):
+    '''reader task of a udpin:, udp:, tcp: endpoint or of a tlog file'''
+    if source.startswith(("udpin:", "udp:", "tcp:")):
+        (kind, host, port) = source.split(":")
+        if kind == "tcp":
+            return read_tcp(queue, host, int(port))
+        return read_udp(queue, host, int(port))
+    return follow_tlog(queue, source)
+
+async def live_analysis(source, timeline_file=None, timeout=5.0, stop_after=0):
+    '''analyse a source until it ends, or stop_after seconds without any message'''
+    if timeline_file is None:
+        timeline_file = timeline_name(source)
+    queue = asyncio.Queue()
+    reader = asyncio.ensure_future(open_source(queue, source))
+    print("\n>Live Analysis of %s" % source)
+    with open(timeline_file, 'w') as timeline:
+        analyser = LiveAnalyser(timeline)
+        last = time.time()
+        lost = False
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    # a reader that failed, on a refused connection or a missing tlog, raises its error here,
+                    # one that ended has already queued the end of the source
+                    if reader.done():
+                        reader.result()
+                        break
+                    silent = time.time() - last
+                    if not lost:
+                        analyser.link_lost(time.time(), silent)
+                        lost = True
+                    if stop_after and silent >= stop_after:
+                        break
+                    continue
+                if item is None:
+                    break
+                last = time.time()
+                lost = False
+                analyser.handle(*item)
+        finally:
+            reader.cancel()
+    print("\n>Timeline Analysis file Created")
+    return analyser.events
+
+# ----- replay of a recorded log, standing in for the vehicle
+
+def replay(filename, address, speed=1.0):
+    '''send a recorded log to udp address as telemetry, speed 0 sends as fast as possible
+
+    tlogs are sent as recorded, DataFlash logs have their GPS, MODE and ERR
+    messages sent as the GPS_RAW_INT, HEARTBEAT and STATUSTEXT a vehicle would send'''
+    log = mavutil.mavlink_connection(filename, notimestamps=False, zero_time_base=False)
+    out = mavutil.mavlink_connection("udpout:" + address, source_system=1)
+    mav = out.mav
+    first = None
+    start = time.time()
+    mode = 0
+    sent = 0
+    while True:
+        m = log.recv_match(type=['GPS', 'MODE', 'ERR', 'GPS_RAW_INT', 'HEARTBEAT', 'STATUSTEXT'])
+        if m is None:
+            break
+        if speed > 0:
+            if first is None:
+                first = m._timestamp
+            delay = (m._timestamp - first) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        mtype = m.get_type()
+        if mtype in ('GPS_RAW_INT', 'HEARTBEAT', 'STATUSTEXT'):
+            out.write(m.get_msgbuf())
+        elif mtype == 'GPS':
+            mav.gps_raw_int_send(int(m._timestamp * 1.0e6), m.Status, int(m.Lat * 1.0e7), int(m.Lng * 1.0e7),
+                                 int(m.Alt * 1000), 65535, 65535, int(m.Spd * 100), 65535, m.NSats)
+        elif mtype == 'MODE':
+            mode = m.Mode
+            mav.heartbeat_send(mavlink.MAV_TYPE_QUADROTOR, mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA,
+                               mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED, mode, mavlink.MAV_STATE_ACTIVE)
+        elif mtype == 'ERR':
+            mav.statustext_send(mavlink.MAV_SEVERITY_ERROR, ("ERR Subsys %u ECode %u" % (m.Subsys, m.ECode)).encode())
+        sent += 1
+    return sent
+
+def __main__():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("source", metavar="<SOURCE>",
+                        help="udpin:HOST:PORT, tcp:HOST:PORT or a tlog that is still being written")
+    parser.add_argument("--output", default=None, help="timeline file (default: named after the source)")
+    parser.add_argument("--timeout", type=float, default=5.0,
+                        help="seconds without any message before the link is reported lost (%(default)s)")
+    parser.add_argument("--stop-after", type=float, default=0,
+                        help="stop after that many seconds without any message (default: never)")
+    parser.add_argument("--replay", default=None, metavar="HOST:PORT",
+                        help="send the <SOURCE> log to HOST:PORT over UDP instead of analysing it")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed up, 0 for as fast as possible (%(default)s)")
+    args = parser.parse_args()
+    if args.replay is not None:
+        print("%u messages sent" % replay(args.source, args.replay, args.speed))
+        return
+    try:
+        asyncio.run(live_analysis(args.source, args.output, args.timeout, args.stop_after))
+    except KeyboardInterrupt:
+        pass
+    except OSError as ex:
+        print("Cannot read %s: %s" % (args.source, ex), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    __main__()
@@ -4,7 +4,8 @@
 view a mission log on a map
 '''
 
-import sys, time, os
+import sys, time, os, ast, builtins
+from types import SimpleNamespace
 from math import *
 
 from pymavlink import mavutil, mavwp, mavextra
@@ -12,8 +13,12 @@ from MAVProxy.modules.mavproxy_map import mp_slipmap, mp_tile
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import multiproc
 import functools
+from dfbinary import DFBinaryReader
+from trajectory import simplify_path, SIMPLIFY_PIXELS
+from profiling import disabled
 
 import cv2
+import numpy as np
 
 def create_map(title):
     '''create map object'''
@@ -54,6 +59,69 @@ def create_imagefile(options, filename, latlon, ground_width, path_objs, mission
     map_img = cv2.cvtColor(map_img, cv2.COLOR_BGR2RGB)
     cv2.imwrite(filename, map_img)
 
+# background colour of a headless image without map tiles
+plain_background = (48, 48, 48)
+
+def project_points(latlon, ground_width, width, lats, lons):
+    '''pixel coordinates of arrays of lat and lon, the vectorized coord_to_pixel of mp_tile'''
+    (lat, lon) = latlon
+    pixel_width_equator = (ground_width / float(width)) / cos(radians(lat))
+    C = mp_util.radius_of_earth / pixel_width_equator
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -89.9999, 89.9999)
+    lons = np.asarray(lons, dtype=np.float64)
+    y = C * (mp_tile.mercator_y(lat) - np.log(np.tan(pi/4 + np.radians(lats)/2)))
+    x = C * np.radians((lons - lon + 180.0) % 360.0 - 180.0)
+    return np.stack((np.rint(x), np.rint(y)), axis=-1).astype(np.int32)
+
+def draw_polylines(img, latlon, ground_width, width, points, colour=None, linewidth=2, closed=False):
+    '''draw a path of (lat, lon[, colour]) points, with one polylines call per colour
+
+    as SlipPolygon does, the segment from a point to the next one has the colour of the point'''
+    if len(points) < 2:
+        return
+    pix = project_points(latlon, ground_width, width, [p[0] for p in points], [p[1] for p in points])
+    if closed:
+        pix = np.concatenate((pix, pix[:1]))
+    colours = [tuple(p[2]) if len(p) > 2 else colour for p in points]
+    if closed:
+        colours.append(colours[0])
+    # runs of segments sharing a colour, each run is one polyline of that colour
+    runs = {}
+    start = 0
+    for i in range(1, len(pix)):
+        if i == len(pix) - 1 or colours[i] != colours[start]:
+            runs.setdefault(colours[start], []).append(pix[start:i+1])
+            start = i
+    for (c, lines) in runs.items():
+        cv2.polylines(img, lines, False, c, linewidth, cv2.LINE_AA)
+
+def render_headless(options, filename, latlon, ground_width, path, wp, fen, width=600, height=600, used_flightmodes=[], mav_type=None):
+    '''create path and mission as an image file without waiting on any tile server
+
+    the background is plain, or made of the tiles already in the local cache'''
+    if getattr(options, "background", "plain") == "cache":
+        mt = mp_tile.MPTile(service=options.service, download=False)
+        map_img = mt.area_to_image(latlon[0], latlon[1], width, height, ground_width)
+    else:
+        map_img = np.zeros((height, width, 3), np.uint8)
+        map_img[:] = plain_background
+    for points in path:
+        draw_polylines(map_img, latlon, ground_width, width, points, (255,0,180))
+    for points in wp.polygon_list():
+        draw_polylines(map_img, latlon, ground_width, width, points, (255,255,255))
+    fence = fen.polygon()
+    if len(fence) > 1:
+        draw_polylines(map_img, latlon, ground_width, width, fence, (0,255,0))
+    if (mav_type is not None and
+        options.colour_source == "flightmode"):
+        tuples = [ (mode, colour_for_flightmode(mav_type, mode))
+                   for mode in used_flightmodes.keys() ]
+        legend = mp_slipmap.SlipFlightModeLegend("legend", tuples)
+        pixmapper = lambda p: tuple(project_points(latlon, ground_width, width, [p[0]], [p[1]])[0].tolist())
+        legend.draw(map_img, pixmapper, None)
+    map_img = cv2.cvtColor(map_img, cv2.COLOR_BGR2RGB)
+    cv2.imwrite(filename, map_img)
+
 map_colours = [ (255,   0,   0),
                 (  0, 255,   0),
                 (  0,   0, 255),
@@ -151,8 +219,150 @@ colour_expression_exceptions = dict()
 colour_source_min = 255
 colour_source_max = 0
 
+# math functions a colour expression may call, working on whole arrays
+vector_functions = {'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'asin': np.arcsin, 'acos': np.arccos,
+                    'atan': np.arctan, 'atan2': np.arctan2, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log,
+                    'log10': np.log10, 'fabs': np.fabs, 'hypot': np.hypot, 'degrees': np.degrees,
+                    'radians': np.radians, 'floor': np.floor, 'ceil': np.ceil, 'pow': np.power}
+
+class MessageColumns(object):
+    '''the fields of a list of messages as arrays, read on first use'''
+    def __init__(self, msgs):
+        self._msgs = msgs
+        self._columns = {}
+
+    def __getattr__(self, field):
+        if field.startswith('_'):
+            raise AttributeError(field)
+        if field not in self._columns:
+            self._columns[field] = np.array([getattr(m, field) for m in self._msgs], dtype=np.float64)
+        return self._columns[field]
+
+class ColourExpression(object):
+    '''a --colour-source expression, compiled once and evaluated over every point of the log together
+
+    Only the values of the message fields the expression reads are kept for
+    every point. Once the log is read, they become arrays and the expression
+    runs once over them. The points it cannot run on that way are evaluated
+    one by one, as before, which also reports their exceptions.'''
+    def __init__(self, source):
+        self.source = source
+        self.code = compile(source, '<colour-source>', 'eval')
+        tree = ast.parse(source, mode='eval')
+        # every name that is not a function or module is a message of the log
+        names = set([n.id for n in ast.walk(tree) if isinstance(n, ast.Name)])
+        self.names = sorted([n for n in names if n not in globals() and not hasattr(builtins, n)])
+        # the fields read of every message, a message used otherwise than by its fields is kept whole
+        attributes = [n for n in ast.walk(tree) if isinstance(n, ast.Attribute) and isinstance(n.value, ast.Name)]
+        self.fields = dict([(name, sorted(set([a.attr for a in attributes if a.value.id == name]))) for name in self.names])
+        used = set([id(a.value) for a in attributes])
+        self.whole = set([n.id for n in ast.walk(tree) if isinstance(n, ast.Name) and n.id in self.fields and id(n) not in used])
+        self.snapshots = []
+
+    def snapshot(self, messages):
+        '''the values the expression reads of the messages as they are at a point, None for a message not received yet'''
+        values = []
+        for name in self.names:
+            m = messages.get(name)
+            if m is None or name in self.whole:
+                values.append(m)
+            else:
+                values.append(tuple([getattr(m, f, None) for f in self.fields[name]]))
+        return tuple(values)
+
+    def scope(self, snapshot):
+        '''the messages of a snapshot as the expression reads them'''
+        scope = {}
+        for (name, v) in zip(self.names, snapshot):
+            if v is None:
+                continue
+            scope[name] = v if name in self.whole else SimpleNamespace(**dict(zip(self.fields[name], v)))
+        return scope
+
+    def add(self, messages):
+        '''keep the values read by the expression as they are at a point, returns the point number'''
+        self.snapshots.append(self.snapshot(messages))
+        return len(self.snapshots) - 1
+
+    def evaluate(self, snapshot):
+        '''value of the expression at a single point'''
+        try:
+            return eval(self.code, globals(), self.scope(snapshot))
+        except Exception as e:
+            str_e = str(e)
+            count = colour_expression_exceptions.get(str_e, 0)
+            if count > 100:
+                print("Too many exceptions processing (%s): %s" % (self.source, str_e))
+                sys.exit(1)
+            colour_expression_exceptions[str_e] = count + 1
+            return 0
+
+    def vectorized(self, rows):
+        '''values of the expression at the points of rows in one go, None if it does not work on arrays'''
+        scope = {}
+        for (k, name) in enumerate(self.names):
+            if name in self.whole:
+                scope[name] = MessageColumns([self.snapshots[r][k] for r in rows])
+                continue
+            columns = {}
+            for (i, field) in enumerate(self.fields[name]):
+                column = [self.snapshots[r][k][i] for r in rows]
+                # a field some message lacks, or that is not a number, raises on its own point
+                if None in column:
+                    return None
+                try:
+                    columns[field] = np.array(column, dtype=np.float64)
+                except (TypeError, ValueError):
+                    return None
+            scope[name] = SimpleNamespace(**columns)
+        try:
+            with np.errstate(all='ignore'):
+                v = np.asarray(eval(self.code, dict(globals(), **vector_functions), scope), dtype=np.float64)
+        except Exception:
+            return None
+        # a single value from an expression over messages means it did not run per point
+        if v.shape != (len(rows),) and (self.names or v.shape != ()):
+            return None
+        return np.broadcast_to(v, (len(rows),))
+
+    def values(self):
+        '''value of the expression at every point, in the range 0..255'''
+        v = np.zeros(len(self.snapshots))
+        # the points before one of the messages was first received raise on their own
+        complete = np.array([None not in s for s in self.snapshots], dtype=bool)
+        rows = np.flatnonzero(complete)
+        batch = self.vectorized(rows) if len(rows) else None
+        if batch is not None:
+            v[rows] = batch
+            rows = np.flatnonzero(~complete)
+        else:
+            rows = np.arange(len(self.snapshots))
+        for r in rows.tolist():
+            value = self.evaluate(self.snapshots[r])
+            if isinstance(value, str):
+                print("colour expression returned a string: %s" % value)
+                sys.exit(1)
+            v[r] = value if value is not None else 0
+        return colour_values(v)
+
+def colour_values(v):
+    '''clamp the values of a colour expression to 0..255, keeping their range'''
+    global colour_source_max, colour_source_min
+    v = np.nan_to_num(v, nan=0.0)
+    if (v < 0).any():
+        print("colour expression returned %d values < 0" % (v < 0).sum())
+    if (v > 255).any():
+        print("colour expression returned %d values > 255" % (v > 255).sum())
+    v = np.clip(v, 0, 255)
+    if len(v):
+        colour_source_min = min(colour_source_min, v.min())
+        colour_source_max = max(colour_source_max, v.max())
+    return v
+
+# compiled expressions of colour_for_point, by source
+colour_expressions = {}
+
 def colour_for_point(mlog, point, instance, options):
-    global colour_expression_exceptions, colour_source_max, colour_source_min
     '''indicate a colour to be used to plot point'''
     source = getattr(options, "colour_source", "flightmode")
     if source == "flightmode":
@@ -160,44 +370,14 @@ def colour_for_point(mlog, point, instance, options):
 
     # evaluate source as an expression which should return a
     # number in the range 0..255
-    try:
-        v = eval(source, globals(),mlog.messages)
-    except Exception as e:
-        str_e = str(e)
-        try:
-            count = colour_expression_exceptions[str_e]
-        except KeyError:
-            colour_expression_exceptions[str_e] = 0
-            count = 0
-        if count > 100:
-            print("Too many exceptions processing (%s): %s" % (source, str_e))
-            sys.exit(1)
-        colour_expression_exceptions[str_e] += 1
-        v = 0
-
-    # we don't use evaluate_expression as we want the exceptions...
-#    v = mavutil.evaluate_expression(source, mlog.messages)
-
-    if v is None:
-        v = 0
-    elif isinstance(v, str):
+    expression = colour_expressions.get(source)
+    if expression is None:
+        expression = colour_expressions[source] = ColourExpression(source)
+    v = expression.evaluate(expression.snapshot(mlog.messages))
+    if isinstance(v, str):
         print("colour expression returned a string: %s" % v)
         sys.exit(1)
-    elif v < 0:
-        print("colour expression returned %d (< 0)" % v)
-        v = 0
-    elif v > 255:
-        print("colour expression returned %d (> 255)" % v)
-        v = 255
-
-    if v < colour_source_min:
-        colour_source_min = v
-    if v > colour_source_max:
-        colour_source_max = v
-
-    r = 255
-    g = 255
-    b = v
+    b = float(colour_values(np.array([v if v is not None else 0], dtype=np.float64))[0])
     return (b,b,b)
 
 def colour_for_point_flightmode(mlog, point, instance, options):
@@ -223,6 +403,27 @@ def colour_for_flightmode(mav_type, fmode, instance=0):
     colour = (r,g,b)
     return colour
 
+def cmd_mission_item(m):
+    '''the mission item of a DataFlash CMD message'''
+    return mavutil.mavlink.MAVLink_mission_item_message(0,
+                                                        0,
+                                                        m.CNum,
+                                                        mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
+                                                        m.CId,
+                                                        0, 1,
+                                                        m.Prm1, m.Prm2, m.Prm3, m.Prm4,
+                                                        m.Lat, m.Lng, m.Alt)
+
+def add_mission_item(wp, m):
+    '''set a mission item, padding the mission with dummy ones up to its seq'''
+    try:
+        while m.seq > wp.count():
+            print("Adding dummy WP %u" % wp.count())
+            wp.set(m, wp.count())
+        wp.set(m, m.seq)
+    except Exception:
+        pass
+
 def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
     '''create a map for a log file'''
     wp = mavwp.MAVWPLoader()
@@ -259,6 +460,10 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
 
     last_timestamps = {}
     used_flightmodes = {}
+    # a colour expression is evaluated over all the points once the log is read
+    expression = None
+    if getattr(options, "colour_source", "flightmode") != "flightmode":
+        expression = ColourExpression(options.colour_source)
 
     while True:
         try:
@@ -271,30 +476,10 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
         type = m.get_type()
 
         if type == 'MISSION_ITEM':
-            try:
-                while m.seq > wp.count():
-                    print("Adding dummy WP %u" % wp.count())
-                    wp.set(m, wp.count())
-                wp.set(m, m.seq)
-            except Exception:
-                pass
+            add_mission_item(wp, m)
             continue
         if type == 'CMD':
-            m = mavutil.mavlink.MAVLink_mission_item_message(0,
-                                                             0,
-                                                             m.CNum,
-                                                             mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT,
-                                                             m.CId,
-                                                             0, 1,
-                                                             m.Prm1, m.Prm2, m.Prm3, m.Prm4,
-                                                             m.Lat, m.Lng, m.Alt)
-            try:
-                while m.seq > wp.count():
-                    print("Adding dummy WP %u" % wp.count())
-                    wp.set(m, wp.count())
-                wp.set(m, m.seq)
-            except Exception:
-                pass
+            add_mission_item(wp, cmd_mission_item(m))
             continue
         if not mlog.check_condition(options.condition):
             continue
@@ -360,18 +545,30 @@ def mavflightview_mav(mlog, options=None, flightmode_selections=[]):
             instance = instances[type]
 
             if abs(lat)>0.01 or abs(lng)>0.01:
-                colour = colour_for_point(mlog, (lat, lng), instance, options)
-                point = (lat, lng, colour)
-
                 if options.rate == 0 or not type in last_timestamps or m._timestamp - last_timestamps[type] > 1.0/options.rate:
                     last_timestamps[type] = m._timestamp
-                    path[instance].append(point)
+                    if expression is not None:
+                        # the point number, replaced by its colour below
+                        colour = expression.add(mlog.messages)
+                    else:
+                        colour = colour_for_point(mlog, (lat, lng), instance, options)
+                    path[instance].append((lat, lng, colour))
+    if expression is not None:
+        values = expression.values().tolist()
+        path = [[(lat, lng, (values[c],)*3) for (lat, lng, c) in p] for p in path]
     if len(path[0]) == 0:
         print("No points to plot")
         return None
 
     return [path, wp, fen, used_flightmodes, getattr(mlog, 'mav_type',None)]
 
+def simplify_paths(path, ground_width, zoom, width=600):
+    '''the flight paths with the detail a map of ground_width metres on width pixels still shows once zoomed in zoom times'''
+    if zoom <= 0:
+        return path
+    tolerance = SIMPLIFY_PIXELS * ground_width / float(zoom) / float(width)
+    return [simplify_path(p, tolerance) if len(p) > 2 else p for p in path]
+
 def mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title=None):
     if not title:
         title='MAVFlightView'
@@ -384,6 +581,11 @@ def mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title
            mp_util.gps_distance(lat, lon, lat, bounds[1]+bounds[3]) >= ground_width-20):
         ground_width += 10
 
+    # the path is simplified once for the initial view, an image is never zoomed and the interactive map,
+    # whose zoom is not reported back by the slipmap process, keeps the detail seen zoomed in lod times
+    lod = getattr(options, "lod", 0)
+    path = simplify_paths(path, ground_width, min(lod, 1) if options.imagefile else lod)
+
     path_objs = []
     for i in range(len(path)):
         if len(path[i]) != 0:
@@ -406,7 +608,9 @@ def mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title
     else:
         fence_obj = None
 
-    if options.imagefile:
+    if options.imagefile and getattr(options, "headless", False):
+        render_headless(options, options.imagefile, (lat,lon), ground_width, path, wp, fen, used_flightmodes=used_flightmodes, mav_type=mav_type)
+    elif options.imagefile:
         create_imagefile(options, options.imagefile, (lat,lon), ground_width, path_objs, mission_obj, fence_obj, used_flightmodes=used_flightmodes, mav_type=mav_type)
     else:
         global multi_map
@@ -448,14 +652,78 @@ def mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title
         else:
             print("colour-source: min=%f max=%f" % (colour_source_min, colour_source_max))
 
-def mavflightview(filename, options):
+def mavflightview(filename, options, profiler=disabled):
     #print("Loading %s ..." % filename)
-    mlog = mavutil.mavlink_connection(filename)
-    stuff = mavflightview_mav(mlog, options)
+    with profiler.stage("map read") as stage:
+        window = getattr(options, "window", None)
+        if getattr(options, "index", False) or window is not None:
+            # the sidecar index of the log lets the map read only its position and mission messages
+            mlog = DFBinaryReader(filename, index=getattr(options, "index", False))
+            if window is not None:
+                mlog.set_window(*window)
+        else:
+            mlog = mavutil.mavlink_connection(filename)
+        stuff = mavflightview_mav(mlog, options)
+        stage["bytes_read"] = os.path.getsize(filename)
     if stuff is None:
         return
     [path, wp, fen, used_flightmodes, mav_type] = stuff
-    mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title=filename)
+    with profiler.stage("map show") as stage:
+        stage["messages"] = sum([len(p) for p in path])
+        mavflightview_show(path, wp, fen, used_flightmodes, mav_type, options, title=filename)
+
+class MapData(object):
+    '''positions and mission of a log read by another tool, so the map does not read the log again
+
+    The flight mode of a position is the one of the log reader when the
+    position was read, and mav_type the one of the reader once it is done.'''
+    def __init__(self):
+        self.points = []
+        self.commands = []
+        self.used_flightmodes = {}
+        self.mav_type = None
+
+    def add_position(self, t, lat, lng, flightmode, fix=True):
+        '''a GPS position at t seconds, only the ones with a fix are plotted'''
+        self.used_flightmodes[flightmode] = 1
+        if fix and (abs(lat)>0.01 or abs(lng)>0.01):
+            self.points.append((t, lat, lng, flightmode))
+
+    def add_command(self, m):
+        '''a CMD or MISSION_ITEM message of the mission'''
+        self.commands.append(cmd_mission_item(m) if m.get_type() == 'CMD' else m)
+
+def mavflightview_data(data, options, title=None, profiler=disabled):
+    '''show the map of a MapData
+
+    Only the options that do not need the log messages apply: mission,
+    fence, mode, rate and the flight mode colours.'''
+    wp = mavwp.MAVWPLoader()
+    if options.mission is not None:
+        wp.load(options.mission)
+    for m in data.commands:
+        add_mission_item(wp, m)
+    fen = mavwp.MAVFenceLoader()
+    if options.fence is not None:
+        fen.load(options.fence)
+    colours = {}
+    path = [[]]
+    last = None
+    for (t, lat, lng, fmode) in data.points:
+        if options.mode is not None and fmode.lower() != options.mode.lower():
+            continue
+        if options.rate != 0 and last is not None and t - last <= 1.0/options.rate:
+            continue
+        last = t
+        if fmode not in colours:
+            colours[fmode] = colour_for_flightmode(data.mav_type, fmode)
+        path[0].append((lat, lng, colours[fmode]))
+    if len(path[0]) == 0:
+        print("No points to plot")
+        return
+    with profiler.stage("map show") as stage:
+        stage["messages"] = len(path[0])
+        mavflightview_show(path, wp, fen, data.used_flightmodes, data.mav_type, options, title=title)
 
 class mavflightview_options(object):
     def __init__(self):
@@ -480,6 +748,11 @@ class mavflightview_options(object):
         self._flightmodes = []
         self.colour_source = 'flightmode'
         self.show_flightmode_legend = True
+        self.index = False
+        self.window = None
+        self.headless = False
+        self.background = "plain"
+        self.lod = 8
 
 if __name__ == "__main__":
     multiproc.freeze_support()
@@ -507,6 +780,10 @@ if __name__ == "__main__":
     parser.add_option("--rate", type='int', default=0, help="maximum message rate to display (0 means all points)")
     parser.add_option("--colour-source", type="str", default="flightmode", help="expression with range 0f..255f used for point colour")
     parser.add_option("--no-flightmode-legend", action="store_false", default=True, dest="show_flightmode_legend", help="hide legend for colour used for flight modes")
+    parser.add_option("--index", action='store_true', default=False, help="read .bin logs through their sidecar message index")
+    parser.add_option("--headless", action='store_true', default=False, help="render --imagefile without waiting on the tile server")
+    parser.add_option("--background", default="plain", help="headless background, plain or cache for the tiles already downloaded")
+    parser.add_option("--lod", type='int', default=8, help="simplify the flight path once, keeping the detail seen zoomed in that many times from the initial view (0 means all points)")
 
     (opts, args) = parser.parse_args()
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+'''
+per stage profile of an analysis: wall and CPU time, messages, bytes read and peak memory
+
+Every stage of the analysis runs inside StageProfiler.stage, which can also
+dump a cProfile of the stage. The report is a JSON file, so runs can be
+compared by tools. CPU time and bytes read are the ones of the thread
+running the stage, so sessions sharing a thread pool each count their own,
+while the peak memory is the one of the whole process.
+'''
+
+import os, sys, time, json, platform, datetime, contextlib, cProfile, threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PROFILE_VERSION = 1
+
+# shared flags of the stages being measured on any thread, set once another stage ran at the same time
+_active = []
+_active_lock = threading.Lock()
+
+def cpu_time():
+    '''CPU seconds of the calling thread, the worker processes it starts are not counted'''
+    return time.thread_time()
+
+def io_read():
+    '''bytes read by the calling thread so far, None where the kernel does not tell'''
+    for path in ("/proc/thread-self/io", "/proc/self/task/%u/io" % threading.get_native_id()):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith("rchar:"):
+                        return int(line.split()[1])
+        except (IOError, OSError):
+            pass
+    return None
+
+def reset_peak():
+    '''restart the peak resident memory of the process, where the kernel allows it'''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+def peak_rss_mb():
+    '''peak resident memory in MB, since the last reset_peak where it is supported'''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+class StageProfiler(object):
+    '''measures the stages of the analysis of a log
+
+    A stage fills the messages it handled and the log bytes it decoded in the
+    record it is given. With cprofile_prefix the stage also runs under
+    cProfile and its statistics go to <prefix>.<stage>.prof. A disabled
+    profiler hands out records and measures nothing. The peak memory is
+    restarted only when no other stage is measured at the same time, on
+    another thread, peak_rss_of_stage tells whether it was.'''
+    def __init__(self, log=None, enabled=True, cprofile_prefix=None):
+        self.log = log
+        self.enabled = enabled
+        self.cprofile_prefix = cprofile_prefix
+        self.stages = []
+        self.start = time.time()
+        self.start_cpu = cpu_time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {"stage": name, "messages": None, "bytes_read": None}
+        if not self.enabled:
+            yield record
+            return
+        # the peak of the process is shared, restarting it would spoil the stages of the other sessions
+        shared = [False]
+        with _active_lock:
+            if _active:
+                shared[0] = True
+                for flag in _active:
+                    flag[0] = True
+            _active.append(shared)
+            peak_reset = reset_peak() if not shared[0] else False
+        io0 = io_read()
+        cpu0 = cpu_time()
+        wall0 = time.time()
+        prof = None
+        if self.cprofile_prefix is not None:
+            prof = cProfile.Profile()
+            prof.enable()
+        try:
+            yield record
+        finally:
+            if prof is not None:
+                prof.disable()
+                prof.dump_stats("%s.%s.prof" % (self.cprofile_prefix, name.replace(" ", "_")))
+            wall = time.time() - wall0
+            io1 = io_read()
+            record["wall_s"] = wall
+            record["cpu_s"] = cpu_time() - cpu0
+            record["io_read_bytes"] = io1 - io0 if io0 is not None and io1 is not None else None
+            record["peak_rss_mb"] = peak_rss_mb()
+            with _active_lock:
+                _active[:] = [flag for flag in _active if flag is not shared]
+            # without the reset, or with other stages running, the peak is the one of the whole process so far
+            record["peak_rss_of_stage"] = peak_reset and not shared[0]
+            if record["messages"] is not None:
+                record["msgs_per_s"] = record["messages"] / wall if wall > 0 else None
+            if record["bytes_read"] is not None:
+                record["mb_per_s"] = record["bytes_read"] / (1024.0 * 1024.0) / wall if wall > 0 else None
+            self.stages.append(record)
+
+    def report(self):
+        return {"version": PROFILE_VERSION,
+                "log": self.log,
+                "started": datetime.datetime.fromtimestamp(self.start).strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "wall_s": time.time() - self.start,
+                "cpu_s": cpu_time() - self.start_cpu,
+                "stages": self.stages}
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=1)
+
+# profiler of the code that is not being profiled
+disabled = StageProfiler(enabled=False)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+'''
+range, saturation, clipping, stuck value and noise checks of the IMU, BARO, MAG and VIBE streams
+
+Every stream is decoded in bulk by the native reader into one array per
+field and split by sensor instance. Every check is a vectorized mask over
+the samples of a field, and the flagged samples closer than MERGE_GAP
+seconds make one anomaly interval, so the highest rate streams of a log
+are checked without any Python work per sample.
+'''
+
+import numpy as np
+from argparse import ArgumentParser
+
+# flagged samples closer than that in seconds are one anomaly interval
+MERGE_GAP = 1.0
+# a value repeated for that long, in seconds and samples, is a stuck sensor
+STUCK_SECONDS = 1.0
+STUCK_SAMPLES = 10
+# seconds of samples whose sample to sample noise is compared with the one of the whole stream
+NOISE_SECONDS = 1.0
+NOISE_MIN_SAMPLES = 8
+# windows noisier than NOISE_FACTOR times the median window are flagged
+NOISE_FACTOR = 5.0
+# fraction of the full scale of a sensor at which it is saturated
+SATURATION = 0.99
+# full scale of the ArduPilot IMUs, 2000 deg/s and 16 g
+GYRO_FULL_SCALE = np.radians(2000.0)
+ACCEL_FULL_SCALE = 16 * 9.80665
+# strength of the earth field in milligauss, anything outside is interference or a broken compass
+MAG_FIELD = (120.0, 900.0)
+# vibration in m/s/s above which the position estimate suffers
+VIBE_LIMIT = 30.0
+# columns telling the instances of a sensor apart
+INSTANCE_COLUMNS = ('I', 'IMU')
+
+def nan_max(values):
+    '''largest value of an array as np.nanmax, nan without a warning when all of them are nan'''
+    values = values[~np.isnan(values)]
+    return values.max() if len(values) else float('nan')
+
+class SensorCheck(object):
+    '''checks of a field of a sensor, or of the length of the vector of several fields
+
+    lo and hi bound the valid values, full_scale is the largest value the
+    sensor can measure, stuck and noise look for a repeated value and for
+    noisy windows, and a counter is flagged wherever it goes up.'''
+    def __init__(self, name, fields=None, lo=None, hi=None, full_scale=None, stuck=False, noise=False, counter=False):
+        self.name = name
+        self.fields = fields if fields is not None else (name,)
+        self.lo = lo
+        self.hi = hi
+        self.full_scale = full_scale
+        self.stuck = stuck
+        self.noise = noise
+        self.counter = counter
+
+    def values(self, columns):
+        '''the samples checked, None when the stream lacks a field'''
+        if any([f not in columns for f in self.fields]):
+            return None
+        if len(self.fields) == 1:
+            return np.asarray(columns[self.fields[0]], dtype=np.float64)
+        return np.sqrt(sum([np.asarray(columns[f], dtype=np.float64) ** 2 for f in self.fields]))
+
+    def masks(self, t, values):
+        '''(check, mask of the flagged samples) of every check of the field'''
+        found = []
+        if self.counter:
+            found.append(("clipping", increasing(values)))
+            return found
+        with np.errstate(invalid='ignore'):
+            invalid = ~np.isfinite(values)
+            if self.lo is not None:
+                invalid |= values < self.lo
+            if self.hi is not None:
+                invalid |= values > self.hi
+            found.append(("range", invalid))
+            if self.full_scale is not None:
+                found.append(("saturation", np.abs(values) >= self.full_scale * SATURATION))
+        if self.stuck:
+            found.append(("stuck", stuck(t, values)))
+        if self.noise:
+            found.append(("noise", noisy(t, values)))
+        return found
+
+def axes(prefix, **kwargs):
+    '''the same checks of the X, Y and Z fields of a sensor'''
+    return [SensorCheck(prefix + axis, **kwargs) for axis in "XYZ"]
+
+IMU_CHECKS = (axes("Gyr", full_scale=GYRO_FULL_SCALE, stuck=True, noise=True) +
+              axes("Acc", full_scale=ACCEL_FULL_SCALE, stuck=True, noise=True))
+BARO_CHECKS = [SensorCheck("Alt", lo=-500.0, hi=10000.0, stuck=True, noise=True),
+               SensorCheck("Press", lo=30000.0, hi=110000.0, stuck=True),
+               SensorCheck("Temp", lo=-40.0, hi=85.0)]
+MAG_CHECKS = (axes("Mag", stuck=True, noise=True) +
+              [SensorCheck("Field", ("MagX", "MagY", "MagZ"), lo=MAG_FIELD[0], hi=MAG_FIELD[1])])
+VIBE_CHECKS = (axes("Vibe", hi=VIBE_LIMIT) +
+               [SensorCheck(c, counter=True) for c in ("Clip", "Clip0", "Clip1", "Clip2")])
+# message type -> checks, older logs have a type per instance
+SENSORS = {"IMU": IMU_CHECKS, "IMU2": IMU_CHECKS, "IMU3": IMU_CHECKS,
+           "BARO": BARO_CHECKS, "BAR2": BARO_CHECKS, "BAR3": BARO_CHECKS,
+           "MAG": MAG_CHECKS, "MAG2": MAG_CHECKS, "MAG3": MAG_CHECKS,
+           "VIBE": VIBE_CHECKS}
+
+def increasing(values):
+    '''samples where a counter went up'''
+    mask = np.zeros(len(values), dtype=bool)
+    mask[1:] = np.diff(values) > 0
+    return mask
+
+def stuck(t, values, seconds=STUCK_SECONDS, samples=STUCK_SAMPLES):
+    '''samples of the runs of one repeated value lasting at least seconds and samples'''
+    n = len(values)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    change = np.ones(n, dtype=bool)
+    change[1:] = values[1:] != values[:-1]
+    starts = np.flatnonzero(change)
+    ends = np.concatenate((starts[1:], [n])) - 1
+    long = ((ends - starts + 1) >= samples) & ((t[ends] - t[starts]) >= seconds)
+    return long[np.cumsum(change) - 1]
+
+def noisy(t, values, seconds=NOISE_SECONDS, factor=NOISE_FACTOR):
+    '''samples of the windows whose sample to sample noise is factor times the one of the median window
+
+    The noise is the spread of the differences of consecutive samples, so
+    the manoeuvres of the vehicle, slow next to the rate of the sensor, do
+    not count as noise.'''
+    mask = np.zeros(len(values), dtype=bool)
+    if len(values) < 2 * NOISE_MIN_SAMPLES:
+        return mask
+    dt = np.median(np.diff(t))
+    per = max(NOISE_MIN_SAMPLES, int(round(seconds / dt))) if dt > 0 else NOISE_MIN_SAMPLES
+    d = np.diff(values)
+    windows = len(d) // per
+    if windows < 2:
+        return mask
+    with np.errstate(invalid='ignore'):
+        noise = d[:windows * per].reshape(windows, per).std(axis=1)
+        typical = np.nanmedian(noise)
+        if not typical > 0:
+            return mask
+        flagged = noise > factor * typical
+    mask[1:windows * per + 1] = np.repeat(flagged, per)
+    return mask
+
+def intervals(t, mask, gap=MERGE_GAP):
+    '''(first, last, samples) of the runs of flagged samples, the runs closer than gap seconds are merged'''
+    idx = np.flatnonzero(mask)
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(t[idx]) > gap)
+    firsts = idx[np.concatenate(([0], breaks + 1))]
+    lasts = idx[np.concatenate((breaks, [len(idx) - 1]))]
+    counts = np.diff(np.concatenate(([0], breaks + 1, [len(idx)])))
+    return list(zip(firsts.tolist(), lasts.tolist(), counts.tolist()))
+
+def sensor_streams(reader, name):
+    '''(instance, timestamps, columns) of every instance of a sensor type, decoded in bulk and limited to the window of the reader'''
+    offsets = reader.window_offsets(name)
+    if len(offsets) == 0:
+        return []
+    recs = reader.records(name, offsets)
+    t = reader.timestamps(name, offsets, recs)
+    columns = reader.columns(name, offsets, recs)
+    if reader.window is not None:
+        keep = reader.in_window(t)
+        t = t[keep]
+        columns = dict((c, v[keep]) for (c, v) in columns.items())
+    instance = None
+    for c in INSTANCE_COLUMNS:
+        if c in columns:
+            instance = c
+            break
+    if instance is None:
+        return [(None, t, columns)]
+    streams = []
+    for i in np.unique(columns[instance]).tolist():
+        sel = np.flatnonzero(columns[instance] == i)
+        streams.append((i, t[sel], dict((c, v[sel]) for (c, v) in columns.items())))
+    return streams
+
+def analyse_sensors(reader, sensors=SENSORS):
+    '''(anomalies, samples) of the sensors of a log
+
+    Every anomaly is a dict of the sensor, field, check, first and last
+    time of the interval, flagged samples and largest value.'''
+    anomalies = []
+    samples = 0
+    for (name, checks) in sensors.items():
+        if name not in reader.name_to_id:
+            continue
+        for (instance, t, columns) in sensor_streams(reader, name):
+            samples += len(t)
+            label = name if instance is None else "%s[%s]" % (name, instance)
+            for check in checks:
+                values = check.values(columns)
+                if values is None:
+                    continue
+                for (kind, mask) in check.masks(t, values):
+                    for (first, last, count) in intervals(t, mask):
+                        # the samples of a stuck or range interval may all have been dropped as nan
+                        worst = nan_max(np.abs(values[first:last + 1])) if kind != "clipping" else values[last]
+                        anomalies.append({"sensor": label, "field": check.name, "check": kind, "start": t[first],
+                                          "end": t[last], "samples": count, "value": float(worst)})
+    anomalies.sort(key=lambda a: a["start"])
+    return (anomalies, samples)
+
+def __main__():
+    from dfbinary import DFBinaryReader
+    from timeline import format_time
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("files", metavar="<LOGFILE.bin>", nargs="+")
+    args = parser.parse_args()
+    for filename in args.files:
+        reader = DFBinaryReader(filename)
+        (anomalies, samples) = analyse_sensors(reader)
+        print("%s: %u samples, %u anomalies" % (filename, samples, len(anomalies)))
+        for a in anomalies:
+            print("%s  %s\t%s\t%s\t%s\t%u\t%.3f" % (format_time(int(a["start"] * 1e6)), format_time(int(a["end"] * 1e6)),
+                                                  a["sensor"], a["field"], a["check"], a["samples"], a["value"]))
+        reader.close()
+
+if __name__ == "__main__":
+    __main__()
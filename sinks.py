@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+'''
+output sinks of the extracted records: colored console, quiet, JSON Lines, CSV, Parquet and Arrow
+
+Every sink collects what it writes and hands it to its file in large
+chunks, so millions of records do not turn into millions of small writes.
+'''
+
+import sys, io, csv, json, tempfile
+from termcolor import colored
+from timeline import format_time
+
+# the columnar outputs are optional, they need pyarrow
+try:
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# characters collected before they are written out
+BUFFER_SIZE = 1024 * 1024
+# held console output of a section kept in memory before it goes to a temporary file
+SPOOL_SIZE = 4 * 1024 * 1024
+# records of a family written together as a row group or record batch of the columnar outputs
+ROW_GROUP = 65536
+
+# column types of the record families in the columnar outputs, other fields get the type of their first value,
+# a timestamp is an integer of microseconds like the time of the record
+family_types = {
+    "parm": {"Name": "string", "Value": "double"},
+    "msg": {"Message": "string"},
+    "ev": {"Event": "string"},
+    "err": {"Subsys": "string", "ECode": "int64"},
+    "mode": {"Mode": "string", "ModeNum": "int64"},
+    "curr": {"Volt": "double", "Curr": "double", "CurrTot": "double"},
+    "gps": {"Status": "string", "Lat": "double", "Lng": "double", "Alt": "double"},
+    "cmd": {"CId": "int64", "Lat": "double", "Lng": "double", "Alt": "double", "CNum": "int64", "Frame": "int64"},
+    "cmdexec": {"Status": "string", "CId": "int64", "Closest": "timestamp", "Dist": "double"},
+    "curr_anomaly": {"Curr": "double"},
+    "alt_anomaly": {"Next": "timestamp", "Event": "string", "Diff": "double"},
+    "sensor": {"End": "timestamp", "Sensor": "string", "Field": "string", "Check": "string", "Samples": "int64", "Value": "double"},
+    "gps_jump": {"Next": "timestamp", "Event": "string", "Dist": "double", "Speed": "double", "Climb": "double"},
+}
+# fields of the record families holding another time in microseconds, formatted only on the console
+time_fields = dict([(family, tuple([f for (f, t) in types.items() if t == "timestamp"])) for (family, types) in family_types.items()])
+
+class Sink(object):
+    '''base of the sinks, drops everything but keeps the buffered writing'''
+    def __init__(self, f=None, owned=False):
+        self.f = f if f is not None else sys.stdout
+        self.owned = owned
+        self.buf = []
+        self.buffered = 0
+
+    def write(self, text):
+        self.buf.append(text)
+        self.buffered += len(text)
+        if self.buffered >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.f.write("".join(self.buf))
+            self.buf = []
+            self.buffered = 0
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        if self.owned:
+            self.f.close()
+
+    def hold(self, families):
+        '''keep the output of families until their section is written'''
+        pass
+
+    def section(self, title, family=None):
+        '''start a section, writing the held output of family in it'''
+        pass
+
+    def message(self, text, color=None, family=None):
+        '''a line for the reader, not a record'''
+        pass
+
+    def record(self, family, t_us, fields, colors=None, console=True, label=None):
+        '''a record of family at t_us microseconds, fields maps the field names to their values in order
+
+        colors maps field names to the color of their value on the console,
+        console False keeps the record out of the console sections and label is
+        text the console writes before the fields'''
+        pass
+
+    def summary(self, summary):
+        '''the summary of a log once it is analysed'''
+        pass
+
+class ConsoleSink(Sink):
+    '''the sections of gryphon, records colored as they are read'''
+    def __init__(self, f=None, owned=False):
+        Sink.__init__(self, f, owned)
+        self.held = {}
+
+    def hold(self, families):
+        for family in families:
+            if family not in self.held:
+                self.held[family] = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+')
+
+    def line(self, text, family):
+        held = self.held.get(family)
+        if held is not None:
+            held.write(text)
+        else:
+            self.write(text)
+
+    def section(self, title, family=None):
+        self.write("\n>" + title + "\n")
+        held = self.held.pop(family, None)
+        if held is not None:
+            held.seek(0)
+            while True:
+                chunk = held.read(BUFFER_SIZE)
+                if not chunk:
+                    break
+                self.write(chunk)
+            held.close()
+
+    def message(self, text, color=None, family=None):
+        self.line((colored(text, color) if color else text) + "\n", family)
+
+    def record(self, family, t_us, fields, colors=None, console=True, label=None):
+        if not console:
+            return
+        values = [label] if label is not None else []
+        times = time_fields.get(family, ())
+        for (name, value) in fields.items():
+            if name in times:
+                value = format_time(value)
+            if colors and name in colors:
+                values.append(colored(str(value), colors[name]))
+            else:
+                values.append(str(value))
+        self.line(format_time(t_us) + "  " + "\t".join(values) + "\n", family)
+
+    def close(self):
+        for held in self.held.values():
+            held.close()
+        self.held = {}
+        Sink.close(self)
+
+class QuietSink(Sink):
+    '''only the summary of every log'''
+    def summary(self, summary):
+        self.write("\t".join(["%s=%s" % (k, v) for (k, v) in summary.items()]) + "\n")
+
+class JSONLSink(Sink):
+    '''one JSON object per record, and one for the summary'''
+    def record(self, family, t_us, fields, colors=None, console=True, label=None):
+        data = {"family": family, "time": format_time(t_us), "t_us": t_us}
+        data.update(fields)
+        self.write(json.dumps(data, default=str) + "\n")
+
+    def summary(self, summary):
+        data = {"family": "summary"}
+        data.update(summary)
+        self.write(json.dumps(data, default=str) + "\n")
+
+class CSVSink(Sink):
+    '''one row per field of every record, so records of every family share the columns'''
+    header = ["family", "time", "t_us", "record", "field", "value"]
+
+    def __init__(self, f=None, owned=False):
+        Sink.__init__(self, f, owned)
+        self.rows = csv.writer(self, lineterminator="\n")
+        self.rows.writerow(self.header)
+        self.count = 0
+
+    def record(self, family, t_us, fields, colors=None, console=True, label=None):
+        time = format_time(t_us)
+        self.rows.writerows([(family, time, t_us, self.count, name, value) for (name, value) in fields.items()])
+        self.count += 1
+
+    def summary(self, summary):
+        self.rows.writerows([("summary", "", "", self.count, name, value) for (name, value) in summary.items()])
+        self.count += 1
+
+class TeeSink(Sink):
+    '''hands everything to several sinks'''
+    def __init__(self, sinks):
+        Sink.__init__(self)
+        self.sinks = sinks
+
+    def write(self, text):
+        for sink in self.sinks:
+            sink.write(text)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def hold(self, families):
+        for sink in self.sinks:
+            sink.hold(families)
+
+    def section(self, title, family=None):
+        for sink in self.sinks:
+            sink.section(title, family)
+
+    def message(self, text, color=None, family=None):
+        for sink in self.sinks:
+            sink.message(text, color, family)
+
+    def record(self, family, t_us, fields, colors=None, console=True, label=None):
+        for sink in self.sinks:
+            sink.record(family, t_us, fields, colors, console, label)
+
+    def summary(self, summary):
+        for sink in self.sinks:
+            sink.summary(summary)
+
+def value_type(value):
+    '''columnar type of a field nobody declared, from one of its values'''
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int64"
+    if isinstance(value, float):
+        return "double"
+    return "string"
+
+# turn the values of the records, some formatted as text, into their column type
+converters = {"double": float, "int64": int, "bool": bool, "string": str, "timestamp": int}
+
+def arrow_type(name):
+    '''pyarrow type of a column type, the timestamps are in microseconds of UTC as the time of the records'''
+    if name == "timestamp":
+        return pyarrow.timestamp("us", tz="UTC")
+    return pyarrow.type_for_alias(name)
+
+class ColumnarTable(object):
+    '''columns of the records of one family, written a row group at a time'''
+    def __init__(self, filename, fmt, types):
+        self.filename = filename
+        self.fmt = fmt
+        self.types = types
+        self.fields = list(types.keys())
+        self.t_us = []
+        self.columns = dict([(f, []) for f in self.fields])
+        self.writer = None
+
+    def add(self, t_us, fields):
+        self.t_us.append(t_us)
+        for f in self.fields:
+            value = fields.get(f)
+            if value is not None and value != "":
+                try:
+                    value = converters[self.types[f]](value)
+                except (TypeError, ValueError):
+                    value = None
+            else:
+                value = None
+            self.columns[f].append(value)
+        if len(self.t_us) >= ROW_GROUP:
+            self.flush()
+
+    def flush(self):
+        if not self.t_us:
+            return
+        arrays = [pyarrow.array(self.t_us, arrow_type("timestamp"))]
+        arrays += [pyarrow.array(self.columns[f], arrow_type(self.types[f])) for f in self.fields]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, ["t_us"] + self.fields)
+        if self.writer is None:
+            if self.fmt == "parquet":
+                self.writer = pyarrow.parquet.ParquetWriter(self.filename, batch.schema)
+            else:
+                self.writer = pyarrow.ipc.new_file(self.filename, batch.schema)
+        if self.fmt == "parquet":
+            self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        self.t_us = []
+        self.columns = dict([(f, []) for f in self.fields])
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+class ColumnarSink(Sink):
+    '''one typed columnar file per record family, <prefix>.<family>.parquet or .arrow, and one for the summary
+
+    The time is a microsecond UTC timestamp column and the fields have native
+    numeric types, so the files are scanned without parsing any text.'''
+    fmt = "parquet"
+
+    def __init__(self, prefix):
+        if pyarrow is None:
+            raise ImportError("the %s output needs pyarrow, pip install pyarrow" % self.fmt)
+        Sink.__init__(self)
+        self.prefix = prefix
+        self.tables = {}
+
+    def filename(self, family):
+        return "%s.%s.%s" % (self.prefix, family, self.fmt)
+
+    def record(self, family, t_us, fields, colors=None, console=True, label=None):
+        table = self.tables.get(family)
+        if table is None:
+            types = dict(family_types.get(family, {}))
+            for (name, value) in fields.items():
+                if name not in types:
+                    types[name] = value_type(value)
+            table = self.tables[family] = ColumnarTable(self.filename(family), self.fmt, types)
+        table.add(t_us, fields)
+
+    def summary(self, summary):
+        arrays = []
+        for value in summary.values():
+            arrays.append(pyarrow.array([value], pyarrow.type_for_alias(value_type(value))))
+        table = pyarrow.Table.from_arrays(arrays, [str(k) for k in summary.keys()])
+        if self.fmt == "parquet":
+            pyarrow.parquet.write_table(table, self.filename("summary"))
+        else:
+            with pyarrow.ipc.new_file(self.filename("summary"), table.schema) as writer:
+                writer.write_table(table)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+
+class ArrowSink(ColumnarSink):
+    '''the Arrow IPC file flavour of ColumnarSink'''
+    fmt = "arrow"
+
+sink_classes = {"console": ConsoleSink, "quiet": QuietSink, "jsonl": JSONLSink, "csv": CSVSink,
+                "parquet": ColumnarSink, "arrow": ArrowSink}
+# sinks writing one file per family, named from a prefix instead of a single file
+columnar_kinds = ("parquet", "arrow")
+
+def make_sink(kind, filename=None):
+    '''sink of a kind writing to filename, or to the standard output, the columnar ones take a file prefix'''
+    if kind in columnar_kinds:
+        return sink_classes[kind](filename)
+    if filename is None:
+        return sink_classes[kind]()
+    f = io.open(filename, 'w', newline='', buffering=BUFFER_SIZE)
+    return sink_classes[kind](f, owned=True)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+'''
+checks of the native DataFlash decoder against pymavlink and of the live analysis on a replayed tlog
+
+Run with pytest from the directory of the modules.
+'''
+
+import asyncio, socket, struct, threading
+import pytest
+from pymavlink import mavutil
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+import dfsynth
+import live
+from dfbinary import DFBinaryReader
+
+# message types dfsynth writes, every one of them is compared
+TYPES = [f[1] for f in dfsynth.FORMATS]
+# time of the first message of the replayed tlog
+T0 = 1586044881.0
+
+@pytest.fixture(scope="module")
+def synth_log(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp("logs") / "synth.bin")
+    dfsynth.synthesize(filename, 60)
+    return filename
+
+def decoded(log):
+    '''(timestamp, fields) of every message of TYPES'''
+    messages = []
+    while True:
+        m = log.recv_match(type=TYPES)
+        if m is None:
+            return messages
+        if m.get_type() in TYPES:
+            messages.append((m._timestamp, m.to_dict()))
+
+def same_message(a, b):
+    '''whether two (timestamp, fields) are the same, garbage decoded as nan by both included'''
+    return a[0] == b[0] and a[1].keys() == b[1].keys() and \
+        all([a[1][k] == b[1][k] or (a[1][k] != a[1][k] and b[1][k] != b[1][k]) for k in a[1]])
+
+def assert_same_messages(filename):
+    expected = decoded(mavutil.mavlink_connection(filename, notimestamps=False, zero_time_base=False))
+    native = DFBinaryReader(filename)
+    try:
+        messages = decoded(native)
+    finally:
+        native.close()
+    assert len(expected) > 0
+    assert len(messages) == len(expected)
+    for (n, (m, e)) in enumerate(zip(messages, expected)):
+        assert same_message(m, e), "message %u: %s != %s" % (n, m, e)
+
+def test_native_decoder_matches_pymavlink(synth_log, tmp_path):
+    assert_same_messages(synth_log)
+    with open(synth_log, 'rb') as f:
+        data = bytearray(f.read())
+    # cut in the middle of a record
+    truncated = str(tmp_path / "truncated.bin")
+    with open(truncated, 'wb') as f:
+        f.write(data[:len(data) // 2 + 37])
+    assert_same_messages(truncated)
+    # a broken header, whose record both decoders skip, and garbage over the records further on
+    i = data.index(bytes([dfsynth.HEAD1, dfsynth.HEAD2]), len(data) // 2)
+    data[i + 1] = 0
+    data[len(data) // 3:len(data) // 3 + 16] = b'\xff' * 16
+    corrupted = str(tmp_path / "corrupted.bin")
+    with open(corrupted, 'wb') as f:
+        f.write(bytes(data))
+    assert_same_messages(corrupted)
+
+def write_tlog(filename, messages):
+    '''a tlog of messages a tenth of a second apart'''
+    mav = mavlink.MAVLink(None, srcSystem=1, srcComponent=1)
+    with open(filename, 'wb') as f:
+        for (i, msg) in enumerate(messages):
+            f.write(struct.pack('>Q', int((T0 + i * 0.1) * 1.0e6)) + msg.pack(mav))
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_live_replay_events(tmp_path):
+    mav = mavlink.MAVLink(None)
+    vehicle = (mavlink.MAV_TYPE_QUADROTOR, mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA, mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED)
+    (lat, lng) = (-353632610, 1491652300)
+
+    def fix(fix_type, alt):
+        return mav.gps_raw_int_encode(0, fix_type, lat, lng, int(alt * 1000), 65535, 65535, 0, 65535, 10)
+
+    tlog = str(tmp_path / "flight.tlog")
+    write_tlog(tlog, [mav.heartbeat_encode(*(vehicle + (0, mavlink.MAV_STATE_ACTIVE))),
+                      fix(3, 100.0),
+                      fix(3, 101.0),
+                      fix(3, 110.0),
+                      fix(1, 110.0),
+                      mav.statustext_encode(mavlink.MAV_SEVERITY_ERROR, b"ERR Subsys 11 ECode 2"),
+                      mav.statustext_encode(mavlink.MAV_SEVERITY_INFO, b"not an error"),
+                      mav.heartbeat_encode(*(vehicle + (3, mavlink.MAV_STATE_ACTIVE))),
+                      mav.heartbeat_encode(mavlink.MAV_TYPE_GCS, mavlink.MAV_AUTOPILOT_INVALID, 0, 5, 0)])
+    port = free_udp_port()
+    timeline = tmp_path / "flight.analysis"
+    # the replay starts once the analysis listens, which stops after two seconds of silence
+    sender = threading.Timer(0.5, live.replay, (tlog, "127.0.0.1:%u" % port, 0))
+    sender.start()
+    try:
+        events = asyncio.run(live.live_analysis("udpin:127.0.0.1:%u" % port, str(timeline), timeout=2.0, stop_after=2.0))
+    finally:
+        sender.join()
+    rows = [line.split("\t")[:-1] for line in timeline.read_text().splitlines()]
+    assert events == len(rows)
+    desc = dict([(t, mavlink.enums['GPS_FIX_TYPE'][t].description) for t in (1, 3)])
+    position = [str(lat * 1.0e-7), str(lng * 1.0e-7)]
+    assert [row[1:] for row in rows[:3]] == [["STABILIZE", "0"], [desc[3]] + position + ["100.00"],
+                                             [rows[2][1], "Alt Anomaly Detected", "9.00"]]
+    assert [row[1:] for row in rows[3:6]] == [[desc[1]] + position + ["110.00"],
+                                              ["ERR Subsys 11 ECode 2", str(mavlink.MAV_SEVERITY_ERROR)], ["AUTO", "3"]]
+    assert len(rows) == 7 and rows[6][1] == "LINK LOST"
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+'''
+time ordered timeline of the extracted records, spilled to disk past a memory budget
+'''
+
+import sys, time, heapq, pickle, tempfile
+
+# default memory the in memory records of all the streams may take
+DEFAULT_BUDGET = 256 * 1024 * 1024
+# records pickled together in a spill file, and read back together during the merge
+SPILL_BATCH = 4096
+
+# seconds formatted by format_time kept before the cache starts over
+FORMAT_CACHE_SIZE = 100000
+format_cache = {}
+
+def format_time(t_us):
+    '''local time of a timestamp in microseconds, formatted once per second'''
+    sec = t_us // 1000000
+    text = format_cache.get(sec)
+    if text is None:
+        if len(format_cache) >= FORMAT_CACHE_SIZE:
+            format_cache.clear()
+        text = format_cache[sec] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec))
+    return text
+
+def format_row(row, times=()):
+    '''a record as a tab separated line, its timestamp and the other times it holds, columns times, formatted'''
+    fields = [str(i) for i in row[1:]]
+    for c in times:
+        if c < len(row):
+            fields[c - 1] = format_time(row[c])
+    return format_time(row[0]) + '\t' + "".join([f + '\t' for f in fields]) + "\n"
+
+def tagged(run, times):
+    '''the records of a run with the time columns of their stream'''
+    for (t_us, count, row) in run:
+        yield (t_us, count, row, times)
+
+def row_size(row):
+    '''rough memory held by a timeline record'''
+    return sys.getsizeof(row) + sum([sys.getsizeof(i) for i in row]) + 100
+
+def read_run(f):
+    '''the records of a spill file, in the order they were written'''
+    f.seek(0)
+    while True:
+        try:
+            batch = pickle.load(f)
+        except EOFError:
+            break
+        for row in batch:
+            yield row
+
+class TimelineStream(object):
+    '''records of one extraction step, in memory until they are spilled as a sorted run'''
+    def __init__(self, name):
+        self.name = name
+        self.rows = []
+        self.size = 0
+        self.runs = []
+
+    def add(self, entry, size):
+        self.rows.append(entry)
+        self.size += size
+
+    def spill(self):
+        '''write the records in memory to a sorted run in a temporary file'''
+        # the records of a step mostly come in log order, so this sort is mostly a linear check
+        self.rows.sort()
+        f = tempfile.TemporaryFile()
+        for i in range(0, len(self.rows), SPILL_BATCH):
+            pickle.dump(self.rows[i:i+SPILL_BATCH], f, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(f)
+        self.rows = []
+        self.size = 0
+
+    def sorted_runs(self):
+        '''iterators over the sorted runs of the stream, spilled ones first'''
+        self.rows.sort()
+        return [read_run(f) for f in self.runs] + [iter(self.rows)]
+
+    def close(self):
+        for f in self.runs:
+            f.close()
+        self.runs = []
+        self.rows = []
+        self.size = 0
+
+class Timeline(object):
+    '''records of every extraction step, written to the timeline file by a k-way merge
+
+    Every record starts with its timestamp in microseconds, records of the
+    same microsecond keep the order they were added in. Every step adds its
+    records to its own stream. When the records in memory of all the streams
+    go over the budget, the largest stream is sorted and spilled to a
+    temporary file, so the memory stays bounded whatever the length of the log.
+    times maps a stream to the columns of its records, besides the first,
+    holding a time in microseconds, they are formatted only when written.'''
+    def __init__(self, budget=DEFAULT_BUDGET, times=None):
+        self.budget = budget
+        self.times = times if times is not None else {}
+        self.streams = {}
+        self.size = 0
+        self.count = 0
+
+    def reset(self, budget=None):
+        '''drop every record and spill file, optionally changing the budget'''
+        for stream in self.streams.values():
+            stream.close()
+        self.streams = {}
+        self.size = 0
+        self.count = 0
+        if budget is not None:
+            self.budget = budget
+
+    def add(self, name, row):
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = self.streams[name] = TimelineStream(name)
+        size = row_size(row)
+        # the sequence number orders the records of the same microsecond, and no other field is ever compared
+        stream.add((row[0], self.count, row), size)
+        self.count += 1
+        self.size += size
+        if self.size > self.budget:
+            largest = max(self.streams.values(), key=lambda s: s.size)
+            self.size -= largest.size
+            largest.spill()
+
+    def merged(self):
+        '''every record in time order, with the time columns of its stream'''
+        runs = []
+        for stream in self.streams.values():
+            times = self.times.get(stream.name, ())
+            runs.extend([tagged(run, times) for run in stream.sorted_runs()])
+        for (t_us, count, row, times) in heapq.merge(*runs):
+            yield (row, times)
+
+    def write(self, filename):
+        '''write the records tab separated, one per line'''
+        with open(filename, 'w+') as log:
+            for (row, times) in self.merged():
+                log.write(format_row(row, times))
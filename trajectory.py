@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+'''
+geometry of the recorded GPS track
+'''
+
+import numpy as np
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+# moves between two fixes faster than that, in m/s, are not flown by any vehicle but jumps of the position
+MAX_GROUND_SPEED = 150.0
+MAX_CLIMB_RATE = 50.0
+
+def geodetic_to_ecef(lats, lons, alts):
+    '''earth centred x, y, z in metres of WGS84 latitudes, longitudes and altitudes'''
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    alt = np.asarray(alts, dtype=np.float64)
+    sin_lat = np.sin(lat)
+    n = WGS84_A / np.sqrt(1 - WGS84_E2 * sin_lat ** 2)
+    x = (n + alt) * np.cos(lat) * np.cos(lon)
+    y = (n + alt) * np.cos(lat) * np.sin(lon)
+    z = (n * (1 - WGS84_E2) + alt) * sin_lat
+    return np.stack((x, y, z), axis=-1)
+
+def geodetic_to_enu(lats, lons, alts, origin):
+    '''east, north, up metres of WGS84 points around the (lat, lon, alt) origin'''
+    d = geodetic_to_ecef(lats, lons, alts) - geodetic_to_ecef(*origin)
+    (lat, lon) = np.radians(origin[:2])
+    (sin_lat, cos_lat, sin_lon, cos_lon) = (np.sin(lat), np.cos(lat), np.sin(lon), np.cos(lon))
+    rotation = np.array([[-sin_lon, cos_lon, 0],
+                         [-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat],
+                         [cos_lat * cos_lon, cos_lat * sin_lon, sin_lat]])
+    return d.reshape(-1, 3).dot(rotation.T)
+
+class Trajectory(object):
+    '''GPS track in local east, north, up metres, with its speeds and accelerations
+
+    The fixes are projected in one go through ECEF around the origin, the
+    first fix by default, so distances are true 3D metres. The rates are
+    finite differences of consecutive fixes: velocity, ground_speed and
+    climb_rate are per segment, one less than the fixes, acceleration per
+    pair of segments and jerk per three. Fixes of the same time give NaN.'''
+    def __init__(self, t, lats, lons, alts, origin=None):
+        self.t = np.asarray(t, dtype=np.float64)
+        if origin is None and len(self.t):
+            origin = (float(lats[0]), float(lons[0]), float(alts[0]))
+        self.origin = origin
+        self.enu = self.project(lats, lons, alts)
+        dt = np.diff(self.t)
+        dt = np.where(dt > 0, dt, np.nan)
+        self.segments = np.diff(self.enu, axis=0)
+        self.velocity = self.segments / dt[:, None]
+        # the up of the origin tilts away from the one of far fixes, the climb is the one of the altitudes
+        climb = np.diff(np.asarray(alts, dtype=np.float64))
+        self.climb_rate = climb / dt
+        self.ground_speed = np.sqrt(np.maximum((self.segments ** 2).sum(axis=1) - climb ** 2, 0)) / dt
+        # the velocity of a segment is the one of its middle
+        mid = (self.t[1:] + self.t[:-1]) * 0.5
+        dmid = np.diff(mid)
+        dmid = np.where(dmid > 0, dmid, np.nan)
+        accel = np.diff(self.velocity, axis=0) / dmid[:, None]
+        self.acceleration = np.linalg.norm(accel, axis=1)
+        dtau = np.diff((mid[1:] + mid[:-1]) * 0.5)
+        dtau = np.where(dtau > 0, dtau, np.nan)
+        self.jerk = np.linalg.norm(np.diff(accel, axis=0), axis=1) / dtau
+
+    def __len__(self):
+        return len(self.t)
+
+    def project(self, lats, lons, alts):
+        '''east, north, up metres of other points in the frame of the trajectory'''
+        if self.origin is None:
+            return np.zeros((0, 3))
+        return geodetic_to_enu(lats, lons, alts, self.origin)
+
+    def jumps(self, max_speed=MAX_GROUND_SPEED, max_climb=MAX_CLIMB_RATE):
+        '''indexes i of the segments from fix i to i+1 no vehicle could have flown, the signature of a glitch or of spoofing'''
+        with np.errstate(invalid='ignore'):
+            return np.flatnonzero((self.ground_speed > max_speed) | (np.abs(self.climb_rate) > max_climb))
+
+class TrackIndex(object):
+    '''uniform grid over the fixes of a track, for radius queries
+
+    The distance is the 3D euclidean one of the coordinates, the ENU metres
+    of a Trajectory. The cells are as large as the tolerance, so a query
+    only looks at the fixes of the 27 cells around its point.'''
+    def __init__(self, coords, tolerance):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+        self.tolerance = tolerance
+        # a hair larger than the tolerance so rounding can never push a match two cells away
+        self.cell = tolerance * (1 + 1e-9)
+        self.cells = {}
+        if len(self.coords) == 0:
+            return
+        keys = np.floor(self.coords / self.cell).astype(np.int64)
+        # group the fixes by cell, keeping the track order inside every cell
+        order = np.lexsort((np.arange(len(keys)), keys[:, 2], keys[:, 1], keys[:, 0]))
+        keys = keys[order]
+        bounds = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(keys)]))
+        for (s, e) in zip(starts.tolist(), ends.tolist()):
+            self.cells[tuple(keys[s].tolist())] = order[s:e]
+
+    def query(self, point):
+        '''return (first, closest, distance) of the fixes within the tolerance of point, or None
+
+        first and closest are indexes in the track'''
+        point = np.asarray(point, dtype=np.float64)
+        (cx, cy, cz) = np.floor(point / self.cell).astype(np.int64).tolist()
+        found = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    idx = self.cells.get((cx + dx, cy + dy, cz + dz))
+                    if idx is not None:
+                        found.append(idx)
+        if not found:
+            return None
+        idx = np.sort(np.concatenate(found))
+        d = self.coords[idx] - point
+        dist = np.sqrt(d[:, 0] ** 2 + d[:, 1] ** 2 + d[:, 2] ** 2)
+        inside = dist <= self.tolerance
+        if not np.any(inside):
+            return None
+        idx = idx[inside]
+        dist = dist[inside]
+        closest = int(np.argmin(dist))
+        return (int(idx[0]), int(idx[closest]), float(dist[closest]))
+
+# error allowed on a map, in pixels
+SIMPLIFY_PIXELS = 0.5
+
+def local_metres(lats, lons):
+    '''equirectangular x, y in metres around the first point, accurate enough over a flight'''
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if len(lats) == 0:
+        return np.zeros((0, 2))
+    scale = np.radians(1.0) * 6378137.0
+    x = (lons - lons[0]) * scale * np.cos(np.radians(lats[0]))
+    y = (lats - lats[0]) * scale
+    return np.stack((x, y), axis=-1)
+
+def segment_distances(xy, s, e):
+    '''distances of the points between s and e to the segment from s to e'''
+    p = xy[s+1:e]
+    a = xy[s]
+    d = xy[e] - a
+    length2 = d[0] * d[0] + d[1] * d[1]
+    if length2 == 0:
+        return np.hypot(p[:, 0] - a[0], p[:, 1] - a[1])
+    t = np.clip(((p[:, 0] - a[0]) * d[0] + (p[:, 1] - a[1]) * d[1]) / length2, 0.0, 1.0)
+    return np.hypot(p[:, 0] - a[0] - t * d[0], p[:, 1] - a[1] - t * d[1])
+
+def douglas_peucker(xy, tolerance):
+    '''mask of the points of a polyline kept by Douglas-Peucker with tolerance
+
+    The end points are always kept, a segment is split at its farthest point
+    while that point is more than tolerance away from it.'''
+    n = len(xy)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        (s, e) = stack.pop()
+        if e - s < 2:
+            continue
+        dist = segment_distances(xy, s, e)
+        i = int(np.argmax(dist))
+        if dist[i] <= tolerance:
+            continue
+        i += s + 1
+        keep[i] = True
+        stack.append((s, i))
+        stack.append((i, e))
+    return keep
+
+def simplify_path(points, tolerance):
+    '''the points of a map path of (lat, lon[, colour]) points kept by Douglas-Peucker with tolerance metres
+
+    Every run of one colour is simplified on its own, keeping its two ends,
+    so the points where the colour changes stay on the map.'''
+    n = len(points)
+    xy = local_metres([p[0] for p in points], [p[1] for p in points])
+    keep = np.zeros(n, dtype=bool)
+    colours = [p[2] if len(p) > 2 else None for p in points]
+    start = 0
+    for i in range(1, n + 1):
+        if i == n or colours[i] != colours[start]:
+            keep[start:i] = douglas_peucker(xy[start:i], tolerance)
+            start = i
+    return [points[i] for i in np.flatnonzero(keep).tolist()]